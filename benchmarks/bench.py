@@ -0,0 +1,198 @@
+"""
+Benchmarks for the hot paths of a backup run on a synthetic git repository.
+
+    python -m benchmarks.bench --files 20000 --ignored-files 100000 --commits 200 --output bench.json
+
+Everything runs locally: the "remote" of the generated repository is a bare repository next to it.
+"""
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import platform
+import shutil
+import subprocess
+import tempfile
+from pathlib import Path
+from git_backup_notifier.utils import compile_exclusions, get_uncommitted_files, get_unpushed_files, copy_files, \
+    delete_old_files
+
+GIT_ENV = {'GIT_AUTHOR_NAME': 'bench', 'GIT_AUTHOR_EMAIL': 'bench@example.com',
+           'GIT_COMMITTER_NAME': 'bench', 'GIT_COMMITTER_EMAIL': 'bench@example.com'}
+EXCLUDE_DIRS = ['.git', 'venv', 'node_modules', '__pycache__']
+EXCLUDE_PATTERNS = ['*.log', '*.tmp', '*.bak']
+
+
+def git(repo_path, *args):
+    subprocess.run(['git'] + list(args), cwd=repo_path, check=True, stdout=subprocess.DEVNULL,
+                   env=dict(os.environ, **GIT_ENV))
+
+
+def write_file(path, size, rng):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(rng.randbytes(size) if hasattr(rng, 'randbytes') else os.urandom(size))
+
+
+def spread_paths(prefix, count, depth, width=10):
+    """
+    Return count file paths spread over a directory tree of the given depth.
+    """
+    paths = []
+    for i in range(count):
+        parts = [f'd{(i // width ** (level + 1)) % width}' for level in range(depth)]
+        paths.append(Path(prefix, *parts, f'file{i}.txt'))
+    return paths
+
+
+def generate_repo(path, files=1000, depth=3, ignored_files=1000, commits=10, unpushed_commits=2,
+                  untracked_files=100, modified_files=50, large_files=2, large_file_size=5 * 1024 * 1024,
+                  small_file_size=512, seed=0):
+    """
+    Create a git repository with a local bare remote. The last unpushed_commits commits are not pushed,
+    ignored_files end up in an ignored node_modules tree.
+    """
+    rng = random.Random(seed)
+    path = Path(path)
+    remote = path.with_name(path.name + '.git')
+    path.mkdir(parents=True)
+    git(path.parent, 'init', '--bare', '-q', str(remote))
+    git(path, 'init', '-q')
+    git(path, 'remote', 'add', 'origin', str(remote))
+
+    (path / '.gitignore').write_text('node_modules/\n*.log\n')
+    tracked = spread_paths('src', files, depth)
+    for relative_path in tracked:
+        write_file(path / relative_path, small_file_size, rng)
+    for i in range(large_files):
+        write_file(path / 'data' / f'large{i}.bin', large_file_size, rng)
+    git(path, 'add', '-A')
+    git(path, 'commit', '-q', '-m', 'Initial commit')
+
+    for i in range(1, commits):
+        if i == commits - unpushed_commits:
+            git(path, 'push', '-q', '-u', 'origin', 'HEAD')
+        for relative_path in rng.sample(tracked, min(len(tracked), 5)):
+            write_file(path / relative_path, small_file_size, rng)
+        git(path, 'commit', '-q', '-a', '-m', f'Commit {i}')
+    if unpushed_commits == 0 or commits <= unpushed_commits:
+        git(path, 'push', '-q', '-u', 'origin', 'HEAD')
+
+    for relative_path in rng.sample(tracked, min(len(tracked), modified_files)):
+        write_file(path / relative_path, small_file_size, rng)
+    for relative_path in spread_paths('untracked', untracked_files, depth):
+        write_file(path / relative_path, small_file_size, rng)
+    for relative_path in spread_paths('node_modules', ignored_files, depth):
+        write_file(path / relative_path, small_file_size, rng)
+    return path
+
+
+def timed(stages, name, func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    stages[name] = round(time.perf_counter() - start, 6)
+    return result
+
+
+def run_benchmark(repo_path, backup_root_path):
+    """
+    Time every stage of a backup of repo_path once. The copy stage runs twice: into an empty backup
+    and again when everything is up to date.
+    """
+    logger = logging.getLogger('benchmark')
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+    matcher = compile_exclusions(EXCLUDE_DIRS, EXCLUDE_PATTERNS)
+    repo_backup_path = Path(backup_root_path) / Path(repo_path).name
+    stages = {}
+    counts = {}
+
+    uncommitted_files = timed(stages, 'get_uncommitted_files', get_uncommitted_files, repo_path, matcher)
+    unpushed_files = timed(stages, 'get_unpushed_files', get_unpushed_files, repo_path, matcher=matcher)
+    all_files = set(uncommitted_files) | set(unpushed_files)
+    counts['uncommitted_files'] = len(uncommitted_files)
+    counts['unpushed_files'] = len(unpushed_files)
+
+    counts['copied'], counts['skipped'] = timed(
+        stages, 'copy_files_cold', copy_files, all_files, repo_path, repo_backup_path, EXCLUDE_PATTERNS,
+        EXCLUDE_DIRS, 0, 999_999_999, logger, False)
+    timed(stages, 'copy_files_warm', copy_files, all_files, repo_path, repo_backup_path, EXCLUDE_PATTERNS,
+          EXCLUDE_DIRS, 0, 999_999_999, logger, False)
+    counts['deleted'] = timed(stages, 'delete_old_files', delete_old_files, backup_root_path, [repo_path], 0,
+                              logger, True)
+    return stages, counts
+
+
+def run(shape, repeat=1, work_dir=None):
+    """
+    Generate a repository of the given shape and benchmark it repeat times. Reports the fastest time per stage.
+    """
+    temp_dir = tempfile.mkdtemp(dir=work_dir)
+    try:
+        repo_path = Path(temp_dir) / 'repo'
+        start = time.perf_counter()
+        generate_repo(repo_path, **shape)
+        generate_seconds = round(time.perf_counter() - start, 3)
+
+        best = {}
+        counts = {}
+        for i in range(repeat):
+            backup_root_path = Path(temp_dir) / f'backup{i}'
+            backup_root_path.mkdir()
+            stages, counts = run_benchmark(str(repo_path), str(backup_root_path))
+            for name, seconds in stages.items():
+                best[name] = min(seconds, best.get(name, seconds))
+    finally:
+        shutil.rmtree(temp_dir)
+
+    git_version = subprocess.run(['git', '--version'], capture_output=True, text=True).stdout.strip()
+    return {
+        'shape': shape,
+        'repeat': repeat,
+        'generate_seconds': generate_seconds,
+        'stages': best,
+        'counts': counts,
+        'environment': {'python': platform.python_version(), 'git': git_version, 'platform': platform.platform()},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the backup stages on a generated git repository.")
+    parser.add_argument('--files', type=int, default=1000, help='Tracked files.')
+    parser.add_argument('--depth', type=int, default=3, help='Directory depth of the generated trees.')
+    parser.add_argument('--ignored-files', type=int, default=1000, help='Files in the ignored node_modules tree.')
+    parser.add_argument('--commits', type=int, default=10, help='Number of commits.')
+    parser.add_argument('--unpushed-commits', type=int, default=2, help='How many of the commits are not pushed.')
+    parser.add_argument('--untracked-files', type=int, default=100, help='Untracked files.')
+    parser.add_argument('--modified-files', type=int, default=50, help='Tracked files with uncommitted changes.')
+    parser.add_argument('--large-files', type=int, default=2, help='Number of large files.')
+    parser.add_argument('--large-file-size', type=int, default=5 * 1024 * 1024, help='Size of large files in bytes.')
+    parser.add_argument('--small-file-size', type=int, default=512, help='Size of all other files in bytes.')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per stage, the fastest one is reported.')
+    parser.add_argument('--work-dir', type=str, help='Directory for the generated repository (default: temp dir).')
+    parser.add_argument('--output', type=str, help='Write the JSON results to this file instead of stdout.')
+    args = parser.parse_args()
+
+    shape = {
+        'files': args.files,
+        'depth': args.depth,
+        'ignored_files': args.ignored_files,
+        'commits': args.commits,
+        'unpushed_commits': args.unpushed_commits,
+        'untracked_files': args.untracked_files,
+        'modified_files': args.modified_files,
+        'large_files': args.large_files,
+        'large_file_size': args.large_file_size,
+        'small_file_size': args.small_file_size,
+    }
+    results = json.dumps(run(shape, args.repeat, args.work_dir), indent=2)
+    if args.output:
+        Path(args.output).write_text(results + '\n')
+    else:
+        sys.stdout.write(results + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""
+Startup time of the command line tool for a run that has nothing to do.
+
+    python -m benchmarks.startup --repeat 10 --output startup.json
+
+Watch wrappers and git hooks start the tool very often, so a no-op run has to stay within STARTUP_BUDGET_SECONDS.
+The exit code is 1 if the median no-op run takes longer or a notification backend is imported at startup.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+import shutil
+import subprocess
+import tempfile
+from pathlib import Path
+from git_backup_notifier.utils import load_config
+
+STARTUP_BUDGET_SECONDS = 0.3
+# Only imported when a notification is sent
+LAZY_MODULES = ['requests', 'plyer', 'smtplib', 'email.mime.text', 'toml']
+PACKAGE_ROOT = Path(__file__).resolve().parent.parent
+
+NOOP_CONFIG = """
+[BackupSettings]
+backup_root_path = "{backup_root_path}"
+
+[Repositories]
+repo_paths = []
+
+[Notifications]
+local = false
+
+[GeneralSettings]
+test_mode = true
+"""
+
+
+def run_python(args, cwd, env):
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable] + args, cwd=cwd, env=env, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"{' '.join(args)} failed: {result.stderr.strip()}")
+    return time.perf_counter() - start, result.stdout
+
+
+def run(repeat=5, work_dir=None):
+    """
+    Time a bare interpreter, the import of the backup module and a no-op backup run (no repositories,
+    no notification channels) in fresh processes. Returns the results as a dict, times are medians.
+    """
+    work_dir = Path(tempfile.mkdtemp(dir=work_dir))
+    try:
+        (work_dir / 'config').mkdir(parents=True, exist_ok=True)
+        (work_dir / 'backup').mkdir(exist_ok=True)
+        config_path = work_dir / 'config' / 'default.toml'
+        config_path.write_text(NOOP_CONFIG.format(backup_root_path=work_dir / 'backup'))
+        # Older than the grace period of the config cache, so the runs after the first one use the cache
+        os.utime(config_path, (time.time() - 60, time.time() - 60))
+        python_path = os.pathsep.join(filter(None, [str(PACKAGE_ROOT), os.environ.get('PYTHONPATH')]))
+        env = dict(os.environ, PYTHONPATH=python_path, GIT_BACKUP_NOTIFIER_CACHE_DIR=str(work_dir / 'cache'))
+
+        check = (f'import sys, json, git_backup_notifier.backup; '
+                 f'print(json.dumps([m for m in {LAZY_MODULES!r} if m in sys.modules]))')
+        imported = json.loads(run_python(['-c', check], work_dir, env)[1])
+        run_python(['-m', 'git_backup_notifier.backup'], work_dir, env)  # Fills the config cache
+        timings = {'interpreter': [], 'import': [], 'noop_run': []}
+        for _ in range(repeat):
+            timings['interpreter'].append(run_python(['-c', 'pass'], work_dir, env)[0])
+            timings['import'].append(run_python(['-c', 'import git_backup_notifier.backup'], work_dir, env)[0])
+            timings['noop_run'].append(run_python(['-m', 'git_backup_notifier.backup'], work_dir, env)[0])
+
+        config_times = {}
+        for name, cache_dir in [('config_parse', False), ('config_cached', work_dir / 'cache')]:
+            start = time.perf_counter()
+            for _ in range(repeat):
+                load_config(config_path, cache_dir=cache_dir)
+            config_times[name] = (time.perf_counter() - start) / repeat
+    finally:
+        shutil.rmtree(work_dir)
+
+    seconds = {name: statistics.median(values) for name, values in timings.items()}
+    seconds.update(config_times)
+    return {
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'repeat': repeat,
+        'seconds': seconds,
+        'budget_seconds': STARTUP_BUDGET_SECONDS,
+        'within_budget': seconds['noop_run'] <= STARTUP_BUDGET_SECONDS and not imported,
+        'eagerly_imported': imported,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the startup time of a no-op backup run.")
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per measurement, the median is reported.')
+    parser.add_argument('--work-dir', type=str, help='Directory for the config and backup root (default: temp dir).')
+    parser.add_argument('--output', type=str, help='Write the JSON results to this file instead of stdout.')
+    args = parser.parse_args()
+
+    results = run(args.repeat, args.work_dir)
+    text = json.dumps(results, indent=2)
+    if args.output:
+        Path(args.output).write_text(text + '\n')
+    else:
+        sys.stdout.write(text + '\n')
+    if not results['within_budget']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,345 @@
+import os
+import gzip
+import json
+import tarfile
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from git_backup_notifier import metrics
+from git_backup_notifier.utils import compile_exclusions, file_event, COPY_BUFFER_SIZE
+
+COMPRESSIONS = {'gzip': '.tar.gz', 'zstd': '.tar.zst'}
+# Uncompressed bytes per compressed frame. Extracting a single file decompresses from the start of its frame.
+FRAME_SIZE = 1024 * 1024
+
+
+def _import_zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError("archive_compression = \"zstd\" needs the zstandard package "
+                           "(pip install git-backup-notifier[zstd])")
+    return zstandard
+
+
+def get_compressor(compression, level=None):
+    """
+    Return a function that compresses bytes into one complete gzip member or zstd frame.
+    Concatenated members/frames are a valid gzip/zstd stream, so the archive is a regular .tar.gz/.tar.zst.
+    """
+    if compression == 'gzip':
+        return lambda data: gzip.compress(data, 6 if level is None else level)
+    if compression == 'zstd':
+        compressor = _import_zstandard().ZstdCompressor(level=3 if level is None else level)
+        return compressor.compress
+    raise ValueError(f"Unknown archive compression: {compression}")
+
+
+def open_decompressed(fileobj, compression):
+    """
+    Return a reader of the decompressed stream of fileobj, starting at its current position.
+    """
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+    if compression == 'zstd':
+        return _import_zstandard().ZstdDecompressor().stream_reader(fileobj, read_across_frames=True)
+    raise ValueError(f"Unknown archive compression: {compression}")
+
+
+class FrameWriter:
+    """
+    Buffer the uncompressed tar stream and write it as independently compressed frames of about frame_size bytes.
+    """
+
+    def __init__(self, out, compress, frame_size=None):
+        self._out = out
+        self._compress = compress
+        self._frame_size = frame_size or FRAME_SIZE
+        self._buffer = bytearray()
+        self.frame_offset = 0
+        self.uncompressed_size = 0
+
+    def position(self):
+        """
+        Return (offset of the current frame in the archive, offset of the next byte in the uncompressed frame).
+        """
+        return self.frame_offset, len(self._buffer)
+
+    def write(self, data):
+        self._buffer += data
+        self.uncompressed_size += len(data)
+        if len(self._buffer) >= self._frame_size:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            self.frame_offset += self._out.write(self._compress(bytes(self._buffer)))
+            self._buffer.clear()
+
+
+class ArchiveStore:
+    """
+    Compressed tar archives below the backup root, one per repository and run in <repo>/.
+    Every archive has a JSON index with the position of each file, so a single file can be extracted
+    by decompressing only the frame it starts in and what follows up to its end.
+    """
+
+    def __init__(self, root_path):
+        self.root_path = Path(root_path)
+
+    @classmethod
+    def for_backup_root(cls, backup_root_path):
+        return cls(Path(backup_root_path) / '.archives')
+
+    def archive_path(self, repo_name, archive_id, compression):
+        return self.root_path / repo_name / f'{archive_id}{COMPRESSIONS[compression]}'
+
+    def index_path(self, repo_name, archive_id):
+        return self.root_path / repo_name / f'{archive_id}.index.json'
+
+    def list_archives(self, repo_name):
+        """
+        Return the ids of the complete archives of a repository, oldest first.
+        """
+        repo_archives_path = self.root_path / repo_name
+        if not repo_archives_path.is_dir():
+            return []
+        return sorted(path.name[:-len('.index.json')] for path in repo_archives_path.glob('*.index.json'))
+
+    def load_index(self, repo_name, archive_id=None):
+        """
+        Return the index of an archive (latest if no id is given) or None if there is none.
+        """
+        if archive_id is None:
+            archives = self.list_archives(repo_name)
+            if not archives:
+                return None
+            archive_id = archives[-1]
+        with open(self.index_path(repo_name, archive_id)) as f:
+            return json.load(f)
+
+    def write_archive(self, repo_name, src_base_path, files, compression, level=None, logger=None):
+        """
+        Write files (relative paths below src_base_path with their stat result) as a new archive.
+        Returns the archive id and its index entries.
+        """
+        archive_id = datetime.now().strftime('%Y%m%dT%H%M%S%f')
+        archive_path = self.archive_path(repo_name, archive_id, compression)
+        archive_path.parent.mkdir(parents=True, exist_ok=True)
+        entries = {}
+        fd, tmp_name = tempfile.mkstemp(prefix=f'.{archive_id}.', suffix='.tmp', dir=archive_path.parent)
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                writer = FrameWriter(out, get_compressor(compression, level))
+                for file, src_stat in files:
+                    frame, offset = writer.position()
+                    if _write_member(writer, Path(src_base_path) / file, file, src_stat, logger, repo_name):
+                        entries[file] = {'size': src_stat.st_size, 'mtime_ns': src_stat.st_mtime_ns,
+                                         'mode': src_stat.st_mode & 0o7777, 'frame': frame, 'offset': offset}
+                writer.write(tarfile.NUL * (2 * tarfile.BLOCKSIZE))
+                remainder = writer.uncompressed_size % tarfile.RECORDSIZE
+                if remainder:
+                    writer.write(tarfile.NUL * (tarfile.RECORDSIZE - remainder))
+                writer.flush()
+            os.replace(tmp_name, archive_path)
+        except BaseException:
+            try:
+                os.unlink(tmp_name)
+            except OSError:
+                pass
+            raise
+        index = {'repo': repo_name, 'archive': archive_path.name, 'compression': compression, 'files': entries}
+        tmp_index_path = archive_path.parent / f'.{archive_id}.index.tmp'
+        tmp_index_path.write_text(json.dumps(index, indent=1, sort_keys=True))
+        os.replace(tmp_index_path, self.index_path(repo_name, archive_id))
+        return archive_id, entries
+
+    def extract_file(self, repo_name, file, target_file, archive_id=None):
+        """
+        Extract a single file of an archive (latest if no id is given) to target_file.
+        """
+        index = self.load_index(repo_name, archive_id)
+        if index is None or file not in index['files']:
+            raise FileNotFoundError(f"{file} is not in the archive of {repo_name}")
+        entry = index['files'][file]
+        with open(self.root_path / repo_name / index['archive'], 'rb') as f:
+            f.seek(entry['frame'])
+            stream = open_decompressed(f, index['compression'])
+            _skip(stream, entry['offset'])
+            with tarfile.open(fileobj=stream, mode='r|') as tar:
+                member = tar.next()
+                _extract_member(tar, member, target_file, entry)
+
+    def delete_expired(self, repo_names, delete_after_days, logger, test_mode=True):
+        """
+        Delete archives older than delete_after_days. The latest archive of a repository is always kept.
+        Returns the number of deleted archives.
+        """
+        cutoff = time.time() - delete_after_days * 24 * 60 * 60
+        deleted = 0
+        for repo_name in repo_names:
+            for archive_id in self.list_archives(repo_name)[:-1]:
+                index_path = self.index_path(repo_name, archive_id)
+                try:
+                    if index_path.stat().st_mtime >= cutoff:
+                        continue
+                    archive_path = self.root_path / repo_name / self.load_index(repo_name, archive_id)['archive']
+                    if not test_mode:
+                        index_path.unlink()
+                        if archive_path.exists():
+                            archive_path.unlink()
+                    logger.info(f"Deleted {archive_path} (older than {delete_after_days} days). Test mode: {test_mode}")
+                    deleted += 1
+                except (OSError, ValueError) as e:
+                    logger.error(f"Failed to delete archive {archive_id} of {repo_name}: {e}")
+        return deleted
+
+
+def _write_member(writer, src_file, name, src_stat, logger, repo_name):
+    """
+    Write the tar header and content of a file. The content is cut or padded to the size in src_stat,
+    in case the file changes while it is read.
+    """
+    try:
+        src = open(src_file, 'rb')
+    except OSError as e:
+        if logger:
+            logger.error("Failed to archive %s: %s", src_file, e, extra=file_event(repo_name, name, 'failed'))
+        return False
+    with src:
+        tarinfo = tarfile.TarInfo(name)
+        tarinfo.size = src_stat.st_size
+        tarinfo.mtime = src_stat.st_mtime
+        tarinfo.mode = src_stat.st_mode & 0o7777
+        writer.write(tarinfo.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape'))
+        remaining = src_stat.st_size
+        while remaining:
+            chunk = src.read(min(remaining, COPY_BUFFER_SIZE))
+            if not chunk:
+                if logger:
+                    logger.warning(f"{src_file} shrank while it was archived, padded with zeros")
+                chunk = tarfile.NUL * remaining
+            writer.write(chunk)
+            remaining -= len(chunk)
+        padding = -src_stat.st_size % tarfile.BLOCKSIZE
+        if padding:
+            writer.write(tarfile.NUL * padding)
+    metrics.count('bytes_copied', src_stat.st_size)
+    return True
+
+
+def _skip(stream, size):
+    while size:
+        chunk = stream.read(min(size, COPY_BUFFER_SIZE))
+        if not chunk:
+            raise EOFError("Unexpected end of archive")
+        size -= len(chunk)
+
+
+def _extract_member(tar, member, target_file, entry):
+    target_file = Path(target_file)
+    target_file.parent.mkdir(parents=True, exist_ok=True)
+    with tar.extractfile(member) as src, open(target_file, 'wb') as dst:
+        while True:
+            chunk = src.read(COPY_BUFFER_SIZE)
+            if not chunk:
+                break
+            dst.write(chunk)
+    os.chmod(target_file, entry['mode'])
+    os.utime(target_file, ns=(entry['mtime_ns'], entry['mtime_ns']))
+
+
+def archive_files(file_list, src_base_path, store, repo_name, exclude_patterns, exclude_dirs, min_size, max_size,
+                  logger, test_mode=True, compression='gzip', level=None):
+    """
+    Write the files of a repository into one compressed archive per run, applying exclusions and size filters
+    like copy_files. No archive is written if all files have the same size and mtime as in the latest archive.
+    Returns the number of archived and skipped files.
+    """
+    matcher = compile_exclusions(exclude_dirs, exclude_patterns)
+    previous = store.load_index(repo_name)
+    previous_files = previous['files'] if previous else None
+    selected = []
+    skipped = 0
+    for file in sorted(file_list):
+        src_file = Path(src_base_path) / file
+
+        reason = matcher.reason(file)
+        if reason:
+            metrics.count('files_filtered')
+            logger.debug("Skipped %s (excluded by %s)", src_file, reason,
+                         extra=file_event(repo_name, file, 'excluded'))
+            skipped += 1
+            continue
+
+        try:
+            src_stat = src_file.stat()
+        except OSError as e:
+            skipped += 1
+            logger.error(f"Failed to archive {src_file}: {e}")
+            continue
+        if not (min_size <= src_stat.st_size <= max_size):
+            metrics.count('files_filtered')
+            logger.debug("Skipped %s (file size out of range)", src_file,
+                         extra=file_event(repo_name, file, 'filtered'))
+            skipped += 1
+            continue
+        selected.append((file, src_stat))
+
+    unchanged = previous_files is not None and len(previous_files) == len(selected) and all(
+        file in previous_files and previous_files[file]['size'] == src_stat.st_size
+        and previous_files[file]['mtime_ns'] == src_stat.st_mtime_ns for file, src_stat in selected)
+    if unchanged or not selected:
+        logger.debug(f"No new archive for {repo_name} (nothing changed since the last archive)")
+        skipped += len(selected)
+        copied = 0
+    elif test_mode:
+        logger.info(f"Would archive {len(selected)} files of {repo_name}. Test mode: {test_mode}")
+        copied = len(selected)
+    else:
+        archive_id, entries = store.write_archive(repo_name, src_base_path, selected, compression, level, logger)
+        copied = len(entries)
+        skipped += len(selected) - len(entries)
+        logger.info(f"Archived {copied} files of {repo_name} as {archive_id}")
+    metrics.count('files_copied', copied)
+    metrics.count('files_skipped', skipped)
+    return copied, skipped
+
+
+def restore_archive(store, repo_name, target_path, logger, archive_id=None, files=None):
+    """
+    Extract the files of an archive (latest if no id is given) below target_path, or only the given files.
+    Returns the number of restored files.
+    """
+    index = store.load_index(repo_name, archive_id)
+    if index is None:
+        raise FileNotFoundError(f"No archive found for {repo_name}")
+    restored = 0
+    if files:
+        for file in files:
+            target_file = Path(target_path) / file
+            try:
+                store.extract_file(repo_name, file, target_file, archive_id)
+                restored += 1
+                logger.info(f"Restored {target_file}")
+            except (OSError, tarfile.TarError) as e:
+                logger.error(f"Failed to restore {target_file}: {e}")
+        return restored
+
+    # Everything: one sequential pass through the archive
+    with open(store.root_path / repo_name / index['archive'], 'rb') as f:
+        stream = open_decompressed(f, index['compression'])
+        with tarfile.open(fileobj=stream, mode='r|') as tar:
+            for member in tar:
+                entry = index['files'].get(member.name)
+                if entry is None or not member.isfile():
+                    continue
+                target_file = Path(target_path) / member.name
+                try:
+                    _extract_member(tar, member, target_file, entry)
+                    restored += 1
+                    logger.info(f"Restored {target_file}")
+                except OSError as e:
+                    logger.error(f"Failed to restore {target_file}: {e}")
+    return restored
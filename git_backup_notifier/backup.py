@@ -1,62 +1,574 @@
 import sys
 import os
 import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from git_backup_notifier.utils import setup_logger, validate_paths, check_free_space, load_config, \
-    get_uncommitted_files, get_unpushed_files, copy_files, delete_old_files
-from git_backup_notifier.notifications import send_notification
+    iter_candidate_files, copy_files, copy_file, delete_old_files, create_buffered_logger, \
+    get_head_commit, get_state_dir, StateFile, compile_exclusions, RepoFingerprints, ErrorCountHandler
+from git_backup_notifier.manifest import BackupManifest, verify_manifest, rebuild_manifest, delete_expired_files
+from git_backup_notifier.snapshots import SnapshotStore, snapshot_files, restore_snapshot
+from git_backup_notifier.scheduling import prioritize_files
+from git_backup_notifier.fanout import Destination, fan_out_files
+from git_backup_notifier.planning import plan_backup, check_plan, write_plan
+from git_backup_notifier.archives import ArchiveStore, archive_files, restore_archive
+from git_backup_notifier.chunks import ChunkStore, restore_chunked_files
+from git_backup_notifier.discovery import discover_repositories
+from git_backup_notifier.bundles import get_bundle_path, bundle_unpushed_commits
+from git_backup_notifier.notifications import NotificationDispatcher
+from git_backup_notifier import metrics
+from git_backup_notifier.metrics import RunMetrics
 
 
-def backup_uncommitted_files(config, source_path=None, destination_path=None):
+def backup_repository(repo_path, backup_root_path, exclude_patterns, exclude_dirs, min_file_size, max_file_size,
+                      logger, test_mode=True, cursors=None, manifest=None, snapshot_store=None, fingerprints=None,
+                      unpushed_mode='files', bundle_all_branches=False, archive_store=None,
+                      archive_compression='gzip', chunk_store=None, copy_workers=1,
+                      copy_max_in_flight_bytes=64 * 1024 * 1024, prioritize=False, priority_patterns=(),
+                      deadline=None, deferred_state=None, extra_destinations=None):
     """
-    Backup uncommitted files from multiple git repositories based on the configuration file.
+    Backup the uncommitted and unpushed files of a single git repository.
+    If cursors is given, only commits after the HEAD of the last successful run are scanned for unpushed files
+    (mirror mode, snapshots and archives always contain the files of all unpushed commits).
+    If manifest is given, up-to-date checks use the backup manifest instead of the destination files.
+    If snapshot_store is given, the files are recorded as a snapshot in the store instead of being mirrored.
+    If fingerprints is given, a repository that did not change since its last backup without errors is skipped.
+    With unpushed_mode 'bundle' unpushed commits are written as a git bundle instead of copying the files they
+    touched (all local-only branches if bundle_all_branches is set).
+    If archive_store is given, the files are written into one compressed archive (gzip or zstd) per run.
+    If chunk_store is given, large files are stored as content defined chunks instead of being copied.
+    In mirror mode copy_workers files are copied in parallel, with at most copy_max_in_flight_bytes in progress.
+    With prioritize and a deadline the files are backed up in the order of prioritize_files (priority_patterns and
+    the files deferred by the last run first). Without a deadline every file is backed up anyway, so the files are
+    copied as they are enumerated instead of being collected and sorted first. If a deadline (time.monotonic()
+    value) passes, the repository or the rest of its files (mirror mode) are deferred to the next run and recorded
+    in deferred_state.
+    If extra_destinations (Destination backup roots with their own manifest) are given in mirror mode, every
+    file is read once and written to backup_root_path and all of them (see fan_out_files).
+    Returns the number of copied and skipped files.
+    """
+    repo_name = Path(repo_path).name
+    repo_backup_path = Path(backup_root_path) / repo_name
+    cursor_key = str(Path(repo_path).resolve())
+    matcher = compile_exclusions(exclude_dirs, exclude_patterns)
+    # Other settings can make other files candidates, so they are part of the fingerprint
+    settings_key = repr((sorted(exclude_patterns), sorted(exclude_dirs), min_file_size, max_file_size,
+                         manifest is not None, snapshot_store is not None, archive_store is not None,
+                         archive_compression, unpushed_mode, bundle_all_branches,
+                         chunk_store.threshold if chunk_store is not None else None,
+                         [str(destination.path) for destination in extra_destinations or []]))
+    errors = ErrorCountHandler()
+    previous = deferred_state.get(cursor_key) if deferred_state is not None else None
+    deferred_files = list(previous['files']) if previous else []
+
+    def defer(message):
+        logger.info(f"Deadline reached: {message}")
+        metrics.count('files_deferred', len(deferred_files))
+        if deferred_state is not None and not test_mode:
+            deferred_state.set(cursor_key, {'files': deferred_files, 'time': time.time()})
+        if fingerprints is not None:
+            fingerprints.remove(cursor_key)
+
+    try:
+        if deadline is not None and time.monotonic() >= deadline:
+            defer(f"deferred {repo_path} to the next run")
+            return 0, 0
+        if fingerprints is not None:
+            with metrics.stage('fingerprint'):
+                if fingerprints.is_unchanged(cursor_key, repo_path, settings_key):
+                    logger.debug(f"Skipped {repo_path} (unchanged since the last run)")
+                    return 0, 0
+        logger.addHandler(errors)
+        head = get_head_commit(repo_path)
+        # Snapshots and archives describe all files of a repository, they need the files of all unpushed commits
+        full_scan = snapshot_store is not None or archive_store is not None
+        last_head = cursors.get(cursor_key) if cursors is not None and not full_scan else None
+        unpushed = unpushed_mode != 'bundle'
+        if unpushed and head is not None and head == last_head:
+            logger.debug(f"Skipped unpushed files of {repo_path} (HEAD unchanged since last run)")
+            unpushed = False
+        # Files are enumerated lazily while they are copied, git output is read as it is written
+        all_files = iter_candidate_files(repo_path, matcher, last_head, unpushed)
+        if prioritize and deadline is not None:
+            with metrics.stage('prioritize'):
+                all_files = prioritize_files(all_files, repo_path, priority_patterns, deferred_files)
+        deferred_files = []
+        tracker = None
+        if fingerprints is not None and not test_mode:
+            tracker = all_files = fingerprints.track(repo_path, all_files)
+        with metrics.stage('copy'):
+            if archive_store is not None:
+                copied, skipped = archive_files(all_files, repo_path, archive_store, repo_name, exclude_patterns,
+                                                exclude_dirs, min_file_size, max_file_size, logger, test_mode,
+                                                archive_compression)
+            elif snapshot_store is not None:
+                copied, skipped = snapshot_files(all_files, repo_path, snapshot_store, repo_name, exclude_patterns,
+                                                 exclude_dirs, min_file_size, max_file_size, logger, test_mode)
+            elif extra_destinations:
+                destinations = [(repo_backup_path, manifest)] + [(Path(destination.path) / repo_name,
+                                                                  destination.manifest)
+                                                                 for destination in extra_destinations]
+                copied, skipped = fan_out_files(all_files, repo_path, destinations, exclude_patterns, exclude_dirs,
+                                                min_file_size, max_file_size, logger, test_mode, copy_workers,
+                                                copy_max_in_flight_bytes, deadline, deferred_files)
+            else:
+                copied, skipped = copy_files(all_files, repo_path, repo_backup_path, exclude_patterns,
+                                             exclude_dirs, min_file_size, max_file_size, logger, test_mode,
+                                             manifest, chunk_store, copy_workers, copy_max_in_flight_bytes,
+                                             deadline, deferred_files)
+        # Neither the cursor nor the fingerprint move on when something was deferred, the next run looks again
+        if deferred_files:
+            defer(f"deferred {len(deferred_files)} files of {repo_path} to the next run")
+            return copied, skipped
+        if unpushed_mode == 'bundle' and deadline is not None and time.monotonic() >= deadline:
+            defer(f"deferred the bundle of {repo_path} to the next run")
+            return copied, skipped
+        if deferred_state is not None and previous and not test_mode:
+            deferred_state.set(cursor_key, None)
+        if unpushed_mode == 'bundle':
+            with metrics.stage('bundle'):
+                bundle_file = get_bundle_path(backup_root_path, repo_name)
+                if bundle_unpushed_commits(repo_path, bundle_file, logger, test_mode, bundle_all_branches):
+                    copied += 1
+                    for destination in extra_destinations or []:
+                        if not test_mode:
+                            copy_bundle(bundle_file, get_bundle_path(destination.path, repo_name), logger)
+        # Files of unpushed commits that failed are clean in git status, only a scan of the same commits retries them
+        if cursors is not None and head is not None and not test_mode and not errors.count:
+            cursors.set(cursor_key, head)
+        if fingerprints is not None and errors.count:
+            # Files that failed are retried by the next run
+            fingerprints.remove(cursor_key)
+        elif tracker is not None:
+            fingerprints.update(cursor_key, tracker, settings_key)
+        return copied, skipped
+    except RuntimeError as e:
+        logger.error(e)
+        if fingerprints is not None:
+            fingerprints.remove(cursor_key)
+        return 0, 0
+    finally:
+        logger.removeHandler(errors)
+
+
+def copy_bundle(bundle_file, dst_file, logger):
+    """
+    Copy a bundle written to the first backup root to another destination.
+    """
+    try:
+        Path(dst_file).parent.mkdir(parents=True, exist_ok=True)
+        copy_file(bundle_file, dst_file)
+        logger.info(f"Copied {bundle_file} to {dst_file}")
+    except OSError as e:
+        logger.error(f"Failed to copy {bundle_file} to {dst_file}: {e}")
+
+
+def process_repositories(repo_paths, workers, logger, func):
+    """
+    Call func(repo_path, logger) for every repository, using a thread pool when more than one worker is configured.
+    Results are returned and log output is emitted in the order of repo_paths, regardless of completion order.
+    """
+    if workers <= 1 or len(repo_paths) <= 1:
+        return [func(repo_path, logger) for repo_path in repo_paths]
+
+    def run(repo_path):
+        repo_logger, buffer = create_buffered_logger(f"{logger.name}.{Path(repo_path).name}")
+        return func(repo_path, repo_logger), buffer.records
+
+    results = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for result, records in executor.map(run, repo_paths):
+            for record in records:
+                logger.handle(record)
+            results.append(result)
+    return results
+
+
+def get_settings(config, source_path=None, destination_path=None):
+    """
+    Collect the settings of a backup run from the configuration and the command line overrides.
     """
     backup_settings = config.get('BackupSettings', {})
-    backup_root_path = destination_path if destination_path else backup_settings.get('backup_root_path',
-                                                                                     '/default/backup/path')
-    min_file_size = backup_settings.get('min_file_size', 0)
-    max_file_size = backup_settings.get('max_file_size', 999_999_999)
-    delete_after_days = backup_settings.get('delete_after_days', 9999)
+    general_settings = config.get('GeneralSettings', {})
+    exclusions = config.get('Exclusions', {})
+    metrics_settings = config.get('Metrics', {})
+    logging_settings = config.get('Logging', {})
+    backup_root_paths = get_backup_root_paths(config, destination_path)
+    settings = {
+        # State, logs and reports are kept in the first destination
+        'backup_root_path': backup_root_paths[0],
+        'backup_root_paths': backup_root_paths,
+        'min_file_size': backup_settings.get('min_file_size', 0),
+        'max_file_size': backup_settings.get('max_file_size', 999_999_999),
+        'delete_after_days': backup_settings.get('delete_after_days', 9999),
+        'unpushed_cursor': backup_settings.get('unpushed_cursor', True),
+        'skip_unchanged': backup_settings.get('skip_unchanged', False),
+        'force_rescan_hours': backup_settings.get('force_rescan_hours', 24),
+        'archive_compression': backup_settings.get('archive_compression', 'gzip'),
+        'chunk_threshold': backup_settings.get('chunk_threshold', 0),
+        'unpushed_mode': backup_settings.get('unpushed_mode', 'files'),
+        'bundle_all_branches': backup_settings.get('bundle_all_branches', False),
+        'use_manifest': backup_settings.get('use_manifest', False),
+        'prioritize': backup_settings.get('prioritize', True),
+        'priority_patterns': backup_settings.get('priority_patterns', []),
+        'plan_free_space': backup_settings.get('plan_free_space', False),
+        'free_space_margin_bytes': int(backup_settings.get('free_space_margin_mb', 10)) * 1024 * 1024,
+        'storage_mode': backup_settings.get('storage_mode', 'mirror'),
+        'repo_paths': [source_path] if source_path else config.get('Repositories', {}).get('repo_paths', []),
+        'discover_roots': [] if source_path else [os.path.expanduser(root) for root in
+                                                  config.get('Repositories', {}).get('discover_roots', [])],
+        'discover_max_depth': config.get('Repositories', {}).get('discover_max_depth', 3),
+        'exclude_patterns': exclusions.get('exclude_patterns', []),
+        'exclude_dirs': exclusions.get('exclude_dirs', ['venv', '.git', '__pycache__']),
+        'test_mode': general_settings.get('test_mode', True),
+        'workers': max(1, int(general_settings.get('workers', 1))),
+        'copy_workers': max(1, int(general_settings.get('copy_workers', 4))),
+        'copy_max_in_flight_bytes': int(general_settings.get('copy_max_in_flight_mb', 64)) * 1024 * 1024,
+        'deadline_seconds': general_settings.get('deadline_seconds', 0),
+        'report_path': metrics_settings.get('report_path', ''),
+        'textfile_path': metrics_settings.get('textfile_path', ''),
+        'log_max_bytes': int(logging_settings.get('max_log_mb', 10)) * 1024 * 1024,
+        'log_backup_count': int(logging_settings.get('backup_count', 5)),
+        'log_file_events': logging_settings.get('file_events', 'text'),
+    }
+    if len(backup_root_paths) > 1 and (settings['storage_mode'] != 'mirror' or settings['chunk_threshold']):
+        raise ValueError("Several backup_root_path destinations are only supported with storage_mode \"mirror\" "
+                         "and without chunk_threshold")
+    return settings
+
+
+def get_backup_root_paths(config, destination_path=None):
+    """
+    Return the destinations of a backup: backup_root_path can be a single path or a list of paths.
+    A destination_path given on the command line replaces all of them.
+    """
+    if destination_path:
+        return [destination_path]
+    backup_root_path = config.get('BackupSettings', {}).get('backup_root_path', '/default/backup/path')
+    if isinstance(backup_root_path, (list, tuple)):
+        if not backup_root_path:
+            raise ValueError("backup_root_path must not be empty")
+        return list(backup_root_path)
+    return [backup_root_path]
 
-    repo_paths = [source_path] if source_path else config.get('Repositories', {}).get('repo_paths', [])
-    exclude_patterns = config.get('Exclusions', {}).get('exclude_patterns', [])
-    exclude_dirs = config.get('Exclusions', {}).get('exclude_dirs', ['venv', '.git', '__pycache__'])
-    test_mode = config.get('GeneralSettings', {}).get('test_mode', True)
+
+def setup_run_logger(settings):
+    """
+    Set up the logger in backuplog below the backup root with the [Logging] settings.
+    """
+    return setup_logger(Path(settings['backup_root_path']) / 'backuplog', settings['log_max_bytes'],
+                        settings['log_backup_count'], settings['log_file_events'])
+
+
+def resolve_repo_paths(settings, logger):
+    """
+    Return the configured repositories together with the repositories found below discover_roots.
+    """
+    repo_paths = list(settings['repo_paths'])
+    if not settings['discover_roots']:
+        return repo_paths
+    discovered = discover_repositories(settings['discover_roots'], settings['exclude_dirs'],
+                                       settings['discover_max_depth'],
+                                       get_state_dir(settings['backup_root_path']) / 'discovery_cache.json')
+    known = {os.path.abspath(repo_path) for repo_path in repo_paths}
+    repo_paths += [repo_path for repo_path in discovered if repo_path not in known]
+    logger.info(f"Discovered {len(discovered)} repositories below {', '.join(settings['discover_roots'])}")
+
+    names = {}
+    for repo_path in repo_paths:
+        names.setdefault(Path(repo_path).name, []).append(repo_path)
+    for name, paths in names.items():
+        if len(paths) > 1:
+            logger.warning(f"Repositories with the same name share the backup directory {name}: {', '.join(paths)}")
+    return repo_paths
+
+
+def open_state(settings):
+    """
+    Open the unpushed cursors, backup manifest and snapshot or archive store a run uses, None for the disabled ones.
+    """
+    backup_root_path = settings['backup_root_path']
+    cursors = None
+    if settings['unpushed_cursor']:
+        cursors = StateFile(get_state_dir(backup_root_path) / 'unpushed_cursors.json')
+    snapshot_store = None
+    archive_store = None
+    if settings['storage_mode'] == 'snapshot':
+        snapshot_store = SnapshotStore.for_backup_root(backup_root_path)
+    elif settings['storage_mode'] == 'archive':
+        archive_store = ArchiveStore.for_backup_root(backup_root_path)
+    manifest = None
+    if settings['use_manifest'] and settings['storage_mode'] == 'mirror':
+        manifest = BackupManifest.for_backup_root(backup_root_path)
+    return cursors, manifest, snapshot_store, archive_store
+
+
+def open_extra_destinations(settings):
+    """
+    Return the destinations after the first backup root as Destination tuples, each with its own manifest
+    if use_manifest is set. Empty for a single destination.
+    """
+    return [Destination(backup_root_path, BackupManifest.for_backup_root(backup_root_path)
+                        if settings['use_manifest'] else None)
+            for backup_root_path in settings['backup_root_paths'][1:]]
+
+
+def close_extra_destinations(extra_destinations):
+    for destination in extra_destinations:
+        if destination.manifest is not None:
+            destination.manifest.close()
+
+
+def open_chunk_store(settings):
+    """
+    Open the chunk store for large files if a chunk_threshold is configured (mirror mode only), otherwise None.
+    """
+    if not settings['chunk_threshold'] or settings['storage_mode'] != 'mirror':
+        return None
+    return ChunkStore.for_backup_root(settings['backup_root_path'], settings['chunk_threshold'])
+
+
+def open_deferred(settings):
+    """
+    Open the files and repositories a run deferred because its deadline passed.
+    """
+    return StateFile(get_state_dir(settings['backup_root_path']) / 'deferred.json')
+
+
+def open_fingerprints(settings):
+    """
+    Open the repository fingerprints if unchanged repositories are skipped, otherwise return None.
+    """
+    if not settings['skip_unchanged']:
+        return None
+    return RepoFingerprints(get_state_dir(settings['backup_root_path']) / 'repo_fingerprints.json',
+                            settings['force_rescan_hours'] * 60 * 60)
+
+
+def repository_backup_func(settings, cursors=None, manifest=None, snapshot_store=None, run_metrics=None,
+                           fingerprints=None, archive_store=None, deadline=None, deferred_state=None,
+                           extra_destinations=None):
+    """
+    Return a function(repo_path, logger) that backs up a single repository with the given settings.
+    If run_metrics is given, stage timings and counters of every repository are collected in it.
+    If a deadline (time.monotonic() value) is given, what is not backed up by then is recorded in deferred_state.
+    extra_destinations (see open_extra_destinations) are written together with the first backup root.
+    """
+    chunk_store = open_chunk_store(settings)
+
+    def backup(repo_path, logger):
+        return backup_repository(repo_path, settings['backup_root_path'], settings['exclude_patterns'],
+                                 settings['exclude_dirs'], settings['min_file_size'], settings['max_file_size'],
+                                 logger, settings['test_mode'], cursors, manifest, snapshot_store, fingerprints,
+                                 settings['unpushed_mode'], settings['bundle_all_branches'], archive_store,
+                                 settings['archive_compression'], chunk_store, settings['copy_workers'],
+                                 settings['copy_max_in_flight_bytes'], settings['prioritize'],
+                                 settings['priority_patterns'], deadline, deferred_state, extra_destinations)
+
+    if run_metrics is None:
+        return backup
+
+    def backup_with_metrics(repo_path, logger):
+        with run_metrics.collect(Path(repo_path).name):
+            return backup(repo_path, logger)
+    return backup_with_metrics
+
+
+def write_run_metrics(run_metrics, settings, logger=None):
+    """
+    Write the JSON run report (default backuplog/run_report.json) and, if configured, the Prometheus textfile.
+    A report that cannot be written is logged but does not fail the backup.
+    """
+    report_path = settings['report_path'] or Path(settings['backup_root_path']) / 'backuplog' / 'run_report.json'
+    try:
+        run_metrics.write_report(report_path)
+        if settings['textfile_path']:
+            run_metrics.write_textfile(settings['textfile_path'])
+    except OSError as e:
+        if logger is not None:
+            logger.error(f"Failed to write the run report: {e}")
+        else:
+            print(f"Error: Failed to write the run report: {e}")
+
+
+def backup_uncommitted_files(config, source_path=None, destination_path=None, deadline_seconds=None):
+    """
+    Backup uncommitted files from multiple git repositories based on the configuration file.
+    With a deadline (deadline_seconds or [GeneralSettings] deadline_seconds) the run stops starting new files
+    when it has run that long. Deferred repositories and files come first in the next run.
+    With several destinations in backup_root_path, every destination is checked for free space, kept up to
+    date and cleaned up by the retention on its own.
+    """
+    deadline_start = time.monotonic()
+    settings = get_settings(config, source_path, destination_path)
+    deadline_seconds = deadline_seconds or settings['deadline_seconds']
+    deadline = deadline_start + deadline_seconds if deadline_seconds else None
+    backup_root_path = settings['backup_root_path']
+    repo_paths = settings['repo_paths']
+    delete_after_days = settings['delete_after_days']
+    test_mode = settings['test_mode']
 
     deleted = 0
     skipped = 0
     copied = 0
+    logger = None
+    run_metrics = RunMetrics()
 
+    state_dir = get_state_dir(backup_root_path) if Path(backup_root_path).is_dir() else None
+    notifier = NotificationDispatcher(config, state_dir)
     try:
-        validate_paths([backup_root_path] + repo_paths)
-        check_free_space(backup_root_path, 10 * 1024 * 1024)  # Check if there is at least 10 MB of free space
+        validate_paths(settings['backup_root_paths'] + repo_paths + settings['discover_roots'])
+        for root_path in settings['backup_root_paths']:
+            check_free_space(root_path, settings['free_space_margin_bytes'])
 
-        log_dir = Path(backup_root_path) / 'backuplog'
-        logger = setup_logger(log_dir)
+        logger = setup_run_logger(settings)
+        with run_metrics.stage('discovery'):
+            repo_paths = resolve_repo_paths(settings, logger)
 
-        for repo_path in repo_paths:
-            repo_name = Path(repo_path).name
-            repo_backup_path = Path(backup_root_path) / repo_name
-            try:
-                uncommitted_files = get_uncommitted_files(repo_path)
-                unpushed_files = get_unpushed_files(repo_path)
-                all_files = set(uncommitted_files) | set(unpushed_files)
-                copied_here, skipped_here = copy_files(all_files, repo_path, repo_backup_path, exclude_patterns,
-                                                       exclude_dirs, min_file_size, max_file_size, logger, test_mode)
+        cursors, manifest, snapshot_store, archive_store = open_state(settings)
+        fingerprints = open_fingerprints(settings)
+        deferred_state = open_deferred(settings)
+        extra_destinations = open_extra_destinations(settings)
+        # Repositories with deferred files first
+        repo_paths = sorted(repo_paths, key=lambda repo_path: not deferred_state.get(str(Path(repo_path).resolve())))
+
+        try:
+            if settings['plan_free_space']:
+                with run_metrics.stage('plan'):
+                    plan = plan_backup(settings, repo_paths, logger, cursors, manifest, open_chunk_store(settings))
+                logger.info(f"Backup plan: {plan['totals']['files_to_copy']} files, "
+                            f"{plan['totals']['bytes_to_copy']} bytes to copy, {plan['bytes_required']} bytes "
+                            f"required, {plan['free_bytes']} bytes free")
+                check_plan(plan)
+                for destination in extra_destinations:
+                    # Every destination has its own files or manifest, so its own plan
+                    check_plan(plan_backup(dict(settings, backup_root_path=destination.path), repo_paths, logger,
+                                           cursors, destination.manifest))
+            results = process_repositories(repo_paths, settings['workers'], logger,
+                                           repository_backup_func(settings, cursors, manifest, snapshot_store,
+                                                                  run_metrics, fingerprints, archive_store,
+                                                                  deadline, deferred_state, extra_destinations))
+            for copied_here, skipped_here in results:
                 copied += copied_here
                 skipped += skipped_here
-            except RuntimeError as e:
-                logger.error(e)
+            if cursors is not None:
+                cursors.save()
+            if fingerprints is not None:
+                fingerprints.save()
+            deferred_state.save()
 
-        delete_old_files(backup_root_path, repo_paths, delete_after_days, logger, test_mode)
-        send_notification("Backup Completed", "The backup process has completed successfully.", config)
+            if deadline is not None and time.monotonic() >= deadline:
+                logger.info("Deadline reached: old files are deleted by the next run")
+            else:
+                with run_metrics.stage('retention'):
+                    if manifest is not None:
+                        deleted = delete_expired_files(manifest, backup_root_path, repo_paths, delete_after_days,
+                                                       logger, test_mode)
+                    elif archive_store is not None:
+                        deleted = archive_store.delete_expired([Path(repo_path).name for repo_path in repo_paths],
+                                                               delete_after_days, logger, test_mode)
+                    elif snapshot_store is not None:
+                        deleted = snapshot_store.prune([Path(repo_path).name for repo_path in repo_paths],
+                                                       delete_after_days, logger, test_mode)
+                    else:
+                        deleted = delete_old_files(backup_root_path, repo_paths, delete_after_days, logger, test_mode)
+                    for destination in extra_destinations:
+                        if destination.manifest is not None:
+                            deleted += delete_expired_files(destination.manifest, destination.path, repo_paths,
+                                                            delete_after_days, logger, test_mode)
+                        else:
+                            deleted += delete_old_files(destination.path, repo_paths, delete_after_days, logger,
+                                                        test_mode)
+                    chunk_store = open_chunk_store(settings)
+                    if chunk_store is not None:
+                        deleted += chunk_store.prune(repo_paths, delete_after_days, logger, test_mode)
+        finally:
+            if manifest is not None:
+                manifest.close()
+            close_extra_destinations(extra_destinations)
+        notifier.notify("Backup Completed", "The backup process has completed successfully.")
     except (FileNotFoundError, NotADirectoryError, OSError) as e:
         print(f"Error: {e}")
-        send_notification("Backup Failed", f"The backup process failed: {e}", config)
+        run_metrics.finish(False, copied=copied, skipped=skipped, deleted=deleted)
+        if Path(backup_root_path).is_dir():
+            write_run_metrics(run_metrics, settings, logger)
+        notifier.notify("Backup Failed", f"The backup process failed: {e}", urgent=True)
+        notifier.close()
         sys.exit(1)
 
+    run_metrics.finish(True, copied=copied, skipped=skipped, deleted=deleted)
+    write_run_metrics(run_metrics, settings, logger)
     logger.info(f"Backup completed: {copied} files copied, {skipped} files skipped, {deleted} files deleted.")
     print(f"Backup completed: {copied} files copied, {skipped} files skipped, {deleted} files deleted.")
+    notifier.close()
+
+
+def plan_backup_run(config, plan_path, source_path=None, destination_path=None):
+    """
+    Build the transfer plan of a backup run without copying or deleting anything and write it as JSON to
+    plan_path ('-' for stdout). Returns the plan.
+    """
+    settings = get_settings(config, source_path, destination_path)
+    validate_paths([settings['backup_root_path']] + settings['repo_paths'] + settings['discover_roots'])
+    logger = setup_run_logger(settings)
+    repo_paths = resolve_repo_paths(settings, logger)
+    cursors, manifest, _, _ = open_state(settings)
+    try:
+        plan = plan_backup(settings, repo_paths, logger, cursors, manifest, open_chunk_store(settings))
+    finally:
+        if manifest is not None:
+            manifest.close()
+    write_plan(plan, plan_path)
+    return plan
+
+
+def check_backup_manifest(config, destination_path=None, rebuild=False):
+    """
+    Verify the backup manifest against the files in the backup root or rebuild it from them.
+    With several destinations the first one is checked, another one can be given as destination_path.
+    Returns the number of problems found (verify) or files recorded (rebuild).
+    """
+    settings = get_settings(config, destination_path=destination_path)
+    backup_root_path = settings['backup_root_path']
+    validate_paths([backup_root_path])
+    logger = setup_logger(Path(backup_root_path) / 'backuplog')
+
+    manifest = BackupManifest.for_backup_root(backup_root_path)
+    try:
+        if rebuild:
+            # The manifest is cleared, so the discovered repositories have to be recorded again as well
+            repo_paths = resolve_repo_paths(settings, logger)
+            return rebuild_manifest(manifest, backup_root_path, [Path(repo_path).name for repo_path in repo_paths],
+                                    logger)
+        return len(verify_manifest(manifest, backup_root_path, logger, check_hash=True))
+    finally:
+        manifest.close()
+
+
+def restore_repository(config, repo_name, target_path, snapshot_id=None, destination_path=None, files=None):
+    """
+    Restore the files of a repository from a snapshot or, with storage_mode "archive", from an archive
+    (latest if no id is given) into target_path. If files are given, only these are extracted from the archive.
+    With storage_mode "mirror" and a chunk_threshold, the latest versions of the chunked large files are restored.
+    Returns the number of restored files.
+    """
+    backup_settings = config.get('BackupSettings', {})
+    backup_root_path = get_backup_root_paths(config, destination_path)[0]
+    validate_paths([backup_root_path, target_path])
+    logger = setup_logger(Path(backup_root_path) / 'backuplog')
+    storage_mode = backup_settings.get('storage_mode', 'mirror')
+    if storage_mode == 'archive':
+        restored = restore_archive(ArchiveStore.for_backup_root(backup_root_path), repo_name, target_path, logger,
+                                   snapshot_id, files)
+    elif storage_mode == 'mirror' and backup_settings.get('chunk_threshold', 0):
+        restored = restore_chunked_files(ChunkStore.for_backup_root(backup_root_path, 0), repo_name, target_path,
+                                         logger, files)
+    else:
+        restored = restore_snapshot(SnapshotStore.for_backup_root(backup_root_path), repo_name, target_path, logger,
+                                    snapshot_id)
+    logger.info(f"Restore completed: {restored} files restored to {target_path}.")
+    return restored
 
 
 def main():
@@ -64,13 +576,55 @@ def main():
     parser.add_argument('config_path', type=str, nargs='?', default=None, help='Path to the user configuration file.')
     parser.add_argument('--source', type=str, help='Override source path.')
     parser.add_argument('--destination', type=str, help='Override destination path.')
+    parser.add_argument('--verify-manifest', action='store_true',
+                        help='Check the backup manifest against the files in the backup and exit.')
+    parser.add_argument('--rebuild-manifest', action='store_true',
+                        help='Rebuild the backup manifest from the files in the backup and exit.')
+    parser.add_argument('--restore', type=str, metavar='REPO_NAME',
+                        help='Restore the files of a repository from a snapshot into --target and exit.')
+    parser.add_argument('--snapshot', type=str,
+                        help='Snapshot or archive id to restore. Default is the latest snapshot or archive.')
+    parser.add_argument('--file', type=str, action='append', dest='files',
+                        help='Restore only this file from an archive or the chunk store (can be given more than once).')
+    parser.add_argument('--target', type=str, help='Directory to restore into.')
+    parser.add_argument('--plan', type=str, metavar='PATH',
+                        help="Write the files, bytes to copy and hash and files to delete of a backup run as JSON "
+                             "to PATH ('-' for stdout) and exit without copying.")
+    parser.add_argument('--deadline', type=float, metavar='SECONDS',
+                        help='Stop starting new files after this many seconds and back up the rest in the next run.')
+    parser.add_argument('--watch', action='store_true',
+                        help='Keep running and backup changed files as they change (see [WatchSettings]).')
 
     args = parser.parse_args()
 
     config = load_config('config/default.toml', args.config_path)
 
     try:
-        backup_uncommitted_files(config, source_path=args.source, destination_path=args.destination)
+        if args.restore:
+            if not args.target:
+                parser.error('--restore requires --target')
+            restore_repository(config, args.restore, args.target, snapshot_id=args.snapshot,
+                               destination_path=args.destination, files=args.files)
+            return
+        if args.watch:
+            from git_backup_notifier.watch import watch_repositories
+            try:
+                watch_repositories(config, source_path=args.source, destination_path=args.destination)
+            except KeyboardInterrupt:
+                pass
+            return
+        if args.plan:
+            plan = plan_backup_run(config, args.plan, source_path=args.source, destination_path=args.destination)
+            if not plan['fits']:
+                sys.exit(3)
+            return
+        if args.verify_manifest or args.rebuild_manifest:
+            result = check_backup_manifest(config, destination_path=args.destination, rebuild=args.rebuild_manifest)
+            if args.verify_manifest and not args.rebuild_manifest and result:
+                sys.exit(2)
+            return
+        backup_uncommitted_files(config, source_path=args.source, destination_path=args.destination,
+                                 deadline_seconds=args.deadline)
     except Exception as e:
         print(f"Error: {e}")
         sys.exit(1)
@@ -0,0 +1,99 @@
+import os
+from pathlib import Path
+from git_backup_notifier import metrics
+from git_backup_notifier.utils import run_git, get_head_commit, get_unpushed_range
+
+BUNDLE_SIGNATURES = (b'# v2 git bundle\n', b'# v3 git bundle\n')
+
+
+def get_bundle_path(backup_root_path, repo_name):
+    return Path(backup_root_path) / '.bundles' / f'{repo_name}.bundle'
+
+
+def read_bundle_heads(bundle_file):
+    """
+    Read the refs of a bundle from its header as a sorted list of (commit, refname),
+    or None if there is no readable bundle.
+    """
+    heads = []
+    try:
+        with open(bundle_file, 'rb') as f:
+            if f.readline() not in BUNDLE_SIGNATURES:
+                return None
+            for line in f:
+                line = line.rstrip(b'\n')
+                if not line:
+                    break
+                if line.startswith((b'-', b'@')):  # Prerequisites and v3 capabilities
+                    continue
+                commit, _, refname = line.decode(errors='surrogateescape').partition(' ')
+                heads.append((commit, refname))
+    except OSError:
+        return None
+    return sorted(heads)
+
+
+def get_bundle_revisions(repo_path, all_branches=False):
+    """
+    Get the git bundle revision arguments for the unpushed commits: the current branch against its upstream
+    (or all remote branches), or all local branches against all remote branches.
+    """
+    if all_branches:
+        return ['--branches', '--not', '--remotes']
+    revisions = get_unpushed_range(repo_path)
+    result = run_git(['symbolic-ref', '--quiet', 'HEAD'], repo_path, text=True)
+    if result.returncode == 0:
+        # Bundle the branch by name, so the restored commits end up on a branch and not on a detached HEAD
+        revisions[0] = result.stdout.strip()
+    return revisions
+
+
+def get_bundle_tips(repo_path, revisions):
+    """
+    Return the sorted (commit, refname) list git bundle would record for revisions: the positive refs whose tip
+    is an unpushed commit. Refs without unpushed commits are left out of a bundle by git.
+    """
+    result = run_git(['rev-list'] + revisions, repo_path, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Failed to list unpushed commits in {repo_path}: {result.stderr.strip()}")
+    unpushed = set(result.stdout.split())
+    if not unpushed:
+        return []
+    positive = revisions[:revisions.index('--not')]
+    if positive == ['--branches']:
+        result = run_git(['for-each-ref', '--format=%(objectname) %(refname)', 'refs/heads'], repo_path, text=True)
+        refs = [line.partition(' ')[::2] for line in result.stdout.splitlines()]
+    else:
+        refs = [(get_head_commit(repo_path), positive[0])]
+    return sorted((commit, refname) for commit, refname in refs if commit in unpushed)
+
+
+def bundle_unpushed_commits(repo_path, bundle_file, logger, test_mode=True, all_branches=False):
+    """
+    Write the unpushed commits of a repository as an incremental git bundle (one sequential write).
+    The bundle is only written again if the tips of the bundled refs changed.
+    Returns True if a bundle was written, False if it was up to date or there is nothing unpushed.
+    """
+    if get_head_commit(repo_path) is None:
+        return False
+    revisions = get_bundle_revisions(repo_path, all_branches)
+    tips = get_bundle_tips(repo_path, revisions)
+    if not tips:
+        logger.debug(f"No unpushed commits in {repo_path}")
+        return False
+    if read_bundle_heads(bundle_file) == tips:
+        logger.debug(f"Skipped {bundle_file} (unpushed commits unchanged)")
+        return False
+
+    logger.info(f"Bundling unpushed commits of {repo_path} to {bundle_file} "
+                f"({', '.join(refname for _, refname in tips)}). Test mode: {test_mode}")
+    if test_mode:
+        return True
+    Path(bundle_file).parent.mkdir(parents=True, exist_ok=True)
+    # git bundle writes to a lock file and renames it, an existing bundle is replaced atomically
+    result = run_git(['bundle', 'create', '--quiet', os.fspath(Path(bundle_file).resolve())] + revisions,
+                     repo_path, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Failed to bundle unpushed commits of {repo_path}: {result.stderr.strip()}")
+    metrics.count('bytes_copied', os.stat(bundle_file).st_size)
+    return True
@@ -0,0 +1,302 @@
+import os
+import json
+import time
+import zlib
+import hashlib
+import tempfile
+from datetime import datetime
+from pathlib import Path
+from git_backup_notifier import metrics
+
+MIN_CHUNK_SIZE = 16 * 1024
+AVERAGE_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 256 * 1024
+# Bytes before a boundary candidate that decide whether it is a boundary
+WINDOW_SIZE = 48
+SAMPLE_SIZE = 1024 * 1024
+READ_SIZE = 4 * 1024 * 1024
+
+
+def chunk_hash(data):
+    return hashlib.blake2b(data, digest_size=20).hexdigest()
+
+
+def choose_anchor(sample):
+    """
+    Choose the boundary parameters of a file from a sample of its content: the anchor byte whose frequency is
+    closest to 1/256 and the number of window hash bits that must be zero for an average chunk size of
+    AVERAGE_CHUNK_SIZE. They are kept with the file, so later versions are cut the same way.
+    """
+    if not sample:
+        return 0, 0
+    target = len(sample) / 256
+    anchor = min(range(256), key=lambda byte: abs(sample.count(bytes([byte])) - target))
+    density = max(sample.count(bytes([anchor])), 1) / len(sample)
+    mask_bits = max(0, round((AVERAGE_CHUNK_SIZE - MIN_CHUNK_SIZE) * density).bit_length() - 1)
+    return anchor, mask_bits
+
+
+def find_chunk_end(data, start, anchor, mask_bits):
+    """
+    Return the end of the content defined chunk that starts at start. data must hold MAX_CHUNK_SIZE bytes
+    after start, unless the file ends before.
+    A chunk ends after an anchor byte where the crc32 of the WINDOW_SIZE bytes up to it has mask_bits zero bits.
+    The anchor bytes are found with a C level search, so only a small fraction of the positions is hashed.
+    An insertion or deletion only moves the boundaries around it, the other chunks stay the same.
+    """
+    mask = (1 << mask_bits) - 1
+    anchor = bytes([anchor])
+    limit = min(len(data), start + MAX_CHUNK_SIZE)
+    position = data.find(anchor, start + MIN_CHUNK_SIZE - 1, limit)
+    while position != -1:
+        if not zlib.crc32(data[max(0, position - WINDOW_SIZE + 1):position + 1]) & mask:
+            return position + 1
+        position = data.find(anchor, position + 1, limit)
+    return limit
+
+
+def iter_chunks(src, anchor, mask_bits):
+    """
+    Read a file and yield its content defined chunks as memoryviews.
+    The file is read in blocks instead of being mapped, a file truncated while it is read must not crash the run.
+    """
+    data = b''
+    start = 0
+    eof = False
+    while True:
+        if len(data) - start < MAX_CHUNK_SIZE and not eof:
+            block = src.read(READ_SIZE)
+            eof = not block
+            data = data[start:] + block
+            start = 0
+            continue
+        if start >= len(data):
+            return
+        end = find_chunk_end(data, start, anchor, mask_bits)
+        yield memoryview(data)[start:end]
+        start = end
+
+
+class ChunkStore:
+    """
+    Content defined chunk store below the backup root for files of at least threshold bytes.
+    Chunks are kept once per hash in objects/, every stored version of a file is a JSON chunk list in
+    versions/<repo>/<path>/. A small change of a large file only writes the chunks around the change.
+    """
+
+    def __init__(self, root_path, threshold):
+        self.root_path = Path(root_path)
+        self.threshold = threshold
+        self.objects_path = self.root_path / 'objects'
+        self.versions_path = self.root_path / 'versions'
+        # Exists while chunks of removed files may be left that no version refers to
+        self.garbage_marker_path = self.root_path / '.garbage'
+
+    @classmethod
+    def for_backup_root(cls, backup_root_path, threshold):
+        return cls(Path(backup_root_path) / '.chunks', threshold)
+
+    def chunk_path(self, hash_value):
+        return self.objects_path / hash_value[:2] / hash_value[2:]
+
+    def file_versions_path(self, repo_name, file):
+        return self.versions_path / repo_name / file
+
+    def list_versions(self, repo_name, file):
+        """
+        Return the version ids of a file, oldest first.
+        """
+        path = self.file_versions_path(repo_name, file)
+        if not path.is_dir():
+            return []
+        return sorted(version.stem for version in path.glob('*.json'))
+
+    def load_version(self, repo_name, file, version_id=None):
+        """
+        Return a version of a file (latest if no id is given) or None if there is none.
+        """
+        if version_id is None:
+            versions = self.list_versions(repo_name, file)
+            if not versions:
+                return None
+            version_id = versions[-1]
+        with open(self.file_versions_path(repo_name, file) / f'{version_id}.json') as f:
+            return json.load(f)
+
+    def list_files(self, repo_name):
+        """
+        Return the relative paths of the files of a repository that have versions in the store.
+        """
+        repo_versions_path = self.versions_path / repo_name
+        return sorted({str(path.parent.relative_to(repo_versions_path)).replace(os.sep, '/')
+                       for path in repo_versions_path.rglob('*.json')})
+
+    def _write_chunk(self, hash_value, data):
+        chunk_path = self.chunk_path(hash_value)
+        if chunk_path.exists():
+            return False
+        chunk_path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(prefix='.chunk.', suffix='.tmp', dir=chunk_path.parent)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_name, chunk_path)
+        except BaseException:
+            try:
+                os.unlink(tmp_name)
+            except OSError:
+                pass
+            raise
+        return True
+
+    def is_current(self, repo_name, file, src_stat):
+        latest = self.load_version(repo_name, file)
+        return latest is not None and latest['size'] == src_stat.st_size and latest['mtime_ns'] == src_stat.st_mtime_ns
+
+    def store_file(self, repo_name, file, src_file, src_stat):
+        """
+        Split a file into chunks, write the chunks that are not in the store yet and record the chunk list as a
+        new version. Returns the number of bytes written to the store.
+        """
+        versions = self.list_versions(repo_name, file)
+        latest = self.load_version(repo_name, file, versions[-1]) if versions else None
+        with open(src_file, 'rb') as src:
+            if latest is not None:
+                anchor, mask_bits = latest['anchor'], latest['mask_bits']
+            else:
+                anchor, mask_bits = choose_anchor(src.read(SAMPLE_SIZE))
+                src.seek(0)
+            chunks = []
+            size = 0
+            written = 0
+            with metrics.timer('hash_seconds'):
+                for chunk in iter_chunks(src, anchor, mask_bits):
+                    hash_value = chunk_hash(chunk)
+                    chunks.append([hash_value, len(chunk)])
+                    if self._write_chunk(hash_value, chunk):
+                        written += len(chunk)
+                    size += len(chunk)
+            metrics.count('bytes_hashed', size)
+
+        version = {'size': size, 'mtime_ns': src_stat.st_mtime_ns, 'mode': src_stat.st_mode & 0o7777,
+                   'anchor': anchor, 'mask_bits': mask_bits, 'chunks': chunks,
+                   'hash': chunk_hash(''.join(hash_value for hash_value, _ in chunks).encode())}
+        if latest is not None and latest['hash'] == version['hash']:
+            # Same content (e.g. only touched): update the latest version instead of adding one
+            self._save_version(repo_name, file, version, versions[-1])
+        else:
+            self._save_version(repo_name, file, version)
+        metrics.count('bytes_copied', written)
+        return written
+
+    def _save_version(self, repo_name, file, version, version_id=None):
+        path = self.file_versions_path(repo_name, file)
+        path.mkdir(parents=True, exist_ok=True)
+        version_id = version_id or datetime.now().strftime('%Y%m%dT%H%M%S%f')
+        tmp_path = path / f'.{version_id}.tmp'
+        tmp_path.write_text(json.dumps(version, sort_keys=True))
+        os.replace(tmp_path, path / f'{version_id}.json')
+
+    def remove_file(self, repo_name, file):
+        """
+        Delete all versions of a file, e.g. when it is mirrored again after it dropped below the threshold.
+        Their chunks are deleted by the next prune. Returns the number of deleted versions.
+        """
+        versions = self.list_versions(repo_name, file)
+        if not versions:
+            return 0
+        self.garbage_marker_path.touch()
+        path = self.file_versions_path(repo_name, file)
+        for version_id in versions:
+            (path / f'{version_id}.json').unlink()
+        try:
+            path.rmdir()
+        except OSError:
+            pass
+        return len(versions)
+
+    def restore_file(self, repo_name, file, target_file, version_id=None):
+        """
+        Reassemble a version of a file (latest if no id is given) from its chunks.
+        """
+        version = self.load_version(repo_name, file, version_id)
+        if version is None:
+            raise FileNotFoundError(f"{file} is not in the chunk store of {repo_name}")
+        target_file = Path(target_file)
+        target_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(target_file, 'wb') as dst:
+            for hash_value, _ in version['chunks']:
+                with open(self.chunk_path(hash_value), 'rb') as chunk:
+                    dst.write(chunk.read())
+        os.chmod(target_file, version['mode'])
+        os.utime(target_file, ns=(version['mtime_ns'], version['mtime_ns']))
+
+    def prune(self, repo_paths, delete_after_days, logger, test_mode=True):
+        """
+        Delete versions recorded more than delete_after_days ago and then the chunks no version refers to.
+        The latest version of a file is kept as long as the file exists in the source repository and is
+        still stored as chunks. Returns the number of deleted versions.
+        """
+        cutoff = time.time() - delete_after_days * 24 * 60 * 60
+        deleted = 0
+        for repo_path in repo_paths:
+            repo_name = Path(repo_path).name
+            for file in self.list_files(repo_name):
+                versions = self.list_versions(repo_name, file)
+                if self._is_chunked_source(Path(repo_path) / file):
+                    versions = versions[:-1]
+                for version_id in versions:
+                    version_path = self.file_versions_path(repo_name, file) / f'{version_id}.json'
+                    try:
+                        if version_path.stat().st_mtime >= cutoff:
+                            continue
+                        if not test_mode:
+                            version_path.unlink()
+                        logger.info(f"Deleted version {version_id} of {repo_name}/{file} "
+                                    f"(older than {delete_after_days} days). Test mode: {test_mode}")
+                        deleted += 1
+                    except OSError as e:
+                        logger.error(f"Failed to delete {version_path}: {e}")
+        if (deleted or self.garbage_marker_path.exists()) and not test_mode:
+            self._collect_garbage(logger)
+        return deleted
+
+    def _is_chunked_source(self, src_file):
+        try:
+            return src_file.stat().st_size >= self.threshold
+        except (FileNotFoundError, NotADirectoryError):
+            return False
+
+    def _collect_garbage(self, logger):
+        referenced = set()
+        for version_path in self.versions_path.rglob('*.json'):
+            with open(version_path) as f:
+                referenced.update(hash_value for hash_value, _ in json.load(f)['chunks'])
+        for chunk_path in self.objects_path.glob('*/*'):
+            hash_value = chunk_path.parent.name + chunk_path.name
+            if hash_value not in referenced and not chunk_path.name.startswith('.'):
+                try:
+                    chunk_path.unlink()
+                except OSError as e:
+                    logger.error(f"Failed to delete chunk {chunk_path}: {e}")
+        try:
+            self.garbage_marker_path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def restore_chunked_files(store, repo_name, target_path, logger, files=None):
+    """
+    Restore the latest versions of the chunked files of a repository (or only the given files) below target_path.
+    Returns the number of restored files.
+    """
+    restored = 0
+    for file in files or store.list_files(repo_name):
+        target_file = Path(target_path) / file
+        try:
+            store.restore_file(repo_name, file, target_file)
+            restored += 1
+            logger.info(f"Restored {target_file}")
+        except OSError as e:
+            logger.error(f"Failed to restore {target_file}: {e}")
+    return restored
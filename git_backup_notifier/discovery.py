@@ -0,0 +1,70 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from git_backup_notifier.utils import compile_exclusions, StateFile
+
+DISCOVERY_WORKERS = 8
+# Directories changed this recently are scanned again next time, their mtime might not show a later change yet
+MTIME_GRACE_SECONDS = 2
+
+
+def discover_repositories(roots, exclude_dirs, max_depth, cache_path=None, workers=DISCOVERY_WORKERS):
+    """
+    Find git repositories below roots, at most max_depth directory levels deep. A directory that contains
+    a .git is a repository and is not descended into, excluded directories and symlinks are skipped.
+    The directories of one level are scanned in parallel. If cache_path is given, the entries and mtime of every
+    directory are kept there and a directory whose mtime did not change is not scanned again.
+    Returns the sorted repository paths.
+    """
+    matcher = compile_exclusions(exclude_dirs, [])
+    cache_key = repr((sorted(exclude_dirs), max_depth))
+    cache = StateFile(cache_path) if cache_path else None
+    cached = cache.get('directories', {}) if cache is not None and cache.get('key') == cache_key else {}
+    started = time.time()
+
+    def scan(path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return path, None
+        entry = cached.get(path)
+        if entry and entry['mtime'] == stat.st_mtime_ns:
+            return path, entry
+        is_repo = False
+        directories = []
+        try:
+            with os.scandir(path) as entries:
+                for dir_entry in entries:
+                    if dir_entry.name == '.git':
+                        is_repo = True  # A directory, or a file for worktrees and submodules
+                    elif dir_entry.is_dir(follow_symlinks=False) and not matcher.excludes_dir(dir_entry.name):
+                        directories.append(dir_entry.name)
+        except OSError:
+            return path, None
+        recent = stat.st_mtime > started - MTIME_GRACE_SECONDS
+        return path, {'mtime': None if recent else stat.st_mtime_ns, 'repo': is_repo,
+                      'dirs': [] if is_repo else sorted(directories)}
+
+    repositories = []
+    scanned = {}
+    level = [os.path.abspath(os.path.expanduser(root)) for root in roots]
+    depth = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while level:
+            next_level = []
+            for path, entry in executor.map(scan, level):
+                if entry is None:
+                    continue
+                scanned[path] = entry
+                if entry['repo']:
+                    repositories.append(path)
+                elif depth < max_depth:
+                    next_level.extend(os.path.join(path, name) for name in entry['dirs'])
+            level = next_level
+            depth += 1
+
+    if cache is not None:
+        cache.set('key', cache_key)
+        cache.set('directories', scanned)
+        cache.save()
+    return sorted(set(repositories))
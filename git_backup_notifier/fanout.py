@@ -0,0 +1,192 @@
+import os
+import queue
+import shutil
+import hashlib
+import logging
+import tempfile
+from collections import namedtuple
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from git_backup_notifier import metrics
+from git_backup_notifier.utils import COPY_BUFFER_SIZE, FILES_IN_FLIGHT_PER_WORKER, ByteBudget, check_copy, \
+    compile_exclusions, file_event, log_file_events, process_files_in_order
+
+# A backup root that is written in addition to backup_root_path, with its own manifest (None without use_manifest)
+Destination = namedtuple('Destination', ['path', 'manifest'])
+
+
+def _read_source(src_file, targets, compute_hash=False):
+    """
+    Read src_file once and put every block into the queue of each (queue, budget) target, after the block was
+    acquired from the budget of that target. The queues end with ('end', sha256 or None) or, if the source
+    could not be read, ('abort', error).
+    """
+    hash_func = hashlib.sha256() if compute_hash else None
+    total = 0
+    try:
+        with open(src_file, 'rb') as src:
+            for block in iter(lambda: src.read(COPY_BUFFER_SIZE), b''):
+                total += len(block)
+                if hash_func is not None:
+                    hash_func.update(block)
+                for blocks, budget in targets:
+                    budget.acquire(len(block))
+                    blocks.put(('data', block))
+    except BaseException as e:
+        # The writers wait for the end of their queue
+        for blocks, _ in targets:
+            blocks.put(('abort', e))
+        if not isinstance(e, OSError):
+            raise
+        return
+    finally:
+        metrics.count('bytes_read', total)
+    if hash_func is not None:
+        metrics.count('bytes_hashed', total)
+    for blocks, _ in targets:
+        blocks.put(('end', hash_func.hexdigest() if hash_func is not None else None))
+
+
+def _write_destination(blocks, budget, file, src_file, src_stat, dst_file, repo_name, manifest, src_hash, message,
+                       created_dirs):
+    """
+    Write the blocks _read_source puts into blocks to a temporary file next to dst_file, which is renamed when
+    the whole source was read. Blocks are released from the budget as they are written, also after a write
+    failed, so the reader never waits for a destination that gave up. Returns the outcome and log records
+    like _copy_file_entry.
+    """
+    error = None
+    dst = None
+    tmp_name = None
+    with metrics.timer('copy_seconds'):
+        try:
+            if dst_file.parent not in created_dirs:
+                dst_file.parent.mkdir(parents=True, exist_ok=True)
+                created_dirs.add(dst_file.parent)
+            fd, tmp_name = tempfile.mkstemp(prefix=f'.{dst_file.name}.', suffix='.tmp', dir=dst_file.parent)
+            dst = os.fdopen(fd, 'wb')
+        except OSError as e:
+            error = e
+        while True:
+            kind, value = blocks.get()
+            if kind != 'data':
+                break
+            if error is None:
+                try:
+                    dst.write(value)
+                    metrics.count('bytes_copied', len(value))
+                except OSError as e:
+                    error = e
+            budget.release(len(value))
+        try:
+            if dst is not None:
+                dst.close()
+            if error is None and kind == 'abort':
+                error = value
+            if error is None:
+                shutil.copystat(src_file, tmp_name)
+                os.replace(tmp_name, dst_file)
+                tmp_name = None
+                if manifest is not None:
+                    manifest.record(repo_name, file, src_stat.st_size, src_stat.st_mtime_ns, src_hash or value)
+        except OSError as e:
+            error = e
+        finally:
+            if tmp_name is not None:
+                try:
+                    os.unlink(tmp_name)
+                except OSError:
+                    pass
+    if error is not None:
+        return 'skipped', [(logging.ERROR, ("Failed to copy %s to %s: %s", src_file, dst_file, error), 'failed')]
+    return 'copied', [(logging.INFO, message, 'copied')]
+
+
+def fan_out_files(file_list, src_base_path, destinations, exclude_patterns, exclude_dirs, min_size, max_size, logger,
+                  test_mode=True, workers=1, max_in_flight_bytes=64 * 1024 * 1024, deadline=None, deferred=None):
+    """
+    Copy files like copy_files, but to several destinations, given as (dst_base_path, manifest or None) pairs.
+    Every destination decides on its own whether a file is up to date, from its manifest or its files.
+    A file that has to be copied to any destination is read once and written to all of them concurrently,
+    by workers threads per destination. At most max_in_flight_bytes of read blocks wait for a destination,
+    so a slow destination only holds up the others when its buffer is full.
+    A file counts as copied if it was copied to at least one destination. A summary of the file events is
+    logged per destination at the end. deadline and deferred work like in copy_files.
+    """
+    matcher = compile_exclusions(exclude_dirs, exclude_patterns)
+    repo_name = Path(destinations[0][0]).name
+    totals = {'copied': 0, 'skipped': 0}
+    events = [{} for _ in destinations]
+    up_to_date = [[] for _ in destinations]
+    created_dirs = [set() for _ in destinations]
+    budgets = [ByteBudget(max_in_flight_bytes) for _ in destinations]
+    repo_metrics = metrics.current()
+
+    def finish(file, records, results):
+        # Records of the filters apply to all destinations
+        for level, message, event in records:
+            logger.log(level, *message, extra=file_event(repo_name, file, event))
+            for destination_events in events:
+                destination_events[event] = destination_events.get(event, 0) + 1
+        copied = False
+        for index, (outcome, destination_records) in enumerate(results):
+            for level, message, event in destination_records:
+                logger.log(level, *message, extra=file_event(repo_name, file, event))
+                events[index][event] = events[index].get(event, 0) + 1
+            if outcome == 'up_to_date':
+                up_to_date[index].append(file)
+            copied = copied or outcome == 'copied'
+        totals['copied' if copied else 'skipped'] += 1
+
+    def write_entry(*args):
+        with metrics.bind(repo_metrics):
+            return _write_destination(*args)
+
+    def process(file, src_file, src_stat):
+        results = []
+        writes = []
+        src_hash = None
+        for index, (dst_base_path, manifest) in enumerate(destinations):
+            dst_file = Path(dst_base_path) / file
+            try:
+                needs_copy, message, src_hash, result = check_copy(file, src_file, src_stat, dst_file, repo_name,
+                                                                   test_mode, manifest, src_hash)
+            except OSError as e:
+                result = ('skipped', [(logging.ERROR, ("Failed to copy %s to %s: %s", src_file, dst_file, e),
+                                       'failed')])
+            else:
+                if needs_copy and test_mode:
+                    result = ('copied', [(logging.INFO, message, 'copied')])
+                elif needs_copy:
+                    writes.append((index, dst_file, message))
+            results.append(result)
+
+        targets = []
+        for index, dst_file, message in writes:
+            blocks = queue.SimpleQueue()
+            results[index] = executors[index].submit(write_entry, blocks, budgets[index], file, src_file, src_stat,
+                                                     dst_file, repo_name, destinations[index][1], src_hash, message,
+                                                     created_dirs[index])
+            targets.append((blocks, budgets[index]))
+        if targets:
+            # Hash while reading if a manifest needs a hash that was not computed yet
+            compute_hash = src_hash is None and any(destinations[index][1] is not None for index, _, _ in writes)
+            _read_source(src_file, targets, compute_hash)
+        return results
+
+    executors = [ThreadPoolExecutor(max_workers=max(1, workers)) for _ in destinations]
+    try:
+        process_files_in_order(file_list, src_base_path, matcher, min_size, max_size, process, finish, deadline,
+                               deferred, FILES_IN_FLIGHT_PER_WORKER * max(1, workers))
+    finally:
+        for executor in executors:
+            executor.shutdown(wait=True)
+
+    copied, skipped = totals['copied'], totals['skipped']
+    for index, (dst_base_path, manifest) in enumerate(destinations):
+        if manifest is not None and not test_mode:
+            manifest.mark_seen(repo_name, up_to_date[index])
+        log_file_events(logger, src_base_path, events[index], dst_base_path)
+    metrics.count('files_copied', copied)
+    metrics.count('files_skipped', skipped)
+    return copied, skipped
@@ -0,0 +1,181 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from pathlib import Path
+from git_backup_notifier.utils import compute_file_hash, get_state_dir
+
+ManifestEntry = namedtuple('ManifestEntry', ['size', 'mtime_ns', 'hash'])
+
+
+class BackupManifest:
+    """
+    Persistent index of the files in a backup root: relative path, size, mtime_ns, content hash and when the
+    file was last seen in the source. Lets copy_files decide whether a file is up to date from one stat of the
+    source file, without touching the destination, and retention find old files without walking the backup.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS files ('
+                           'repo TEXT NOT NULL, path TEXT NOT NULL, size INTEGER NOT NULL, '
+                           'mtime_ns INTEGER NOT NULL, hash TEXT NOT NULL, last_seen REAL NOT NULL DEFAULT 0, '
+                           'PRIMARY KEY (repo, path))')
+        columns = [row[1] for row in self._conn.execute('PRAGMA table_info(files)')]
+        if 'last_seen' not in columns:
+            # Manifest of an older version: count all files as seen now
+            self._conn.execute('ALTER TABLE files ADD COLUMN last_seen REAL NOT NULL DEFAULT 0')
+            self._conn.execute('UPDATE files SET last_seen = ?', (time.time(),))
+        self._conn.execute('CREATE INDEX IF NOT EXISTS files_last_seen ON files (repo, last_seen)')
+        self._conn.commit()
+
+    @classmethod
+    def for_backup_root(cls, backup_root_path):
+        return cls(get_state_dir(backup_root_path) / 'manifest.sqlite3')
+
+    def get(self, repo, path):
+        with self._lock:
+            row = self._conn.execute('SELECT size, mtime_ns, hash FROM files WHERE repo = ? AND path = ?',
+                                     (repo, path)).fetchone()
+        return ManifestEntry(*row) if row else None
+
+    def record(self, repo, path, size, mtime_ns, file_hash):
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO files (repo, path, size, mtime_ns, hash, last_seen) '
+                               'VALUES (?, ?, ?, ?, ?, ?)', (repo, path, size, mtime_ns, file_hash, time.time()))
+
+    def mark_seen(self, repo, paths, timestamp=None):
+        """
+        Remember that the files were seen in the source, so retention keeps them.
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        with self._lock:
+            self._conn.executemany('UPDATE files SET last_seen = ? WHERE repo = ? AND path = ?',
+                                   ((timestamp, repo, path) for path in paths))
+
+    def expired(self, repo, cutoff):
+        """
+        Return the paths of a repository that were not seen in the source since cutoff (unix time).
+        """
+        with self._lock:
+            rows = self._conn.execute('SELECT path FROM files WHERE repo = ? AND last_seen < ? ORDER BY path',
+                                      (repo, cutoff)).fetchall()
+        return [row[0] for row in rows]
+
+    def remove(self, repo, path):
+        with self._lock:
+            self._conn.execute('DELETE FROM files WHERE repo = ? AND path = ?', (repo, path))
+
+    def entries(self, repo=None):
+        """
+        Return (repo, path, ManifestEntry) for all files, or for the files of one repository.
+        """
+        query = 'SELECT repo, path, size, mtime_ns, hash FROM files'
+        params = ()
+        if repo is not None:
+            query += ' WHERE repo = ?'
+            params = (repo,)
+        with self._lock:
+            rows = self._conn.execute(query + ' ORDER BY repo, path', params).fetchall()
+        return [(row[0], row[1], ManifestEntry(*row[2:])) for row in rows]
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute('DELETE FROM files')
+
+    def commit(self):
+        with self._lock:
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+
+def verify_manifest(manifest, backup_root_path, logger, check_hash=False):
+    """
+    Compare the manifest with the files in the backup root.
+    Returns the list of (repo, path, problem) for entries whose backup file is missing or differs.
+    """
+    problems = []
+    for repo, path, entry in manifest.entries():
+        backup_file = Path(backup_root_path) / repo / path
+        try:
+            stat = backup_file.stat()
+        except FileNotFoundError:
+            problems.append((repo, path, 'missing'))
+            continue
+        if stat.st_size != entry.size:
+            problems.append((repo, path, 'size differs'))
+        elif check_hash and compute_file_hash(backup_file) != entry.hash:
+            problems.append((repo, path, 'hash differs'))
+    for repo, path, problem in problems:
+        logger.warning(f"Manifest entry {repo}/{path}: {problem}")
+    logger.info(f"Manifest verified: {len(problems)} problems found.")
+    return problems
+
+
+def delete_expired_files(manifest, backup_root_path, repo_paths, delete_after_days, logger, test_mode=True):
+    """
+    Delete files from the backup that do not exist in the source repository and were not seen
+    in the source for the specified number of days. Candidates come from the manifest, so only files
+    that are due are touched.
+    """
+    cutoff = time.time() - delete_after_days * 24 * 60 * 60
+    deleted = 0
+    for repo_path in repo_paths:
+        repo_name = Path(repo_path).name
+        backup_path = Path(backup_root_path) / repo_name
+        still_in_source = []
+        for path in manifest.expired(repo_name, cutoff):
+            file_path = backup_path / path
+            if (Path(repo_path) / path).exists():
+                # No longer a backup candidate (e.g. committed and pushed) but still in the source: keep it
+                still_in_source.append(path)
+                continue
+            try:
+                if not test_mode:
+                    if file_path.exists():
+                        file_path.unlink()
+                    manifest.remove(repo_name, path)
+                logger.info(
+                    f"Deleted {file_path} (no longer in source and older than {delete_after_days} days)."
+                    f"Test mode: {test_mode}")
+                deleted += 1
+            except OSError as e:
+                logger.error(f"Failed to delete {file_path}: {e}")
+        if still_in_source and not test_mode:
+            manifest.mark_seen(repo_name, still_in_source)
+    manifest.commit()
+    return deleted
+
+
+def rebuild_manifest(manifest, backup_root_path, repo_names, logger):
+    """
+    Recreate the manifest from the files that are currently in the backup root.
+    Returns the number of recorded files.
+    """
+    manifest.clear()
+    recorded = 0
+    for repo in repo_names:
+        repo_backup_path = Path(backup_root_path) / repo
+        for root, _, files in os.walk(repo_backup_path):
+            for file in files:
+                backup_file = Path(root) / file
+                try:
+                    stat = backup_file.stat()
+                    manifest.record(repo, str(backup_file.relative_to(repo_backup_path)), stat.st_size,
+                                    stat.st_mtime_ns, compute_file_hash(backup_file))
+                    recorded += 1
+                except OSError as e:
+                    logger.error(f"Failed to add {backup_file} to the manifest: {e}")
+    manifest.commit()
+    logger.info(f"Manifest rebuilt: {recorded} files recorded.")
+    return recorded
@@ -0,0 +1,235 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+# Metrics of the repository the current thread works on, set by RunMetrics.collect()
+_current = threading.local()
+
+COUNTERS = ['files_enumerated', 'files_filtered', 'files_copied', 'files_skipped', 'files_deferred', 'bytes_hashed',
+            'bytes_read', 'bytes_copied', 'subprocess_count', 'subprocess_seconds', 'filter_seconds', 'hash_seconds',
+            'copy_seconds']
+
+
+def count(name, value=1):
+    """
+    Add value to a counter of the repository the current thread works on. Does nothing outside of a run.
+    """
+    repo_metrics = getattr(_current, 'metrics', None)
+    if repo_metrics is not None:
+        repo_metrics.add(name, value)
+
+
+def current():
+    """
+    Return the metrics of the repository the current thread works on, or None.
+    """
+    return getattr(_current, 'metrics', None)
+
+
+@contextmanager
+def bind(repo_metrics):
+    """
+    Collect the metrics of the current thread in repo_metrics, e.g. in a worker thread of a repository.
+    """
+    previous = getattr(_current, 'metrics', None)
+    _current.metrics = repo_metrics
+    try:
+        yield repo_metrics
+    finally:
+        _current.metrics = previous
+
+
+@contextmanager
+def stage(name):
+    """
+    Record the wall time of a stage of the repository the current thread works on.
+    """
+    repo_metrics = getattr(_current, 'metrics', None)
+    if repo_metrics is None:
+        yield
+        return
+    with repo_metrics.stage(name):
+        yield
+
+
+def timed_iter(name, iterable):
+    """
+    Yield the items of iterable and add the time spent producing them to the stage name of the current
+    repository, e.g. for enumeration that runs interleaved with the copy stage.
+    """
+    repo_metrics = current()
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            if repo_metrics is not None:
+                repo_metrics.add_stage(name, time.perf_counter() - start)
+        yield item
+
+
+def counted(name, iterable):
+    """
+    Yield the items of iterable and add their number to the counter name of the current repository.
+    """
+    number = 0
+    try:
+        for item in iterable:
+            number += 1
+            yield item
+    finally:
+        count(name, number)
+
+
+@contextmanager
+def timer(name):
+    """
+    Add the time spent in the block to the counter name of the current repository.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        count(name, time.perf_counter() - start)
+
+
+class RepoMetrics:
+    """
+    Stage timings and counters of one repository.
+    """
+
+    def __init__(self, repo_name):
+        self.repo_name = repo_name
+        self.stages = {}
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self._lock = threading.Lock()
+
+    def add(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_stage(self, name, seconds):
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0) + seconds
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Record the wall time of a stage. Time of repeated stages adds up.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.perf_counter() - start)
+
+    def as_dict(self):
+        return {'stages': {name: round(seconds, 6) for name, seconds in self.stages.items()},
+                'counters': {name: round(value, 6) if isinstance(value, float) else value
+                             for name, value in self.counters.items()}}
+
+
+class RunMetrics:
+    """
+    Timings and counters of a backup run, per repository. Written as a JSON report and optionally as a
+    node_exporter textfile at the end of the run.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self._start = time.perf_counter()
+        self.duration = None
+        self.success = None
+        self.stages = {}
+        self.repos = {}
+        self.totals = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def collect(self, repo_name):
+        """
+        Collect the metrics of work done by the current thread for a repository.
+        """
+        with self._lock:
+            repo_metrics = self.repos.setdefault(repo_name, RepoMetrics(repo_name))
+        with bind(repo_metrics), repo_metrics.stage('total'):
+            yield repo_metrics
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Record the wall time of a stage that is not specific to one repository (e.g. retention).
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0) + time.perf_counter() - start
+
+    def finish(self, success, **totals):
+        """
+        Stop the run clock and remember the totals (e.g. copied, skipped, deleted) of the run.
+        """
+        self.duration = time.perf_counter() - self._start
+        self.success = success
+        self.totals = totals
+
+    def as_dict(self):
+        return {
+            'started': self.started,
+            'duration_seconds': round(self.duration or 0, 6),
+            'success': self.success,
+            'totals': self.totals,
+            'stages': {name: round(seconds, 6) for name, seconds in self.stages.items()},
+            'repositories': {name: repo.as_dict() for name, repo in sorted(self.repos.items())},
+        }
+
+    def write_report(self, report_path):
+        _write_atomic(report_path, json.dumps(self.as_dict(), indent=2, sort_keys=True) + '\n')
+
+    def write_textfile(self, textfile_path):
+        """
+        Write the metrics in the Prometheus text format for the node_exporter textfile collector.
+        """
+        lines = []
+
+        def metric(name, help_text, samples):
+            lines.append(f'# HELP git_backup_{name} {help_text}')
+            lines.append(f'# TYPE git_backup_{name} gauge')
+            for labels, value in samples:
+                label_text = ','.join(f'{key}="{_escape_label(str(val))}"' for key, val in labels.items())
+                lines.append(f'git_backup_{name}{{{label_text}}} {value}' if label_text
+                             else f'git_backup_{name} {value}')
+
+        metric('last_run_timestamp_seconds', 'Start time of the last backup run.', [({}, self.started)])
+        metric('run_duration_seconds', 'Wall time of the last backup run.', [({}, round(self.duration or 0, 6))])
+        metric('run_success', '1 if the last backup run succeeded.', [({}, int(bool(self.success)))])
+        metric('run_files', 'Files of the last backup run by result.',
+               [({'result': name}, value) for name, value in sorted(self.totals.items())])
+        metric('run_stage_seconds', 'Wall time of stages that are not specific to a repository.',
+               [({'stage': name}, round(seconds, 6)) for name, seconds in sorted(self.stages.items())])
+        metric('repo_stage_seconds', 'Wall time per repository and stage.',
+               [({'repo': repo.repo_name, 'stage': stage}, round(seconds, 6))
+                for repo in self.repos.values() for stage, seconds in sorted(repo.stages.items())])
+        for counter in COUNTERS:
+            metric(f'repo_{counter}', f'{counter.replace("_", " ").capitalize()} per repository.',
+                   [({'repo': repo.repo_name}, repo.counters.get(counter, 0)) for repo in self.repos.values()])
+        _write_atomic(textfile_path, '\n'.join(lines) + '\n')
+
+
+def _escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _write_atomic(path, text):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f'.{path.name}.tmp')
+    tmp_path.write_text(text)
+    os.replace(tmp_path, path)
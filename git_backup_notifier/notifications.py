@@ -1,12 +1,23 @@
-import smtplib
-from email.mime.text import MIMEText
-import requests
-from plyer import notification
 import subprocess
 import sys
+import time
+import queue
+import threading
+from git_backup_notifier.utils import StateFile
 
+DEFAULT_TIMEOUT = 10
+TELEGRAM_API_URL = 'https://api.telegram.org'
+# smtplib, email, requests and plyer are imported where they are used. They take most of the startup time
+# and many runs (hooks, watch wrappers) never send a notification.
 
-def send_email_notification(to_address, subject, body, smtp_config=None):
+
+class PermanentNotificationError(Exception):
+    """
+    A notification failed in a way that a retry will not fix (e.g. wrong credentials).
+    """
+
+
+def send_email_notification(to_address, subject, body, smtp_config=None, timeout=DEFAULT_TIMEOUT):
     if not smtp_config:
         print("No SMTP configuration provided.")
         return
@@ -21,62 +32,70 @@ def send_email_notification(to_address, subject, body, smtp_config=None):
     password = smtp_config.get('smtp_password', 'your-password')
     from_address = smtp_config.get('from_address', 'test@dummy.com')
 
+    import smtplib
+    from email.mime.text import MIMEText
     msg = MIMEText(body)
     msg['Subject'] = subject
-    msg['From'] = 'your-email@example.com'
+    msg['From'] = from_address
     msg['To'] = to_address
 
     try:
-        with smtplib.SMTP(server, port=port) as server:
+        with smtplib.SMTP(server, port=port, timeout=timeout) as server:
             server.login(user=username, password=password)
             server.sendmail(from_addr=from_address, to_addrs=[to_address], msg=msg.as_string())
     except Exception as e:
         print(f"Failed to send email: {e}")
 
 
-def send_telegram_notification(token, chat_id, message):
-    url = f"https://api.telegram.org/bot{token}/sendMessage"
+def send_telegram_notification(token, chat_id, message, timeout=DEFAULT_TIMEOUT, api_url=TELEGRAM_API_URL):
+    import requests
+    url = f"{api_url}/bot{token}/sendMessage"
     payload = {
         'chat_id': chat_id,
         'text': message
     }
     try:
-        response = requests.post(url, data=payload)
+        response = requests.post(url, data=payload, timeout=timeout)
         response.raise_for_status()
     except requests.RequestException as e:
         print(f"Failed to send Telegram message: {e}")
 
 
-def send_local_notification(title, message):
+def send_local_notification(title, message, timeout=DEFAULT_TIMEOUT):
     if sys.platform == 'win32':
+        from plyer import notification
         notification.notify(
             title=title,
             message=message,
             app_name='Backup Script'
         )
     elif sys.platform == 'darwin':
-        send_macos_notification(title, message)
+        send_macos_notification(title, message, timeout)
     elif sys.platform.startswith('linux'):
-        send_linux_notification(title, message)
+        send_linux_notification(title, message, timeout)
     else:
         print(f"Local notifications are not supported on this platform: {sys.platform}")
 
 
-def send_macos_notification(title, message):
+def send_macos_notification(title, message, timeout=DEFAULT_TIMEOUT):
     try:
-        subprocess.run(['osascript', '-e', f'display notification "{message}" with title "{title}"'])
+        subprocess.run(['osascript', '-e', f'display notification "{message}" with title "{title}"'], timeout=timeout)
     except Exception as e:
         print(f"Failed to send MacOS notification: {e}")
 
 
-def send_linux_notification(title, message):
+def send_linux_notification(title, message, timeout=DEFAULT_TIMEOUT):
     try:
-        subprocess.run(['notify-send', title, message])
+        subprocess.run(['notify-send', title, message], timeout=timeout)
     except Exception as e:
         print(f"Failed to send Linux notification: {e}")
 
 
 def send_notification(title, message, config):
+    """
+    Send a notification on all configured channels and wait for it. See NotificationDispatcher for
+    sending in the background.
+    """
     send_local_notification(title, message)
     if 'email' in config['Notifications']:
         send_email_notification(to_address=config['Notifications']['email'],
@@ -86,3 +105,208 @@ def send_notification(title, message, config):
     if 'telegram_token' in config['Notifications'] and 'telegram_chat_id' in config['Notifications']:
         send_telegram_notification(config['Notifications']['telegram_token'],
                                    config['Notifications']['telegram_chat_id'], message)
+
+
+class EmailChannel:
+    """
+    Sends notifications by email over one SMTP connection that is kept open between messages.
+    """
+
+    def __init__(self, smtp_config, timeout):
+        self.to_address = smtp_config['email']
+        self.server = smtp_config.get('smtp_server', 'smtp.example.com')
+        self.port = smtp_config.get('smtp_port', 587)
+        self.username = smtp_config.get('smtp_user')
+        self.password = smtp_config.get('smtp_password')
+        self.from_address = smtp_config.get('from_address', 'test@dummy.com')
+        self.starttls = smtp_config.get('smtp_starttls', False)
+        self.timeout = timeout
+        self._connection = None
+
+    def _connect(self):
+        import smtplib
+        connection = smtplib.SMTP(self.server, port=self.port, timeout=self.timeout)
+        if self.starttls:
+            connection.starttls()
+        if self.username:
+            try:
+                connection.login(user=self.username, password=self.password)
+            except smtplib.SMTPAuthenticationError as e:
+                connection.close()
+                raise PermanentNotificationError(e)
+        return connection
+
+    def send(self, title, message):
+        import smtplib
+        from email.mime.text import MIMEText
+        if self._connection is not None:
+            try:
+                self._connection.noop()
+            except smtplib.SMTPException:
+                self.reset()
+        if self._connection is None:
+            self._connection = self._connect()
+        msg = MIMEText(message)
+        msg['Subject'] = title
+        msg['From'] = self.from_address
+        msg['To'] = self.to_address
+        try:
+            self._connection.sendmail(from_addr=self.from_address, to_addrs=[self.to_address],
+                                      msg=msg.as_string())
+        except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused) as e:
+            raise PermanentNotificationError(e)
+
+    def reset(self):
+        if self._connection is not None:
+            import smtplib
+            try:
+                self._connection.quit()
+            except (smtplib.SMTPException, OSError):
+                self._connection.close()
+            self._connection = None
+
+    def close(self):
+        self.reset()
+
+
+class TelegramChannel:
+    """
+    Sends notifications to a Telegram chat through a reused HTTP session.
+    """
+
+    def __init__(self, token, chat_id, timeout, api_url=TELEGRAM_API_URL):
+        self.url = f"{api_url}/bot{token}/sendMessage"
+        self.chat_id = chat_id
+        self.timeout = timeout
+        self._session = None
+
+    def send(self, title, message):
+        if self._session is None:
+            import requests
+            self._session = requests.Session()
+        response = self._session.post(self.url, data={'chat_id': self.chat_id, 'text': message},
+                                      timeout=self.timeout)
+        if 400 <= response.status_code < 500 and response.status_code != 429:
+            raise PermanentNotificationError(f"Telegram API returned {response.status_code}: {response.text}")
+        response.raise_for_status()
+
+    def reset(self):
+        pass
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+
+
+class LocalChannel:
+    """
+    Shows notifications on the local desktop.
+    """
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+
+    def send(self, title, message):
+        send_local_notification(title, message, self.timeout)
+
+    def reset(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class NotificationDispatcher:
+    """
+    Sends notifications from background threads, one queue and worker per channel, so a slow
+    SMTP server or Telegram API does not hold up the backup. Connections are reused, every call
+    has a timeout and failed sends are retried with exponential backoff.
+    With digest_interval, notifications are collected (also over several runs if a state directory
+    is given) and sent as one message once the oldest of them is digest_interval seconds old.
+    """
+
+    def __init__(self, config, state_dir=None):
+        settings = config.get('Notifications', {})
+        self.timeout = settings.get('timeout', DEFAULT_TIMEOUT)
+        self.max_retries = settings.get('max_retries', 3)
+        self.retry_backoff = settings.get('retry_backoff', 1.0)
+        self.shutdown_timeout = settings.get('shutdown_timeout', 30)
+        self.digest_interval = settings.get('digest_interval', 0)
+        self._digest = StateFile(state_dir / 'notification_digest.json') if state_dir else None
+        self._digest_data = {}
+
+        channels = []
+        if settings.get('local', True):
+            channels.append(('local', LocalChannel(self.timeout)))
+        if 'email' in settings:
+            channels.append(('email', EmailChannel(settings, self.timeout)))
+        if 'telegram_token' in settings and 'telegram_chat_id' in settings:
+            channels.append(('telegram', TelegramChannel(settings['telegram_token'], settings['telegram_chat_id'],
+                                                         self.timeout,
+                                                         settings.get('telegram_api_url', TELEGRAM_API_URL))))
+        self._queues = []
+        self._threads = []
+        for name, channel in channels:
+            channel_queue = queue.Queue()
+            thread = threading.Thread(target=self._worker, args=(name, channel, channel_queue),
+                                      name=f'notify-{name}', daemon=True)
+            thread.start()
+            self._queues.append(channel_queue)
+            self._threads.append(thread)
+
+    def _worker(self, name, channel, channel_queue):
+        while True:
+            item = channel_queue.get()
+            if item is None:
+                break
+            title, message = item
+            for attempt in range(self.max_retries + 1):
+                try:
+                    channel.send(title, message)
+                    break
+                except Exception as e:
+                    channel.reset()
+                    if attempt == self.max_retries or isinstance(e, PermanentNotificationError):
+                        print(f"Failed to send {name} notification: {e}")
+                        break
+                    time.sleep(self.retry_backoff * 2 ** attempt)
+        channel.close()
+
+    def _send(self, title, message):
+        for channel_queue in self._queues:
+            channel_queue.put((title, message))
+
+    def notify(self, title, message, urgent=False):
+        """
+        Queue a notification and return immediately. Urgent notifications are never held back for a digest.
+        """
+        if not self.digest_interval or urgent:
+            self._send(title, message)
+            return
+        digest = self._digest.data if self._digest else self._digest_data
+        digest.setdefault('messages', []).append([time.time(), title, message])
+        if time.time() - digest['messages'][0][0] >= self.digest_interval:
+            self._send_digest(digest)
+        if self._digest:
+            self._digest.save()
+
+    def _send_digest(self, digest):
+        messages = digest.get('messages', [])
+        if messages:
+            self._send(f"{len(messages)} backup notifications",
+                       '\n'.join(f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(timestamp))} {title}: {message}"
+                                 for timestamp, title, message in messages))
+        digest['messages'] = []
+
+    def close(self, timeout=None):
+        """
+        Send everything that is queued, waiting at most timeout (default shutdown_timeout) seconds in total.
+        """
+        timeout = self.shutdown_timeout if timeout is None else timeout
+        # A digest that only lives in memory would be lost
+        self._send_digest(self._digest_data)
+        deadline = time.monotonic() + timeout
+        for channel_queue in self._queues:
+            channel_queue.put(None)
+        for thread in self._threads:
+            thread.join(max(0, deadline - time.monotonic()))
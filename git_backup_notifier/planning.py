@@ -0,0 +1,153 @@
+import sys
+import json
+import time
+from datetime import datetime
+from pathlib import Path
+from git_backup_notifier.utils import compile_exclusions, get_head_commit, iter_candidate_files, iter_expired_files, \
+    get_free_space
+
+
+def plan_file(file, src_stat, dst_file, repo_name, storage_mode='mirror', manifest=None, chunk_store=None):
+    """
+    Decide what a backup would do with a file without reading it, with the same checks as copy_files.
+    Returns (action, bytes to copy, bytes to hash, bytes of the backup the copy replaces).
+    A file with the same size but another mtime is hashed by the backup ('hash'). Whether its content changed
+    is not known before, so it is counted as copied.
+    """
+    size = src_stat.st_size
+    if storage_mode != 'mirror':
+        # Snapshots hash every file, archives read every file. Both write at most its size.
+        return 'store', size, size, 0
+    if chunk_store is not None and size >= chunk_store.threshold:
+        if chunk_store.is_current(repo_name, file, src_stat):
+            return 'up_to_date', 0, 0, 0
+        # At most the whole file is written as new chunks, older versions are kept
+        return 'chunk', size, size, 0
+    if manifest is not None:
+        entry = manifest.get(repo_name, file)
+        if entry is None:
+            return 'copy', size, 0, 0
+        if entry.size == size and entry.mtime_ns == src_stat.st_mtime_ns:
+            return 'up_to_date', 0, 0, 0
+        if entry.size != size:
+            return 'copy', size, 0, entry.size
+        return 'hash', size, size, size
+
+    try:
+        dst_stat = dst_file.stat()
+    except FileNotFoundError:
+        return 'copy', size, 0, 0
+    if size == dst_stat.st_size and src_stat.st_mtime == dst_stat.st_mtime:
+        return 'up_to_date', 0, 0, 0
+    if size != dst_stat.st_size:
+        return 'copy', size, 0, dst_stat.st_size
+    # Source and destination are hashed
+    return 'hash', size, 2 * size, size
+
+
+def plan_repository(repo_path, settings, logger, cursors=None, manifest=None, chunk_store=None):
+    """
+    Build the transfer plan of a single repository: every candidate file that passes the filters with the action
+    a backup would take, the bytes it would copy and hash and the files the retention would delete.
+    """
+    repo_path = str(repo_path)
+    repo_name = Path(repo_path).name
+    repo_backup_path = Path(settings['backup_root_path']) / repo_name
+    matcher = compile_exclusions(settings['exclude_dirs'], settings['exclude_patterns'])
+    storage_mode = settings['storage_mode']
+    plan = {'repo': repo_name, 'path': repo_path, 'files': [], 'files_filtered': 0, 'bytes_to_copy': 0,
+            'bytes_to_hash': 0, 'bytes_replaced': 0, 'largest_copy': 0, 'files_to_delete': []}
+    try:
+        head = get_head_commit(repo_path)
+        last_head = cursors.get(str(Path(repo_path).resolve())) \
+            if cursors is not None and storage_mode == 'mirror' else None
+        unpushed = settings['unpushed_mode'] != 'bundle' and (head is None or head != last_head)
+        for file in iter_candidate_files(repo_path, matcher, last_head, unpushed):
+            try:
+                src_stat = (Path(repo_path) / file).stat()
+            except OSError:
+                continue
+            if matcher.reason(file) or not (settings['min_file_size'] <= src_stat.st_size <= settings['max_file_size']):
+                plan['files_filtered'] += 1
+                continue
+            action, to_copy, to_hash, replaced = plan_file(file, src_stat, repo_backup_path / file, repo_name,
+                                                           storage_mode, manifest, chunk_store)
+            plan['files'].append({'path': file, 'size': src_stat.st_size, 'action': action})
+            plan['bytes_to_copy'] += to_copy
+            plan['bytes_to_hash'] += to_hash
+            plan['bytes_replaced'] += replaced
+            plan['largest_copy'] = max(plan['largest_copy'], to_copy)
+    except RuntimeError as e:
+        logger.error(e)
+        plan['error'] = str(e)
+
+    if storage_mode == 'mirror' and manifest is not None:
+        cutoff = time.time() - settings['delete_after_days'] * 24 * 60 * 60
+        plan['files_to_delete'] = [path for path in manifest.expired(repo_name, cutoff)
+                                   if not (Path(repo_path) / path).exists()]
+    elif storage_mode == 'mirror':
+        plan['files_to_delete'] = [file_path.relative_to(repo_backup_path).as_posix() for file_path in
+                                   iter_expired_files(settings['backup_root_path'], [repo_path],
+                                                      settings['delete_after_days'], logger)]
+    return plan
+
+
+def plan_backup(settings, repo_paths, logger, cursors=None, manifest=None, chunk_store=None):
+    """
+    Build the transfer plan of a backup run and compare the space it needs with the free space of the backup root.
+    Space needed is the growth of the backup (copied bytes minus the bytes they replace) plus room for the
+    temporary files that are in progress at the same time, and free_space_margin_bytes.
+    Deleted files are not taken into account, the retention runs after the copy.
+    """
+    repositories = [plan_repository(repo_path, settings, logger, cursors, manifest, chunk_store)
+                    for repo_path in repo_paths]
+    growth = sum(max(0, repo['bytes_to_copy'] - repo['bytes_replaced']) for repo in repositories)
+    bytes_to_copy = sum(repo['bytes_to_copy'] for repo in repositories)
+    largest_copy = max([repo['largest_copy'] for repo in repositories], default=0)
+    in_flight = settings['copy_max_in_flight_bytes'] if settings['copy_workers'] > 1 else 0
+    # Replaced files are only freed when their copy is complete
+    temporary = min(bytes_to_copy, max(largest_copy, in_flight))
+    bytes_required = growth + temporary
+    free_bytes = get_free_space(settings['backup_root_path'])
+    margin = settings['free_space_margin_bytes']
+    return {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'backup_root_path': str(settings['backup_root_path']),
+        'storage_mode': settings['storage_mode'],
+        'test_mode': settings['test_mode'],
+        'totals': {
+            'files': sum(len(repo['files']) for repo in repositories),
+            'files_to_copy': sum(1 for repo in repositories for file in repo['files']
+                                 if file['action'] != 'up_to_date'),
+            'files_filtered': sum(repo['files_filtered'] for repo in repositories),
+            'bytes_to_copy': bytes_to_copy,
+            'bytes_to_hash': sum(repo['bytes_to_hash'] for repo in repositories),
+            'files_to_delete': sum(len(repo['files_to_delete']) for repo in repositories),
+        },
+        'bytes_required': bytes_required,
+        'free_bytes': free_bytes,
+        'margin_bytes': margin,
+        'fits': bytes_required + margin <= free_bytes,
+        'repositories': repositories,
+    }
+
+
+def check_plan(plan):
+    """
+    Raise OSError if the backup root does not have the free space a plan needs.
+    """
+    if not plan['fits']:
+        raise OSError(f"Not enough free space on device: {plan['backup_root_path']}. "
+                      f"Required: {plan['bytes_required']} + {plan['margin_bytes']} margin, "
+                      f"Available: {plan['free_bytes']}")
+
+
+def write_plan(plan, path):
+    """
+    Write a plan as JSON to path, or to stdout if path is '-'.
+    """
+    text = json.dumps(plan, indent=2)
+    if path == '-':
+        sys.stdout.write(text + '\n')
+    else:
+        Path(path).write_text(text)
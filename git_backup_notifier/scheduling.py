@@ -0,0 +1,35 @@
+import os
+import time
+from git_backup_notifier.utils import compile_exclusions
+
+# Upper ages in seconds of the recency classes files are ordered by: last hour, day, week, older
+AGE_CLASSES = (60 * 60, 24 * 60 * 60, 7 * 24 * 60 * 60)
+
+
+def get_age_class(age):
+    return next((index for index, limit in enumerate(AGE_CLASSES) if age < limit), len(AGE_CLASSES))
+
+
+def prioritize_files(files, src_base_path, priority_patterns=(), deferred=(), now=None):
+    """
+    Return the files ordered by what should be backed up first when a run might not finish:
+    files matching one of priority_patterns (file name or path relative to src_base_path) and files deferred
+    by the last run first, then by recency (AGE_CLASSES) and within a class smaller files before larger ones.
+    Files that cannot be read come last, copy_files reports them.
+    """
+    now = time.time() if now is None else now
+    matcher = compile_exclusions([], priority_patterns) if priority_patterns else None
+    deferred = set(deferred)
+    keys = []
+    missing = []
+    for file in files:
+        try:
+            src_stat = os.stat(os.path.join(src_base_path, file))
+        except OSError:
+            missing.append(file)
+            continue
+        urgent = file in deferred or matcher is not None and (
+            matcher.excludes_name(os.path.basename(file)) or matcher.excludes_name(file))
+        keys.append((not urgent, get_age_class(now - src_stat.st_mtime), src_stat.st_size, file))
+    keys.sort()
+    return [key[-1] for key in keys] + missing
@@ -0,0 +1,245 @@
+import os
+import json
+import tempfile
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from git_backup_notifier import metrics
+from git_backup_notifier.utils import compile_exclusions, compute_file_hash, copy_and_hash, copy_file, file_event
+
+
+class SnapshotStore:
+    """
+    Content addressed store below the backup root. File contents are kept once per sha256 in objects/,
+    every run of a repository is recorded as a JSON snapshot in snapshots/<repo>/ that maps paths to hashes.
+    """
+
+    def __init__(self, root_path):
+        self.root_path = Path(root_path)
+        self.objects_path = self.root_path / 'objects'
+        self.snapshots_path = self.root_path / 'snapshots'
+        self._known_sizes = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_backup_root(cls, backup_root_path):
+        return cls(Path(backup_root_path) / '.store')
+
+    def object_path(self, file_hash):
+        return self.objects_path / file_hash[:2] / file_hash[2:]
+
+    def has_object(self, file_hash):
+        return self.object_path(file_hash).exists()
+
+    def add_object(self, src_file):
+        """
+        Store the content of src_file, reading it only once.
+        Returns the hash and whether the content was new to the store.
+        """
+        self.objects_path.mkdir(parents=True, exist_ok=True)
+        with open(src_file, 'rb') as src:
+            fd, tmp_name = tempfile.mkstemp(prefix='.object.', suffix='.tmp', dir=self.objects_path)
+            try:
+                with os.fdopen(fd, 'wb') as dst:
+                    file_hash = copy_and_hash(src, dst)
+                object_path = self.object_path(file_hash)
+                if object_path.exists():
+                    os.unlink(tmp_name)
+                    return file_hash, False
+                object_path.parent.mkdir(exist_ok=True)
+                os.replace(tmp_name, object_path)
+                return file_hash, True
+            except BaseException:
+                try:
+                    os.unlink(tmp_name)
+                except OSError:
+                    pass
+                raise
+
+    def known_sizes(self):
+        """
+        Return the set of file sizes in the latest snapshot of every repository. Content of another size is new to
+        the store and copied right away, content of a known size is hashed first. Add the sizes of new objects.
+        """
+        with self._lock:
+            if self._known_sizes is None:
+                sizes = set()
+                if self.snapshots_path.is_dir():
+                    for repo_snapshots_path in self.snapshots_path.iterdir():
+                        if repo_snapshots_path.is_dir():
+                            entries = self.load_snapshot(repo_snapshots_path.name)
+                            sizes.update(entry['size'] for entry in entries.values())
+                self._known_sizes = sizes
+            return self._known_sizes
+
+    def list_snapshots(self, repo_name):
+        """
+        Return the snapshot ids of a repository, oldest first.
+        """
+        repo_snapshots_path = self.snapshots_path / repo_name
+        if not repo_snapshots_path.is_dir():
+            return []
+        return sorted(path.stem for path in repo_snapshots_path.glob('*.json'))
+
+    def load_snapshot(self, repo_name, snapshot_id=None):
+        """
+        Return the entries of a snapshot (latest if no id is given) or an empty dict if there is none.
+        """
+        if snapshot_id is None:
+            snapshots = self.list_snapshots(repo_name)
+            if not snapshots:
+                return {}
+            snapshot_id = snapshots[-1]
+        with open(self.snapshots_path / repo_name / f'{snapshot_id}.json') as f:
+            return json.load(f)['files']
+
+    def save_snapshot(self, repo_name, entries):
+        """
+        Record entries as a new snapshot of the repository and return its id.
+        """
+        snapshot_id = datetime.now().strftime('%Y%m%dT%H%M%S%f')
+        repo_snapshots_path = self.snapshots_path / repo_name
+        repo_snapshots_path.mkdir(parents=True, exist_ok=True)
+        tmp_path = repo_snapshots_path / f'.{snapshot_id}.tmp'
+        tmp_path.write_text(json.dumps({'repo': repo_name, 'files': entries}, indent=1, sort_keys=True))
+        os.replace(tmp_path, repo_snapshots_path / f'{snapshot_id}.json')
+        return snapshot_id
+
+    def prune(self, repo_names, delete_after_days, logger, test_mode=True):
+        """
+        Delete snapshots recorded more than delete_after_days ago, except the latest snapshot of every repository,
+        and then the objects no snapshot refers to. Returns the number of deleted snapshots.
+        """
+        cutoff = time.time() - delete_after_days * 24 * 60 * 60
+        deleted = 0
+        for repo_name in repo_names:
+            for snapshot_id in self.list_snapshots(repo_name)[:-1]:
+                snapshot_path = self.snapshots_path / repo_name / f'{snapshot_id}.json'
+                try:
+                    if snapshot_path.stat().st_mtime >= cutoff:
+                        continue
+                    if not test_mode:
+                        snapshot_path.unlink()
+                    logger.info(f"Deleted snapshot {snapshot_id} of {repo_name} "
+                                f"(older than {delete_after_days} days). Test mode: {test_mode}")
+                    deleted += 1
+                except OSError as e:
+                    logger.error(f"Failed to delete {snapshot_path}: {e}")
+        if deleted and not test_mode:
+            self._collect_garbage(logger)
+        return deleted
+
+    def _collect_garbage(self, logger):
+        # Snapshots of all repositories, also of those that are not part of this run
+        referenced = set()
+        for snapshot_path in self.snapshots_path.glob('*/*.json'):
+            with open(snapshot_path) as f:
+                referenced.update(entry['hash'] for entry in json.load(f)['files'].values())
+        for object_path in self.objects_path.glob('*/*'):
+            file_hash = object_path.parent.name + object_path.name
+            if file_hash not in referenced and not object_path.name.startswith('.'):
+                try:
+                    object_path.unlink()
+                except OSError as e:
+                    logger.error(f"Failed to delete object {object_path}: {e}")
+        with self._lock:
+            self._known_sizes = None
+
+
+def snapshot_files(file_list, src_base_path, store, repo_name, exclude_patterns, exclude_dirs, min_size, max_size,
+                   logger, test_mode=True):
+    """
+    Store files in the snapshot store and record them as a new snapshot of the repository,
+    applying exclusions and size filters like copy_files.
+    Files with the same size and mtime as in the previous snapshot are not read again. Files that changed
+    only their mtime and files with the size of stored content (e.g. the same .env in another repository) are
+    hashed first and only copied into the store if their content is new.
+    """
+    matcher = compile_exclusions(exclude_dirs, exclude_patterns)
+    previous = store.load_snapshot(repo_name)
+    entries = {}
+    copied = 0
+    skipped = 0
+    for file in sorted(file_list):
+        src_file = Path(src_base_path) / file
+
+        reason = matcher.reason(file)
+        if reason:
+            metrics.count('files_filtered')
+            logger.debug("Skipped %s (excluded by %s)", src_file, reason,
+                         extra=file_event(repo_name, file, 'excluded'))
+            skipped += 1
+            continue
+
+        try:
+            src_stat = src_file.stat()
+            if not (min_size <= src_stat.st_size <= max_size):
+                metrics.count('files_filtered')
+                logger.debug("Skipped %s (file size out of range)", src_file,
+                             extra=file_event(repo_name, file, 'filtered'))
+                skipped += 1
+                continue
+
+            entry = previous.get(file)
+            if entry and entry['size'] == src_stat.st_size and entry['mtime_ns'] == src_stat.st_mtime_ns:
+                entries[file] = entry
+                skipped += 1
+                logger.debug("Skipped %s (unchanged since the last snapshot)", src_file,
+                             extra=file_event(repo_name, file, 'up_to_date'))
+                continue
+
+            if test_mode or entry is not None or src_stat.st_size in store.known_sizes():
+                file_hash = compute_file_hash(src_file)
+                added = not store.has_object(file_hash)
+                if added and not test_mode:
+                    file_hash, added = store.add_object(src_file)
+            else:
+                # Content of a new size: copied and hashed in one pass
+                file_hash, added = store.add_object(src_file)
+            if not test_mode:
+                store.known_sizes().add(src_stat.st_size)
+            entries[file] = {'hash': file_hash, 'size': src_stat.st_size, 'mtime_ns': src_stat.st_mtime_ns,
+                             'mode': src_stat.st_mode & 0o7777}
+            if added:
+                copied += 1
+                logger.info("Stored %s as object %s", src_file, file_hash, extra=file_event(repo_name, file, 'stored'))
+            else:
+                skipped += 1
+                logger.debug("Skipped %s (content is already in the store)", src_file,
+                             extra=file_event(repo_name, file, 'up_to_date'))
+        except OSError as e:
+            skipped += 1
+            logger.error("Failed to store %s: %s", src_file, e, extra=file_event(repo_name, file, 'failed'))
+
+    if entries == previous:
+        logger.debug(f"No new snapshot for {repo_name} (nothing changed since the last snapshot)")
+    elif not test_mode:
+        snapshot_id = store.save_snapshot(repo_name, entries)
+        logger.info(f"Recorded snapshot {snapshot_id} of {repo_name} with {len(entries)} files")
+    metrics.count('files_copied', copied)
+    metrics.count('files_skipped', skipped)
+    return copied, skipped
+
+
+def restore_snapshot(store, repo_name, target_path, logger, snapshot_id=None):
+    """
+    Write the files of a snapshot (latest if no id is given) below target_path.
+    Returns the number of restored files.
+    """
+    entries = store.load_snapshot(repo_name, snapshot_id)
+    if not entries:
+        raise FileNotFoundError(f"No snapshot found for {repo_name}")
+    restored = 0
+    for file, entry in sorted(entries.items()):
+        target_file = Path(target_path) / file
+        try:
+            target_file.parent.mkdir(parents=True, exist_ok=True)
+            copy_file(store.object_path(entry['hash']), target_file)
+            os.chmod(target_file, entry['mode'])
+            os.utime(target_file, ns=(entry['mtime_ns'], entry['mtime_ns']))
+            restored += 1
+            logger.info(f"Restored {target_file}")
+        except OSError as e:
+            logger.error(f"Failed to restore {target_file}: {e}")
+    return restored
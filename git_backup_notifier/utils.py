@@ -2,49 +2,251 @@ import os
 import shutil
 import subprocess
 import logging
+import logging.handlers
+import atexit
+import queue
 import hashlib
+import json
+import threading
 from pathlib import Path
 from datetime import datetime, timedelta
-import toml
 import fnmatch
+import functools
+import re
+import sys
+import tempfile
+import time
+from collections import namedtuple, deque
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor, Future
+from git_backup_notifier import metrics
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
-def setup_logger(log_dir):
+COPY_BUFFER_SIZE = 1024 * 1024
+FICLONE = 0x40049409  # ioctl to reflink a file on btrfs/XFS
+# Files a copy worker may have in progress or waiting to be logged, so memory does not grow with the repository
+FILES_IN_FLIGHT_PER_WORKER = 4
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+# Config files changed this recently are not cached, their mtime might not show a later change yet
+CONFIG_CACHE_GRACE_SECONDS = 2
+
+
+class RecordBufferHandler(logging.Handler):
+    """
+    Collect log records in memory so they can be replayed later in a deterministic order.
+    """
+
+    def __init__(self):
+        super().__init__(logging.DEBUG)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class ErrorCountHandler(logging.Handler):
     """
-    Set up the logger for backup operations.
+    Count the error records of a logger, e.g. to find out whether a repository was backed up without errors.
     """
+
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+
+def create_buffered_logger(name):
+    """
+    Create a standalone logger that keeps its records in memory instead of writing them.
+    """
+    buffered_logger = logging.Logger(name, logging.DEBUG)
+    handler = RecordBufferHandler()
+    buffered_logger.addHandler(handler)
+    return buffered_logger, handler
+
+
+def file_event(repo_name, path, event):
+    """
+    Return the extra fields of a per-file log record: the repository, the path in it and what happened to the file
+    (copied, chunked, stored, up_to_date, excluded, filtered or failed).
+    """
+    return {'repo': repo_name, 'path': path, 'event': event}
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    Put records on the queue as they are. The standard QueueHandler formats every message in the thread that logs,
+    here the listener thread formats it, and only if a handler writes it.
+    Arguments of log calls must not be changed after the call.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class FileEventFilter(logging.Filter):
+    """
+    Pass only per-file records (events=True) or everything except per-file records below WARNING (events=False).
+    """
+
+    def __init__(self, events):
+        super().__init__()
+        self.events = events
+
+    def filter(self, record):
+        is_event = hasattr(record, 'event')
+        return is_event if self.events else not is_event or record.levelno >= logging.WARNING
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """
+    Format a per-file record as one compact JSON object per line, the message is only kept for warnings and errors.
+    """
+
+    def format(self, record):
+        event = {'time': round(record.created, 3), 'level': record.levelname, 'repo': record.repo,
+                 'path': record.path, 'event': record.event}
+        if record.levelno >= logging.WARNING:
+            event['message'] = record.getMessage()
+        return json.dumps(event, separators=(',', ':'))
+
+
+_log_lock = threading.Lock()
+_log_listener = None
+
+
+def setup_logger(log_dir, max_bytes=LOG_MAX_BYTES, backup_count=LOG_BACKUP_COUNT, file_events='text'):
+    """
+    Set up the logger for backup operations. Records are put on a queue and written by a background thread
+    to backup.log (rotated at max_bytes, backup_count old logs are kept) and to the console (INFO and above).
+    With file_events 'jsonl' the per-file records go to events.jsonl as compact JSON lines instead.
+    Calling it again replaces the handlers of the previous call.
+    """
+    global _log_listener
     log_dir.mkdir(parents=True, exist_ok=True)
-    log_file = log_dir / 'backup.log'
 
     logger = logging.getLogger('backup_logger')
     logger.setLevel(logging.DEBUG)
 
-    fh = logging.FileHandler(log_file)
+    formatter = logging.Formatter(LOG_FORMAT)
+    fh = logging.handlers.RotatingFileHandler(log_dir / 'backup.log', maxBytes=max_bytes, backupCount=backup_count)
     fh.setLevel(logging.DEBUG)
+    fh.setFormatter(formatter)
 
     ch = logging.StreamHandler()
     ch.setLevel(logging.INFO)
-
-    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-    fh.setFormatter(formatter)
     ch.setFormatter(formatter)
+    handlers = [fh, ch]
+
+    if file_events == 'jsonl':
+        fh.addFilter(FileEventFilter(False))
+        ch.addFilter(FileEventFilter(False))
+        eh = logging.handlers.RotatingFileHandler(log_dir / 'events.jsonl', maxBytes=max_bytes,
+                                                  backupCount=backup_count)
+        eh.setLevel(logging.DEBUG)
+        eh.setFormatter(JsonLinesFormatter())
+        eh.addFilter(FileEventFilter(True))
+        handlers.append(eh)
 
-    logger.addHandler(fh)
-    logger.addHandler(ch)
+    with _log_lock:
+        stop_logger()
+        log_queue = queue.SimpleQueue()
+        _log_listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+        _log_listener.start()
+        logger.addHandler(LazyQueueHandler(log_queue))
 
     return logger
 
 
-def load_config(default_path, user_path=None):
+def stop_logger():
+    """
+    Write the records that are still queued and close the handlers of setup_logger. Runs at exit.
+    """
+    global _log_listener
+    logger = logging.getLogger('backup_logger')
+    for handler in list(logger.handlers):
+        if isinstance(handler, LazyQueueHandler):
+            logger.removeHandler(handler)
+    if _log_listener is not None:
+        _log_listener.stop()
+        for handler in _log_listener.handlers:
+            handler.close()
+        _log_listener = None
+
+
+atexit.register(stop_logger)
+
+
+def get_cache_dir():
+    """
+    Directory for caches that do not belong to a backup root, GIT_BACKUP_NOTIFIER_CACHE_DIR or the user cache dir.
+    """
+    if os.environ.get('GIT_BACKUP_NOTIFIER_CACHE_DIR'):
+        return Path(os.environ['GIT_BACKUP_NOTIFIER_CACHE_DIR'])
+    return Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache') / 'git-backup-notifier'
+
+
+def get_config_key(paths):
+    """
+    Return the path, size and mtime of every config file (None for missing files) or None if one of them was
+    changed so recently that a later change might not show in its mtime.
+    """
+    key = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            key.append([os.path.abspath(path), None, None])
+            continue
+        if stat.st_mtime > time.time() - CONFIG_CACHE_GRACE_SECONDS:
+            return None
+        key.append([os.path.abspath(path), stat.st_size, stat.st_mtime_ns])
+    return key
+
+
+def load_config(default_path, user_path=None, cache_dir=None):
     """
     Load the default configuration and optionally merge it with a user-specified configuration.
+    The merged configuration is cached as JSON in cache_dir (default get_cache_dir()) and used again
+    as long as size and mtime of both files are the same. Pass cache_dir=False to always parse the files.
     """
+    paths = [default_path] + ([user_path] if user_path else [])
+    key = get_config_key(paths) if cache_dir is not False else None
+    cache_file = None
+    if key is not None:
+        cache_name = hashlib.blake2b(json.dumps([path for path, _, _ in key]).encode(), digest_size=8).hexdigest()
+        cache_file = Path(cache_dir or get_cache_dir()) / f'config_{cache_name}.json'
+        try:
+            cached = json.loads(cache_file.read_text())
+            if cached['key'] == key:
+                return cached['config']
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    import toml
     config = toml.load(default_path)
 
     if user_path and Path(user_path).exists():
         user_config = toml.load(user_path)
         merge_dicts(config, user_config)
 
+    if cache_file is not None:
+        try:
+            text = json.dumps({'key': key, 'config': config})
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp_file = cache_file.with_name(f'.{cache_file.name}.{os.getpid()}.tmp')
+            tmp_file.write_text(text)
+            os.replace(tmp_file, cache_file)
+        except (OSError, TypeError, ValueError):
+            pass  # Dates and times do not fit into JSON, such configs are parsed every time
     return config
 
 
@@ -59,68 +261,301 @@ def merge_dicts(base, updates):
             base[key] = value
 
 
-def get_uncommitted_files(repo_path):
+class ExclusionMatcher:
+    """
+    Exclusion rules compiled once: a set of excluded directory names and a single regex
+    for all file name patterns.
+    """
+
+    def __init__(self, exclude_dirs=(), exclude_patterns=()):
+        self.exclude_dirs = frozenset(exclude_dirs)
+        self.exclude_patterns = tuple(exclude_patterns)
+        # fnmatch compares case-insensitive where the file system does (Windows), so does the regex
+        flags = re.IGNORECASE if os.path.normcase('A') == 'a' else 0
+        self._pattern_regex = re.compile('|'.join(fnmatch.translate(pattern) for pattern in self.exclude_patterns),
+                                         flags) if self.exclude_patterns else None
+
+    def excludes_dir(self, name):
+        return name in self.exclude_dirs
+
+    def excludes_name(self, name):
+        return self._pattern_regex is not None and self._pattern_regex.match(name) is not None
+
+    def reason(self, relative_path, is_dir=False):
+        """
+        Return why a path relative to the repository is excluded ('directory' or 'pattern') or None.
+        """
+        parts = Path(relative_path).parts
+        if not parts:
+            return None
+        if any(part in self.exclude_dirs for part in (parts if is_dir else parts[:-1])):
+            return 'directory'
+        if not is_dir and self.excludes_name(parts[-1]):
+            return 'pattern'
+        return None
+
+    def pathspecs(self):
+        """
+        git pathspecs that keep git from descending into excluded directories.
+        """
+        return [f':(exclude,glob)**/{name}/**' for name in sorted(self.exclude_dirs)]
+
+
+@functools.lru_cache(maxsize=16)
+def _compile_exclusions(exclude_dirs, exclude_patterns):
+    return ExclusionMatcher(exclude_dirs, exclude_patterns)
+
+
+def compile_exclusions(exclude_dirs, exclude_patterns):
+    """
+    Get the ExclusionMatcher for the given rules. Matchers are cached, so repeated calls do not recompile.
+    """
+    return _compile_exclusions(tuple(exclude_dirs or ()), tuple(exclude_patterns or ()))
+
+
+StatusEntry = namedtuple('StatusEntry', ['kind', 'path', 'orig_path'])
+
+
+def run_git(args, repo_path, **kwargs):
+    """
+    Run a git command in repo_path, capturing its output, and count it in the run metrics.
+    """
+    start = time.perf_counter()
+    try:
+        return subprocess.run(['git'] + args, capture_output=True, cwd=repo_path, **kwargs)
+    finally:
+        metrics.count('subprocess_count')
+        metrics.count('subprocess_seconds', time.perf_counter() - start)
+
+
+def iter_nul_separated(stream, chunk_size=65536):
+    """
+    Yield the NUL separated records of a binary stream as they arrive.
+    """
+    pending = b''
+    for chunk in iter(lambda: stream.read1(chunk_size), b''):
+        records = (pending + chunk).split(b'\0')
+        pending = records.pop()
+        yield from records
+    if pending:
+        yield pending
+
+
+def parse_status_records(records):
+    """
+    Parse the records of `git status --porcelain=v2 -z` into StatusEntry tuples.
+    Kinds are modified, staged, deleted, renamed, unmerged, untracked and ignored.
+    """
+    records = iter(records)
+    for record in records:
+        if not record or record.startswith(b'#'):
+            continue
+        entry_type = record[:1]
+        if entry_type in (b'?', b'!'):
+            kind = 'untracked' if entry_type == b'?' else 'ignored'
+            yield StatusEntry(kind, os.fsdecode(record[2:]), None)
+        elif entry_type == b'1':
+            fields = record.split(b' ', 8)
+            xy = fields[1]
+            if b'D' in xy:
+                kind = 'deleted'
+            elif xy[1:2] != b'.':
+                kind = 'modified'
+            else:
+                kind = 'staged'
+            yield StatusEntry(kind, os.fsdecode(fields[8]), None)
+        elif entry_type == b'2':
+            fields = record.split(b' ', 9)
+            orig_path = next(records, b'')
+            yield StatusEntry('renamed', os.fsdecode(fields[9]), os.fsdecode(orig_path))
+        elif entry_type == b'u':
+            fields = record.split(b' ', 10)
+            yield StatusEntry('unmerged', os.fsdecode(fields[10]), None)
+
+
+def iter_git_output(args, repo_path, description):
+    """
+    Run git and yield the NUL separated records of its output while git is still writing it.
+    Raises RuntimeError if git fails, description says what failed.
+    stderr goes to a temporary file: a pipe that is only read after stdout could fill up and block git.
+    """
+    start = time.perf_counter()
+    with tempfile.TemporaryFile() as stderr_file:
+        process = subprocess.Popen(['git'] + args, stdout=subprocess.PIPE, stderr=stderr_file, cwd=repo_path)
+        try:
+            yield from iter_nul_separated(process.stdout)
+        finally:
+            process.stdout.close()
+            returncode = process.wait()
+            metrics.count('subprocess_count')
+            metrics.count('subprocess_seconds', time.perf_counter() - start)
+        stderr_file.seek(0)
+        stderr = stderr_file.read()
+    if returncode != 0:
+        raise RuntimeError(f"Failed to {description} in {repo_path}: {os.fsdecode(stderr).strip()}")
+
+
+def iter_git_status(repo_path, matcher=None, paths=None):
+    """
+    Run a single `git status` for untracked, ignored and changed files and yield StatusEntry tuples while
+    git is still writing its output. Paths are relative to the repository root and decoded with os.fsdecode,
+    so names that are not valid UTF-8 still map back to the original file.
+    If a matcher is given, git does not descend into excluded directories.
+    If paths are given, only these files and directories are looked at.
+    """
+    pathspecs = [f':(literal){path}' for path in paths or []]
+    pathspecs += matcher.pathspecs() if matcher else []
+    yield from parse_status_records(iter_git_output(['status', '--porcelain=v2', '-z', '--ignored=matching',
+                                                     '--untracked-files=all', '--'] + pathspecs,
+                                                    repo_path, 'get uncommitted files'))
+
+
+def iter_uncommitted_files(repo_path, matcher=None):
+    """
+    Yield the uncommitted files of a git repository while git status is still running,
+    with untracked directories expanded to their files.
+    If a matcher is given, excluded files are dropped and excluded directories are never entered.
+    """
+    entries = iter_git_status(repo_path, matcher)
+    yield from iter_expanded(repo_path, (entry.path for entry in entries if entry.kind != 'deleted'), matcher)
+
+
+def get_uncommitted_files(repo_path, matcher=None):
     """
     Get a list of uncommitted files in a git repository.
+    If a matcher is given, excluded files are dropped and excluded directories are never entered.
     """
+    return list(iter_uncommitted_files(repo_path, matcher))
+
+
+def iter_unique(paths):
+    """
+    Yield every path once. Seen paths are kept as 16 byte digests, which take less memory than the paths.
+    """
+    seen = set()
+    for path in paths:
+        key = hashlib.blake2b(os.fsencode(path), digest_size=16).digest()
+        if key not in seen:
+            seen.add(key)
+            yield path
+
+
+def get_head_commit(repo_path):
+    """
+    Get the commit id of HEAD or None if the repository has no commits yet.
+    """
+    result = run_git(['rev-parse', '--verify', '--quiet', 'HEAD'], repo_path, text=True)
+    return result.stdout.strip() or None
+
+
+def get_unpushed_range(repo_path):
+    """
+    Get the git log revision arguments that select unpushed commits.
+    Uses @{upstream}..HEAD if the current branch tracks a remote branch, otherwise all commits that are
+    not reachable from any remote branch.
+    """
+    result = run_git(['rev-parse', '--verify', '--quiet', '@{upstream}'], repo_path, text=True)
+    if result.returncode == 0:
+        return ['HEAD', '--not', '@{upstream}']
+    return ['HEAD', '--not', '--remotes']
+
+
+def iter_unpushed_files(repo_path, since=None, matcher=None):
+    """
+    Yield the files touched by unpushed commits of a git repository while git log is still running.
+    A file touched by several commits is yielded for every commit, see iter_unique.
+    If since is given, commits reachable from that commit are treated as already processed.
+    If a matcher is given, excluded files are dropped.
+    """
+    revisions = get_unpushed_range(repo_path)
+    if since:
+        revisions.append(since)
+    pathspecs = matcher.pathspecs() if matcher else []
+    records = iter_git_output(['log', '-z', '--name-only', '--pretty=format:'] + revisions + ['--'] + pathspecs,
+                              repo_path, 'get unpushed files')
+    yielded = False
     try:
-        os.chdir(repo_path)
-        # Get untracked and ignored files
-        result_untracked = subprocess.run(['git', 'ls-files', '--others', '--exclude-standard'], capture_output=True,
-                                          text=True)
-        result_ignored = subprocess.run(['git', 'ls-files', '--others', '--ignored', '--exclude-standard', '-o'],
-                                        capture_output=True, text=True)
-
-        untracked_files = result_untracked.stdout.splitlines()
-        ignored_files = result_ignored.stdout.splitlines()
-
-        # Get modified files
-        result_modified = subprocess.run(['git', 'status', '--porcelain'], capture_output=True, text=True)
-        modified_files = [line[3:] for line in result_modified.stdout.splitlines() if line.startswith(' M')]
-
-        # Combine all files
-        files = untracked_files + ignored_files + modified_files
-
-        # Expand directories to list all untracked files
-        all_files = []
-        for file in files:
-            path = Path(file)
-            if path.is_file():
-                all_files.append(file)
-            elif path.is_dir():
-                for sub_file in path.rglob('*'):
-                    if sub_file.is_file():
-                        all_files.append(str(sub_file))
-        return all_files
-    except subprocess.CalledProcessError as e:
-        raise RuntimeError(f"Failed to get uncommitted files in {repo_path}: {e}")
-
-
-def get_unpushed_files(repo_path):
+        for file in iter_expanded(repo_path, (os.fsdecode(record) for record in records if record), matcher):
+            yielded = True
+            yield file
+    except RuntimeError:
+        # git log fails on its arguments before it writes anything
+        if yielded:
+            raise
+        if since:
+            # The commit of the last run might be gone (e.g. after a rebase and gc). Use the full range instead.
+            yield from iter_unpushed_files(repo_path, matcher=matcher)
+        elif get_head_commit(repo_path) is not None:
+            raise
+
+
+def get_unpushed_files(repo_path, since=None, matcher=None):
     """
     Get a list of unpushed files in a git repository.
+    If since is given, commits reachable from that commit are treated as already processed.
+    If a matcher is given, excluded files are dropped.
     """
-    try:
-        os.chdir(repo_path)
-        branch = subprocess.check_output(['git', 'rev-parse', '--abbrev-ref', 'HEAD']).strip().decode()
-        remote_branch = f'origin/{branch}'
-        result = subprocess.run(['git', 'log', '--name-only', '--pretty=format:'],
-                                capture_output=True, text=True)
-        files = set(result.stdout.splitlines())
-        files.discard('')  # Remove empty strings
-        # Expand directories to list all untracked files
-        all_files = []
-        for file in files:
-            path = Path(file)
-            if path.is_file():
-                all_files.append(file)
-            elif path.is_dir():
-                for sub_file in path.rglob('*'):
-                    if sub_file.is_file():
-                        all_files.append(str(sub_file))
-        return list(all_files)
-    except subprocess.CalledProcessError as e:
-        raise RuntimeError(f"Failed to get unpushed files in {repo_path}: {e}")
+    return list(iter_unique(iter_unpushed_files(repo_path, since, matcher)))
+
+
+def iter_candidate_files(repo_path, matcher=None, since=None, unpushed=True):
+    """
+    Yield every backup candidate of a repository once: the uncommitted files and, if unpushed is set,
+    the files touched by unpushed commits (since the given commit). Enumeration time is recorded as the
+    enumerate_uncommitted and enumerate_unpushed stages of the current repository.
+    """
+    candidates = metrics.timed_iter('enumerate_uncommitted', iter_uncommitted_files(repo_path, matcher))
+    if unpushed:
+        candidates = chain(candidates, metrics.timed_iter('enumerate_unpushed',
+                                                          iter_unpushed_files(repo_path, since, matcher)))
+    return metrics.counted('files_enumerated', iter_unique(candidates))
+
+
+def iter_expanded(repo_path, files, matcher=None):
+    """
+    Yield files and the files below directories, as paths relative to repo_path.
+    If a matcher is given, excluded files are dropped and excluded directories are not entered.
+    """
+    repo_path = Path(repo_path)
+    for file in files:
+        file = str(Path(file))
+        path = repo_path / file
+        if path.is_file():
+            if matcher is None or matcher.reason(file) is None:
+                yield file
+        elif path.is_dir():
+            if matcher is None or matcher.reason(file, is_dir=True) is None:
+                yield from walk_files(repo_path, file, matcher)
+
+
+def expand_directories(repo_path, files, matcher=None):
+    """
+    Expand directories to list all files below them. Paths are relative to repo_path.
+    If a matcher is given, excluded files are dropped and excluded directories are not entered.
+    """
+    return list(iter_expanded(repo_path, files, matcher))
+
+
+def walk_files(base_path, relative_dir, matcher=None):
+    """
+    Yield all files below a directory as paths relative to base_path.
+    Excluded directories are pruned with os.scandir before they are entered.
+    """
+    stack = [relative_dir]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(os.path.join(base_path, current)) as entries:
+                for entry in entries:
+                    relative_path = os.path.join(current, entry.name)
+                    if entry.is_dir(follow_symlinks=False):
+                        if matcher is None or not matcher.excludes_dir(entry.name):
+                            stack.append(relative_path)
+                    elif entry.is_file():
+                        if matcher is None or not matcher.excludes_name(entry.name):
+                            yield relative_path
+        except OSError:
+            continue
 
 
 def compute_file_hash(file_path):
@@ -128,84 +563,364 @@ def compute_file_hash(file_path):
     Compute the hash of a file.
     """
     hash_func = hashlib.sha256()
-    with open(file_path, 'rb') as f:
-        for chunk in iter(lambda: f.read(4096), b""):
+    with metrics.timer('hash_seconds'), open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(COPY_BUFFER_SIZE), b""):
             hash_func.update(chunk)
+            metrics.count('bytes_hashed', len(chunk))
     return hash_func.hexdigest()
 
 
-def copy_files(file_list, src_base_path, dst_base_path, exclude_patterns, exclude_dirs, min_size, max_size, logger,
-               test_mode=True):
+def copy_and_hash(src, dst):
     """
-    Copy files from the source base path to the destination base path
-    maintaining the directory structure and applying exclusions and size filters.
+    Stream src to dst through one large buffer and return the sha256 of the copied content.
+    """
+    hash_func = hashlib.sha256()
+    buffer = bytearray(COPY_BUFFER_SIZE)
+    view = memoryview(buffer)
+    total = 0
+    while True:
+        size = src.readinto(buffer)
+        if not size:
+            break
+        hash_func.update(view[:size])
+        dst.write(view[:size])
+        total += size
+    metrics.count('bytes_hashed', total)
+    metrics.count('bytes_copied', total)
+    return hash_func.hexdigest()
+
+
+def _kernel_copy(src_fd, dst_fd):
+    """
+    Copy src_fd to dst_fd without passing the data through Python: reflink (FICLONE) on btrfs/XFS,
+    then copy_file_range, then sendfile. Returns False if none of them works for these files.
+    """
+    if fcntl is not None and sys.platform.startswith('linux'):
+        try:
+            fcntl.ioctl(dst_fd, FICLONE, src_fd)
+            return True
+        except OSError:
+            pass
+    for name in ('copy_file_range', 'sendfile'):
+        if not hasattr(os, name):
+            continue
+        try:
+            offset = 0
+            while True:
+                if name == 'copy_file_range':
+                    copied = os.copy_file_range(src_fd, dst_fd, 8 * COPY_BUFFER_SIZE)
+                else:
+                    copied = os.sendfile(dst_fd, src_fd, offset, 8 * COPY_BUFFER_SIZE)
+                if not copied:
+                    return True
+                offset += copied
+        except OSError:
+            # Not supported for this file system pair, start over with the next method
+            os.lseek(src_fd, 0, os.SEEK_SET)
+            os.lseek(dst_fd, 0, os.SEEK_SET)
+            os.ftruncate(dst_fd, 0)
+    return False
+
+
+def copy_file(src_file, dst_file, compute_hash=False):
+    """
+    Copy a file with its metadata like shutil.copy2. The content is written to a temporary file next to the
+    destination which is then renamed, so the destination is never seen half written.
+    With compute_hash the source is read once and its sha256 is returned. Otherwise the copy is done by the
+    kernel where possible and None is returned.
     """
-    copied = 0
-    skipped = 0
-    for file in file_list:
+    dst_file = Path(dst_file)
+    with metrics.timer('copy_seconds'), open(src_file, 'rb') as src:
+        fd, tmp_name = tempfile.mkstemp(prefix=f'.{dst_file.name}.', suffix='.tmp', dir=dst_file.parent)
+        try:
+            with os.fdopen(fd, 'wb') as dst:
+                if compute_hash:
+                    digest = copy_and_hash(src, dst)
+                else:
+                    digest = None
+                    if not _kernel_copy(src.fileno(), dst.fileno()):
+                        shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+                    metrics.count('bytes_copied', os.fstat(dst.fileno()).st_size)
+            shutil.copystat(src_file, tmp_name)
+            os.replace(tmp_name, dst_file)
+        except BaseException:
+            try:
+                os.unlink(tmp_name)
+            except OSError:
+                pass
+            raise
+    return digest
+
+
+def check_destination(src_file, src_stat, dst_file, src_hash=None):
+    """
+    Decide from the destination file whether src_file has to be copied.
+    A src_hash computed before (e.g. for another destination) is used instead of hashing the source again.
+    Returns (needs_copy, log message and its arguments, source hash or None if it was not computed).
+    """
+    try:
+        dst_stat = dst_file.stat()
+    except FileNotFoundError:
+        return True, ("Copied %s to %s", src_file, dst_file), None
+
+    # Check file size and modification time first
+    if src_stat.st_size == dst_stat.st_size and src_stat.st_mtime == dst_stat.st_mtime:
+        return False, ("Skipped %s (destination file is up to date based on size and mtime)", src_file), None
+    if src_stat.st_size != dst_stat.st_size:
+        return True, ("Overwritten %s due to different size", dst_file), None
+
+    # Compute hash if size or mtime indicate a potential change
+    src_hash = src_hash or compute_file_hash(src_file)
+    if src_hash == compute_file_hash(dst_file):
+        return False, ("Skipped %s (destination file is up to date based on hash)", src_file), src_hash
+    return True, ("Overwritten %s due to different hash value", dst_file), src_hash
+
+
+def check_manifest(manifest, repo_name, file, src_file, src_stat, dst_file, src_hash=None):
+    """
+    Decide from the backup manifest whether src_file has to be copied. The destination is not touched.
+    A src_hash computed before is used instead of hashing the source again.
+    Returns (needs_copy, log message and its arguments, source hash or None if it was not computed).
+    """
+    entry = manifest.get(repo_name, file)
+    if entry is None:
+        return True, ("Copied %s to %s", src_file, dst_file), None
+    if entry.size == src_stat.st_size and entry.mtime_ns == src_stat.st_mtime_ns:
+        return False, ("Skipped %s (backup is up to date based on manifest)", src_file), None
+    if entry.size != src_stat.st_size:
+        return True, ("Overwritten %s due to different size", dst_file), None
+    src_hash = src_hash or compute_file_hash(src_file)
+    if src_hash == entry.hash:
+        return False, ("Skipped %s (backup is up to date based on hash)", src_file), src_hash
+    return True, ("Overwritten %s due to different hash value", dst_file), src_hash
+
+
+class ByteBudget:
+    """
+    Limit the bytes of the files that are copied at the same time. A file larger than the limit
+    is copied when nothing else is in flight.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, size):
+        with self._condition:
+            while self.in_flight and self.in_flight + size > self.limit:
+                self._condition.wait()
+            self.in_flight += size
+
+    def release(self, size):
+        with self._condition:
+            self.in_flight -= size
+            self._condition.notify_all()
+
+
+def check_copy(file, src_file, src_stat, dst_file, repo_name, test_mode, manifest=None, src_hash=None):
+    """
+    Decide whether src_file has to be copied to dst_file, from the manifest if given, otherwise from dst_file.
+    Returns (needs_copy, log message and its arguments, source hash or None, outcome and log records if no copy
+    is needed). A src_hash computed before is used instead of hashing the source again.
+    """
+    if manifest is not None:
+        needs_copy, message, src_hash = check_manifest(manifest, repo_name, file, src_file, src_stat, dst_file,
+                                                       src_hash)
+    else:
+        needs_copy, message, src_hash = check_destination(src_file, src_stat, dst_file, src_hash)
+    if needs_copy:
+        return True, message, src_hash, None
+    if manifest is not None and src_hash is not None and not test_mode:
+        # Content is unchanged, remember the new mtime so the next run does not hash again
+        manifest.record(repo_name, file, src_stat.st_size, src_stat.st_mtime_ns, src_hash)
+        return False, message, src_hash, ('skipped', [(logging.DEBUG, message, 'up_to_date')])
+    return False, message, src_hash, ('up_to_date', [(logging.DEBUG, message, 'up_to_date')])
+
+
+def _copy_file_entry(file, src_file, src_stat, dst_file, repo_name, test_mode, manifest, chunk_store, created_dirs):
+    """
+    Check and copy a single file for copy_files. Returns the outcome ('copied', 'skipped' or 'up_to_date')
+    and the (level, (message, args...), event) log records, so they can be logged in file order when files are
+    copied in parallel. Messages are only formatted when a handler writes them.
+    """
+    try:
+        if chunk_store is not None and src_stat.st_size >= chunk_store.threshold:
+            if chunk_store.is_current(repo_name, file, src_stat):
+                return 'skipped', [(logging.DEBUG, ("Skipped %s (unchanged since its last chunked version)", src_file),
+                                    'up_to_date')]
+            if test_mode:
+                return 'copied', [(logging.INFO, ("Storing %s as chunks. Test mode: %s", src_file, test_mode),
+                                   'chunked')]
+            written = chunk_store.store_file(repo_name, file, src_file, src_stat)
+            return 'copied', [(logging.INFO, ("Stored %s as chunks (%d of %d bytes written)", src_file, written,
+                                              src_stat.st_size), 'chunked')]
+
+        needs_copy, message, src_hash, result = check_copy(file, src_file, src_stat, dst_file, repo_name, test_mode,
+                                                           manifest)
+        if not needs_copy:
+            return result
+
+        records = [(logging.INFO, message, 'copied')]
+        if not test_mode:
+            if dst_file.parent not in created_dirs:
+                dst_file.parent.mkdir(parents=True, exist_ok=True)
+                created_dirs.add(dst_file.parent)
+            # Hash while copying if the manifest needs a hash that was not computed yet
+            copied_hash = copy_file(src_file, dst_file, compute_hash=manifest is not None and src_hash is None)
+            if manifest is not None:
+                manifest.record(repo_name, file, src_stat.st_size, src_stat.st_mtime_ns, src_hash or copied_hash)
+            if chunk_store is not None:
+                # The file dropped below the threshold: its chunked versions must not be restored any more
+                chunk_store.remove_file(repo_name, file)
+        return 'copied', records
+    except OSError as e:
+        return 'skipped', [(logging.ERROR, ("Failed to copy %s to %s: %s", src_file, dst_file, e), 'failed')]
+
+
+def process_files_in_order(file_list, src_base_path, matcher, min_size, max_size, process, finish, deadline=None,
+                           deferred=None, max_pending=FILES_IN_FLIGHT_PER_WORKER):
+    """
+    Apply the exclusions and size filters of copy_files to file_list and call process(file, src_file, src_stat)
+    for the other files. process returns a list of results, each a value or a Future of it.
+    finish(file, records, results) is called in the order of file_list, with the (level, message, event) log
+    records of the filters and the results once all of them are done. Files that were filtered have no results.
+    At most max_pending files are in progress or done but waiting for an earlier file, beyond that the next file
+    is only started when the first one is finished. Small files, which hardly count against a byte budget, can
+    therefore not pile up as Futures and results behind a slow large file.
+    If a deadline (a time.monotonic() value) is given, files that were not started when it passes are not
+    processed but appended to the list deferred. Files in progress are finished.
+    """
+    pending = deque()
+
+    def drain(wait=False):
+        while pending and (wait or len(pending) > max_pending or
+                           all(not isinstance(result, Future) or result.done() for result in pending[0][2])):
+            file, records, results = pending.popleft()
+            finish(file, records, [result.result() if isinstance(result, Future) else result for result in results])
+
+    file_iter = iter(file_list)
+    for file in file_iter:
+        if deadline is not None and time.monotonic() >= deadline:
+            deferred.extend(file for file in chain([file], file_iter) if not matcher.reason(file))
+            break
         src_file = Path(src_base_path) / file
+        filter_start = time.perf_counter()
 
-        # Skip files in excluded directories
-        if any(excluded in src_file.parts for excluded in exclude_dirs):
-            logger.debug(f"Skipped {src_file} (excluded by directory)")
-            skipped += 1
+        # Skip files in excluded directories or matching an excluded pattern
+        reason = matcher.reason(file)
+        if reason:
+            metrics.count('filter_seconds', time.perf_counter() - filter_start)
+            metrics.count('files_filtered')
+            pending.append((file, [(logging.DEBUG, ("Skipped %s (excluded by %s)", src_file, reason), 'excluded')], []))
+            drain()
             continue
 
-        if any(fnmatch.fnmatch(src_file.name, pattern) for pattern in exclude_patterns):
-            logger.debug(f"Skipped {src_file} (excluded by pattern)")
-            skipped += 1
+        try:
+            src_stat = src_file.stat()
+        except OSError as e:
+            pending.append((file, [(logging.ERROR, ("Failed to copy %s: %s", src_file, e), 'failed')], []))
+            drain()
             continue
-        if not (min_size <= src_file.stat().st_size <= max_size):
-            logger.debug(f"Skipped {src_file} (file size out of range)")
-            skipped += 1
+        metrics.count('filter_seconds', time.perf_counter() - filter_start)
+        if not (min_size <= src_stat.st_size <= max_size):
+            metrics.count('files_filtered')
+            pending.append((file, [(logging.DEBUG, ("Skipped %s (file size out of range)", src_file), 'filtered')],
+                            []))
+            drain()
             continue
 
-        dst_file = Path(dst_base_path) / file
-        dst_file.parent.mkdir(parents=True, exist_ok=True)
+        pending.append((file, [], process(file, src_file, src_stat)))
+        drain()
+    drain(wait=True)
+
+
+def log_file_events(logger, src_base_path, events, dst_base_path=None):
+    """
+    Log the summary of the file events of copy_files or of one destination of fan_out_files.
+    """
+    if not events:
+        return
+    summary = ', '.join(f'{count} {event}' for event, count in sorted(events.items()))
+    if dst_base_path is None:
+        logger.info("Files of %s: %s", src_base_path, summary)
+    else:
+        logger.info("Files of %s in %s: %s", src_base_path, dst_base_path, summary)
+
 
+def copy_files(file_list, src_base_path, dst_base_path, exclude_patterns, exclude_dirs, min_size, max_size, logger,
+               test_mode=True, manifest=None, chunk_store=None, workers=1, max_in_flight_bytes=64 * 1024 * 1024,
+               deadline=None, deferred=None):
+    """
+    Copy files from the source base path to the destination base path
+    maintaining the directory structure and applying exclusions and size filters.
+    If a manifest is given, up-to-date checks use the manifest instead of the destination files.
+    If a chunk store is given, files of at least its threshold are stored as chunks instead of being copied.
+    With more than one worker, files are checked and copied in a thread pool, with at most max_in_flight_bytes
+    of files in progress. Log records are written in the order of file_list either way. Every per-file record
+    carries a file event (see file_event), a summary of the events is logged at the end.
+    If a deadline (a time.monotonic() value) is given, files that were not started when it passes are not copied
+    but appended to the list deferred. Files in progress are completed.
+    """
+    matcher = compile_exclusions(exclude_dirs, exclude_patterns)
+    repo_name = Path(dst_base_path).name
+    totals = {'copied': 0, 'skipped': 0}
+    events = {}
+    up_to_date = []
+    # Destination directories created in this run, so siblings do not create them again
+    created_dirs = set()
+
+    def finish(file, records, results):
+        outcome, file_records = results[0] if results else ('skipped', [])
+        for level, message, event in chain(records, file_records):
+            logger.log(level, *message, extra=file_event(repo_name, file, event))
+            events[event] = events.get(event, 0) + 1
+        if outcome == 'up_to_date':
+            up_to_date.append(file)
+            outcome = 'skipped'
+        totals[outcome] += 1
+
+    executor = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+    budget = ByteBudget(max_in_flight_bytes)
+    repo_metrics = metrics.current()
+
+    def copy_entry(file, src_file, src_stat, dst_file):
         try:
-            if dst_file.exists():
-                src_mtime = src_file.stat().st_mtime
-                dst_mtime = dst_file.stat().st_mtime
-                src_size = src_file.stat().st_size
-                dst_size = dst_file.stat().st_size
-
-                # Check file size and modification time first
-                if src_size == dst_size and src_mtime == dst_mtime:
-                    skipped += 1
-                    logger.debug(f"Skipped {src_file} (destination file is up to date based on size and mtime)")
-                    continue
-                else:
-                    # Compute hash if size or mtime indicate a potential change
-                    src_hash = compute_file_hash(src_file)
-                    dst_hash = compute_file_hash(dst_file)
-                    if src_hash == dst_hash:
-                        skipped += 1
-                        logger.debug(f"Skipped {src_file} (destination file is up to date based on hash)")
-                        continue
-                    else:
-                        copied += 1
-                        logger.info(f"Overwritten {dst_file} due to different hash value")
-            else:
-                copied += 1
-                logger.info(f"Copied {src_file} to {dst_file}")
+            with metrics.bind(repo_metrics):
+                return _copy_file_entry(file, src_file, src_stat, dst_file, repo_name, test_mode, manifest,
+                                        chunk_store, created_dirs)
+        finally:
+            budget.release(src_stat.st_size)
 
-            if not test_mode:
-                shutil.copy2(src_file, dst_file)
-        except OSError as e:
-            skipped += 1
-            logger.error(f"Failed to copy {src_file} to {dst_file}: {e}")
+    def process(file, src_file, src_stat):
+        dst_file = Path(dst_base_path) / file
+        budget.acquire(src_stat.st_size)
+        if executor is None:
+            return [copy_entry(file, src_file, src_stat, dst_file)]
+        return [executor.submit(copy_entry, file, src_file, src_stat, dst_file)]
 
+    try:
+        process_files_in_order(file_list, src_base_path, matcher, min_size, max_size, process, finish, deadline,
+                               deferred, FILES_IN_FLIGHT_PER_WORKER * workers)
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    copied, skipped = totals['copied'], totals['skipped']
+    if manifest is not None and not test_mode:
+        manifest.mark_seen(repo_name, up_to_date)
+    metrics.count('files_copied', copied)
+    metrics.count('files_skipped', skipped)
+    log_file_events(logger, src_base_path, events)
     return copied, skipped
 
 
-def delete_old_files(backup_root_path, repo_paths, delete_after_days, logger, test_mode=True):
+def iter_expired_files(backup_root_path, repo_paths, delete_after_days, logger):
     """
-    Delete files from the backup that do not exist in the source repository
-    if they are older than the specified number of days.
+    Yield the files in the backup that do not exist in the source repository
+    and are older than the specified number of days.
     """
     cutoff_date = datetime.now() - timedelta(days=delete_after_days)
-    deleted = 0
     for repo_path in repo_paths:
         repo_name = Path(repo_path).name
         backup_path = Path(backup_root_path) / repo_name
@@ -217,18 +932,184 @@ def delete_old_files(backup_root_path, repo_paths, delete_after_days, logger, te
 
                 try:
                     if not src_file_path.exists() and datetime.fromtimestamp(file_path.stat().st_mtime) < cutoff_date:
-                        if not test_mode:
-                            file_path.unlink()
-                        logger.info(
-                            f"Deleted {file_path} (no longer in source and older than {delete_after_days} days)."
-                            f"Test mode: {test_mode}")
-                        deleted += 1
+                        yield file_path
                 except OSError as e:
-                    logger.error(f"Failed to delete {file_path}: {e}")
+                    logger.error(f"Failed to check {file_path} for expiry: {e}")
+
+
+def delete_old_files(backup_root_path, repo_paths, delete_after_days, logger, test_mode=True):
+    """
+    Delete files from the backup that do not exist in the source repository
+    if they are older than the specified number of days.
+    """
+    deleted = 0
+    for file_path in iter_expired_files(backup_root_path, repo_paths, delete_after_days, logger):
+        try:
+            if not test_mode:
+                file_path.unlink()
+            logger.info(
+                f"Deleted {file_path} (no longer in source and older than {delete_after_days} days)."
+                f"Test mode: {test_mode}")
+            deleted += 1
+        except OSError as e:
+            logger.error(f"Failed to delete {file_path}: {e}")
 
     return deleted
 
 
+class StateFile:
+    """
+    JSON file that keeps small pieces of per-repository state between runs.
+    Access is thread safe, changes are written on save().
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        try:
+            self.data = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            self.data = {}
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self.data.get(key, default)
+
+    def set(self, key, value):
+        with self._lock:
+            self.data[key] = value
+
+    def save(self):
+        with self._lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_name(self.path.name + '.tmp')
+            tmp_path.write_text(json.dumps(self.data, indent=2, sort_keys=True))
+            os.replace(tmp_path, self.path)
+
+
+class RepoFingerprints:
+    """
+    Fingerprints of the repositories taken at their last complete backup, kept in a StateFile.
+    A fingerprint covers all refs (HEAD, branches, upstream), size and mtime of the git index and of the
+    working tree paths that held backup candidates. A repository whose fingerprint did not change is not
+    scanned again, except every force_rescan_seconds.
+    """
+
+    def __init__(self, path, force_rescan_seconds):
+        self.state = StateFile(path)
+        self.force_rescan_seconds = force_rescan_seconds
+
+    def is_unchanged(self, key, repo_path, settings_key):
+        cached = self.state.get(key)
+        if not cached or time.time() - cached['scanned'] >= self.force_rescan_seconds:
+            return False
+        return get_repo_fingerprint(repo_path, cached['paths'], settings_key) == cached['fingerprint']
+
+    def track(self, repo_path, files):
+        """
+        Return a FingerprintTracker to pass the candidate files of a repository through while they are backed up.
+        """
+        return FingerprintTracker(repo_path, files)
+
+    def update(self, key, tracker, settings_key):
+        """
+        Take the fingerprint of a repository from a tracker whose candidates were all backed up.
+        """
+        paths = fingerprint_paths(tracker.files)
+        fingerprint = get_repo_fingerprint(tracker.repo_path, paths, settings_key, tracker.refs, tracker.states)
+        self.state.set(key, {'fingerprint': fingerprint, 'paths': paths, 'scanned': time.time()})
+
+    def remove(self, key):
+        self.state.set(key, None)
+
+    def save(self):
+        self.state.save()
+
+
+class FingerprintTracker:
+    """
+    Pass the candidate files of a repository through while recording the state of every file and its directory
+    when it is enumerated, before it is backed up. Changes made while a file is backed up then show up as
+    a different fingerprint in the next run.
+    """
+
+    def __init__(self, repo_path, files):
+        self.repo_path = repo_path
+        self.refs = get_repo_refs(repo_path)
+        self.states = {'': get_path_state(repo_path)}
+        self.files = []
+        self._files = files
+
+    def __iter__(self):
+        for file in self._files:
+            directory = os.path.dirname(file)
+            if directory not in self.states:
+                self.states[directory] = get_path_state(os.path.join(self.repo_path, directory))
+            self.states[file] = get_path_state(os.path.join(self.repo_path, file))
+            self.files.append(file)
+            yield file
+
+
+def fingerprint_paths(files):
+    """
+    Return the working tree paths a repository fingerprint covers: the candidate files, the directories that
+    hold them (a new or renamed file changes the directory mtime) and the working tree root.
+    """
+    directories = {''} | {os.path.dirname(file) for file in files}
+    return sorted(directories) + sorted(files)
+
+
+def get_git_dir(repo_path):
+    git_path = Path(repo_path) / '.git'
+    if git_path.is_file():
+        # Worktrees and submodules have a .git file that points to the git directory
+        content = git_path.read_text().strip()
+        if content.startswith('gitdir:'):
+            return Path(repo_path) / content[len('gitdir:'):].strip()
+    return git_path
+
+
+def get_repo_refs(repo_path):
+    """
+    Return the output of one git call that lists all refs including HEAD and the upstream branch.
+    """
+    result = run_git(['show-ref', '--head'], repo_path)
+    if result.returncode not in (0, 1):  # 1: no refs yet
+        raise RuntimeError(f"Error running git show-ref in {repo_path}: "
+                           f"{result.stderr.decode(errors='replace').strip()}")
+    return result.stdout
+
+
+def get_path_state(path):
+    try:
+        stat = os.stat(path)
+        return f'{stat.st_size}:{stat.st_mtime_ns}'
+    except OSError:
+        return '-'
+
+
+def get_repo_fingerprint(repo_path, paths, settings_key='', refs=None, states=None):
+    """
+    Build a fingerprint of a repository from its refs and the size and mtime of the git index and the given
+    working tree paths (relative to repo_path). refs and the states of paths are looked up unless given.
+    """
+    states = states or {}
+    fingerprint = hashlib.sha256(settings_key.encode())
+    fingerprint.update(get_repo_refs(repo_path) if refs is None else refs)
+    fingerprint.update(f'\0index\0{get_path_state(get_git_dir(repo_path) / "index")}'.encode())
+    for path in paths:
+        state = states[path] if path in states else get_path_state(os.path.join(repo_path, path))
+        fingerprint.update(f'\0{path}\0{state}'.encode(errors='surrogateescape'))
+    return fingerprint.hexdigest()
+
+
+def get_state_dir(backup_root_path):
+    """
+    Get the directory below the backup root that holds state between runs.
+    """
+    return Path(backup_root_path) / '.state'
+
+
 def validate_paths(paths):
     for path in paths:
         if not Path(path).exists():
@@ -237,8 +1118,12 @@ def validate_paths(paths):
             raise NotADirectoryError(f"Not a directory: {path}")
 
 
-def check_free_space(path, required_space):
+def get_free_space(path):
     statvfs = os.statvfs(path)
-    free_space = statvfs.f_frsize * statvfs.f_bavail
+    return statvfs.f_frsize * statvfs.f_bavail
+
+
+def check_free_space(path, required_space):
+    free_space = get_free_space(path)
     if free_space < required_space:
         raise OSError(f"Not enough free space on device: {path}. Required: {required_space}, Available: {free_space}")
@@ -0,0 +1,305 @@
+import os
+import sys
+import time
+import select
+import struct
+import threading
+import ctypes
+import ctypes.util
+from pathlib import Path
+from git_backup_notifier.backup import get_settings, open_state, repository_backup_func, process_repositories, \
+    open_chunk_store, resolve_repo_paths, setup_run_logger, open_extra_destinations, close_extra_destinations
+from git_backup_notifier.fanout import fan_out_files
+from git_backup_notifier.utils import validate_paths, compile_exclusions, iter_git_status, \
+    expand_directories, copy_files, walk_files
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT_HEADER = struct.Struct('iIII')
+
+# Marker for a repository that needs a full scan instead of looking at single paths
+FULL_SCAN = None
+# More changed paths than this are handled by a full scan of the repository
+MAX_CHANGED_PATHS = 1000
+
+
+class InotifyWatcher:
+    """
+    Watch the working trees of repositories with inotify (Linux only). Excluded directories are not watched.
+    read_events returns (repo_path, relative path) tuples, relative path is FULL_SCAN if events were lost
+    or a new directory could not be watched (e.g. max_user_watches reached).
+    """
+
+    def __init__(self, repo_paths, matcher, logger=None):
+        self.repo_paths = list(repo_paths)
+        self._matcher = matcher
+        self._logger = logger
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"inotify_init1 failed: {os.strerror(errno)}")
+        self._watches = {}
+        try:
+            for repo_path in self.repo_paths:
+                self._add_tree(repo_path, '')
+        except OSError:
+            self.close()
+            raise
+
+    def _add_watch(self, repo_path, relative_dir):
+        path = os.path.join(repo_path, relative_dir)
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            if errno == 2:  # ENOENT: removed in the meantime
+                return
+            raise OSError(errno, f"inotify_add_watch failed: {os.strerror(errno)}", path)
+        self._watches[wd] = (repo_path, relative_dir)
+
+    def _add_tree(self, repo_path, relative_dir):
+        self._add_watch(repo_path, relative_dir)
+        stack = [relative_dir]
+        while stack:
+            current = stack.pop()
+            try:
+                with os.scandir(os.path.join(repo_path, current)) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False) and not self._matcher.excludes_dir(entry.name):
+                            relative_path = os.path.join(current, entry.name)
+                            self._add_watch(repo_path, relative_path)
+                            stack.append(relative_path)
+            except FileNotFoundError:
+                continue
+
+    def read_events(self, timeout):
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return []
+        events = []
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                name = os.fsdecode(data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0'))
+                offset += EVENT_HEADER.size + length
+                if mask & IN_Q_OVERFLOW:
+                    events.extend((repo_path, FULL_SCAN) for repo_path in self.repo_paths)
+                    continue
+                if mask & IN_IGNORED:
+                    self._watches.pop(wd, None)
+                    continue
+                if wd not in self._watches or not name:
+                    continue
+                repo_path, relative_dir = self._watches[wd]
+                relative_path = os.path.join(relative_dir, name)
+                if mask & IN_ISDIR:
+                    if self._matcher.excludes_dir(name):
+                        continue
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        try:
+                            self._add_tree(repo_path, relative_path)
+                        except OSError as e:
+                            # Changes below the directory are only found by the full scans until the next reconcile
+                            if self._logger:
+                                self._logger.warning(f"Cannot watch {os.path.join(repo_path, relative_path)}: {e}")
+                            events.append((repo_path, FULL_SCAN))
+                            continue
+                elif self._matcher.excludes_name(name):
+                    continue
+                events.append((repo_path, relative_path))
+        return events
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+class PollingWatcher:
+    """
+    Fallback watcher that compares size and mtime of all files in the working trees every poll_interval seconds.
+    """
+
+    def __init__(self, repo_paths, matcher, poll_interval=5):
+        self.repo_paths = list(repo_paths)
+        self._matcher = matcher
+        self._poll_interval = poll_interval
+        self._state = {repo_path: self._scan(repo_path) for repo_path in self.repo_paths}
+        self._next_poll = time.monotonic() + poll_interval
+
+    def _scan(self, repo_path):
+        state = {}
+        for relative_path in walk_files(repo_path, '', self._matcher):
+            try:
+                stat = os.stat(os.path.join(repo_path, relative_path))
+                state[relative_path] = (stat.st_size, stat.st_mtime_ns)
+            except OSError:
+                continue
+        return state
+
+    def read_events(self, timeout):
+        wait = self._next_poll - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return []
+        time.sleep(max(0, wait))
+        self._next_poll = time.monotonic() + self._poll_interval
+        events = []
+        for repo_path in self.repo_paths:
+            old_state = self._state[repo_path]
+            new_state = self._scan(repo_path)
+            changed = {path for path in old_state.keys() | new_state.keys()
+                       if old_state.get(path) != new_state.get(path)}
+            events.extend((repo_path, path) for path in sorted(changed))
+            self._state[repo_path] = new_state
+        return events
+
+    def close(self):
+        pass
+
+
+def create_watcher(repo_paths, matcher, poll_interval, logger):
+    """
+    Use inotify where available and fall back to polling otherwise.
+    """
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(repo_paths, matcher, logger)
+        except (OSError, AttributeError) as e:
+            logger.warning(f"inotify is not available ({e}), falling back to polling every {poll_interval}s")
+    return PollingWatcher(repo_paths, matcher, poll_interval)
+
+
+def is_within(path, changed_paths):
+    """
+    Check whether path or one of its parent directories is in changed_paths.
+    """
+    if path in changed_paths:
+        return True
+    return any(str(parent) in changed_paths for parent in Path(path).parents)
+
+
+def backup_changed_paths(repo_path, changed_paths, settings, backup, manifest, snapshot_store, logger,
+                         extra_destinations=None):
+    """
+    Backup the files of a repository that changed. Changed paths that are not uncommitted
+    (e.g. files restored by a checkout) are left alone. With extra_destinations the files are written to
+    all destinations from one read. Returns the number of copied and skipped files.
+    """
+    if changed_paths is FULL_SCAN or len(changed_paths) > MAX_CHANGED_PATHS or settings['storage_mode'] != 'mirror':
+        # Snapshots and archives always describe all files of a repository
+        return backup(repo_path, logger)
+
+    matcher = compile_exclusions(settings['exclude_dirs'], settings['exclude_patterns'])
+    try:
+        candidates = [entry.path for entry in iter_git_status(repo_path, matcher, paths=sorted(changed_paths))
+                      if entry.kind != 'deleted']
+    except RuntimeError as e:
+        logger.error(e)
+        return 0, 0
+    files = [file for file in expand_directories(repo_path, candidates, matcher) if is_within(file, changed_paths)]
+    if extra_destinations:
+        repo_name = Path(repo_path).name
+        destinations = [(Path(settings['backup_root_path']) / repo_name, manifest)] + \
+            [(Path(destination.path) / repo_name, destination.manifest) for destination in extra_destinations]
+        return fan_out_files(files, repo_path, destinations, settings['exclude_patterns'], settings['exclude_dirs'],
+                             settings['min_file_size'], settings['max_file_size'], logger, settings['test_mode'],
+                             settings['copy_workers'], settings['copy_max_in_flight_bytes'])
+    return copy_files(files, repo_path, Path(settings['backup_root_path']) / Path(repo_path).name,
+                      settings['exclude_patterns'], settings['exclude_dirs'], settings['min_file_size'],
+                      settings['max_file_size'], logger, settings['test_mode'], manifest, open_chunk_store(settings),
+                      settings['copy_workers'], settings['copy_max_in_flight_bytes'])
+
+
+def watch_repositories(config, source_path=None, destination_path=None, stop_event=None):
+    """
+    Keep backing up the repositories while they change. Changes are collected until no new change arrived
+    for debounce_seconds (or max_delay_seconds passed), then only the changed paths are looked at.
+    A full backup of all repositories runs at start and every reconcile_interval seconds to catch missed events.
+    Runs until stop_event is set.
+    """
+    settings = get_settings(config, source_path, destination_path)
+    watch_settings = config.get('WatchSettings', {})
+    debounce = watch_settings.get('debounce_seconds', 2)
+    max_delay = watch_settings.get('max_delay_seconds', 30)
+    reconcile_interval = watch_settings.get('reconcile_interval', 3600)
+    poll_interval = watch_settings.get('poll_interval', 5)
+    stop_event = stop_event or threading.Event()
+
+    validate_paths(settings['backup_root_paths'] + settings['repo_paths'] + settings['discover_roots'])
+    logger = setup_run_logger(settings)
+    repo_paths = resolve_repo_paths(settings, logger)
+
+    # Changes inside .git (e.g. the index written by git status) never lead to a backup
+    watch_matcher = compile_exclusions(list(settings['exclude_dirs']) + ['.git'], settings['exclude_patterns'])
+    watcher = create_watcher(repo_paths, watch_matcher, poll_interval, logger)
+    cursors, manifest, snapshot_store, archive_store = open_state(settings)
+    extra_destinations = open_extra_destinations(settings)
+    backup = repository_backup_func(settings, cursors, manifest, snapshot_store, archive_store=archive_store,
+                                    extra_destinations=extra_destinations)
+
+    def save_state():
+        if cursors is not None:
+            cursors.save()
+        if manifest is not None:
+            manifest.commit()
+        for destination in extra_destinations:
+            if destination.manifest is not None:
+                destination.manifest.commit()
+
+    def reconcile():
+        results = process_repositories(repo_paths, settings['workers'], logger, backup)
+        save_state()
+        logger.info(f"Full backup completed: {sum(copied for copied, _ in results)} files copied.")
+
+    pending = {}
+    first_event = last_event = None
+    try:
+        logger.info(f"Watching {len(repo_paths)} repositories with {type(watcher).__name__}")
+        reconcile()
+        next_reconcile = time.monotonic() + reconcile_interval
+        while not stop_event.is_set():
+            events = watcher.read_events(timeout=min(debounce, 1.0))
+            now = time.monotonic()
+            for repo_path, relative_path in events:
+                if relative_path is FULL_SCAN:
+                    pending[repo_path] = FULL_SCAN
+                elif pending.get(repo_path, ()) is not FULL_SCAN:
+                    pending.setdefault(repo_path, set()).add(relative_path)
+                first_event = first_event or now
+                last_event = now
+
+            if pending and (now - last_event >= debounce or now - first_event >= max_delay):
+                copied = 0
+                for repo_path, changed_paths in pending.items():
+                    copied += backup_changed_paths(repo_path, changed_paths, settings, backup, manifest,
+                                                   snapshot_store, logger, extra_destinations)[0]
+                save_state()
+                logger.info(f"Incremental backup completed: {copied} files copied.")
+                pending.clear()
+                first_event = last_event = None
+
+            if now >= next_reconcile:
+                reconcile()
+                next_reconcile = time.monotonic() + reconcile_interval
+    finally:
+        watcher.close()
+        if cursors is not None:
+            cursors.save()
+        if manifest is not None:
+            manifest.close()
+        close_extra_destinations(extra_destinations)
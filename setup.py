@@ -9,6 +9,9 @@ setup(
         'requests',
         'plyer',
     ],
+    extras_require={
+        'zstd': ['zstandard'],
+    },
     entry_points={
         'console_scripts': [
             'git-backup-notifier=git_backup_notifier.backup:main',
@@ -0,0 +1,101 @@
+import logging
+import tarfile
+import tempfile
+import shutil
+import subprocess
+from pathlib import Path
+import pytest
+from git_backup_notifier import archives
+from git_backup_notifier.archives import ArchiveStore, archive_files, restore_archive
+from git_backup_notifier.backup import backup_uncommitted_files
+from git_backup_notifier.utils import load_config
+
+
+@pytest.fixture
+def setup_dirs():
+    temp_dir = tempfile.mkdtemp()
+    src = Path(temp_dir) / 'src'
+    (src / 'subdir').mkdir(parents=True)
+    (src / 'file1.txt').write_text('one')
+    (src / 'subdir' / 'file2.txt').write_text('two' * 1000)
+    (src / 'large.bin').write_bytes(bytes(range(256)) * 400)
+    (src / 'debug.log').write_text('excluded')
+
+    yield Path(temp_dir), src
+
+    shutil.rmtree(temp_dir)
+
+
+def test_archive_and_restore(setup_dirs, monkeypatch):
+    temp_dir, src = setup_dirs
+    # Small frames, so files start in different frames
+    monkeypatch.setattr(archives, 'FRAME_SIZE', 4096)
+    logger = logging.getLogger('test_archives')
+    store = ArchiveStore.for_backup_root(temp_dir / 'backup')
+    files = ['file1.txt', 'subdir/file2.txt', 'large.bin', 'debug.log']
+
+    assert archive_files(files, src, store, 'src', ['*.log'], [], 0, 1000000, logger, False) == (3, 1)
+    # Nothing changed: no new archive
+    assert archive_files(files, src, store, 'src', ['*.log'], [], 0, 1000000, logger, False) == (0, 4)
+    assert len(store.list_archives('src')) == 1
+
+    # A regular tar.gz
+    index = store.load_index('src')
+    with tarfile.open(store.root_path / 'src' / index['archive']) as tar:
+        assert sorted(tar.getnames()) == ['file1.txt', 'large.bin', 'subdir/file2.txt']
+    assert len({entry['frame'] for entry in index['files'].values()}) > 1
+
+    # Single files are extracted from their frame
+    target = temp_dir / 'restore'
+    assert restore_archive(store, 'src', target, logger, files=['subdir/file2.txt', 'large.bin']) == 2
+    assert (target / 'subdir' / 'file2.txt').read_text() == 'two' * 1000
+    assert (target / 'large.bin').read_bytes() == (src / 'large.bin').read_bytes()
+    assert not (target / 'file1.txt').exists()
+
+    assert restore_archive(store, 'src', target, logger) == 3
+    assert (target / 'file1.txt').read_text() == 'one'
+
+
+def test_archive_skips_file_removed_before_it_is_read(setup_dirs, monkeypatch):
+    temp_dir, src = setup_dirs
+    logger = logging.getLogger('test_archives')
+    store = ArchiveStore.for_backup_root(temp_dir / 'backup')
+    write_archive = store.write_archive
+
+    def remove_then_write(*args, **kwargs):
+        # The file was selected (stat) but is gone when its content is read
+        (src / 'file1.txt').unlink()
+        return write_archive(*args, **kwargs)
+    monkeypatch.setattr(store, 'write_archive', remove_then_write)
+
+    assert archive_files(['file1.txt', 'large.bin'], src, store, 'src', [], [], 0, 1000000, logger, False) == (1, 1)
+    assert list(store.load_index('src')['files']) == ['large.bin']
+
+
+def test_archive_keeps_unpushed_files_with_cursor(setup_dirs):
+    temp_dir, src = setup_dirs
+    subprocess.run(['git', 'init'], cwd=src, check=True)
+    subprocess.run(['git', 'add', 'file1.txt'], cwd=src, check=True)
+    subprocess.run(['git', 'commit', '-m', 'Unpushed commit'], cwd=src, check=True)
+    backup_path = temp_dir / 'backup'
+    backup_path.mkdir()
+    config = load_config('config/default.toml', 'config/test_config.toml')
+    config['BackupSettings'].update({'backup_root_path': str(backup_path), 'storage_mode': 'archive',
+                                     'unpushed_cursor': True})
+    config['Repositories']['repo_paths'] = [str(src)]
+    config['Exclusions']['exclude_patterns'] = ['*.log', '*.bin']
+    config['GeneralSettings']['test_mode'] = False
+    store = ArchiveStore.for_backup_root(backup_path)
+
+    backup_uncommitted_files(config)
+    assert sorted(store.load_index('src')['files']) == ['file1.txt', 'subdir/file2.txt']
+
+    # HEAD did not move: the file of the unpushed commit is still part of the next archive
+    (src / 'subdir' / 'file2.txt').write_text('changed')
+    backup_uncommitted_files(config)
+    assert len(store.list_archives('src')) == 2
+    assert sorted(store.load_index('src')['files']) == ['file1.txt', 'subdir/file2.txt']
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
@@ -1,4 +1,5 @@
 import os
+import json
 import shutil
 import tempfile
 from pathlib import Path
@@ -87,5 +88,83 @@ def test_backup(setup_test_environment):
     assert not errors, "Errors occurred:\n{}".format("\n".join(errors))
 
 
+def test_backup_parallel(setup_test_environment):
+    temp_dir, test_dirs = setup_test_environment
+
+    config = load_config('config/default.toml', 'config/test_config.toml')
+    backup_path = Path(temp_dir) / 'backup_parallel'
+    backup_path.mkdir(exist_ok=True)
+    config['BackupSettings']['backup_root_path'] = str(backup_path)
+    config['Repositories']['repo_paths'] = [str(dir) for dir in test_dirs]
+    config['GeneralSettings']['workers'] = 4
+    cwd = os.getcwd()
+
+    try:
+        backup_uncommitted_files(config)
+    except SystemExit:
+        pass
+
+    assert os.getcwd() == cwd
+    assert (backup_path / 'repo1' / 'subdir' / 'file3.txt').exists()
+    assert (backup_path / 'repo2' / 'file4.txt').exists()
+    assert not (backup_path / 'repo2' / 'venv' / 'dummy_file.txt').exists()
+
+
+def test_backup_skips_unchanged_repositories(setup_test_environment):
+    temp_dir, test_dirs = setup_test_environment
+
+    config = load_config('config/default.toml', 'config/test_config.toml')
+    backup_path = Path(temp_dir) / 'backup_fingerprints'
+    backup_path.mkdir(exist_ok=True)
+    config['BackupSettings']['backup_root_path'] = str(backup_path)
+    config['BackupSettings']['skip_unchanged'] = True
+    config['Repositories']['repo_paths'] = [str(test_dirs[0])]
+    report_path = backup_path / 'backuplog' / 'run_report.json'
+
+    def backup_stages():
+        try:
+            backup_uncommitted_files(config)
+        except SystemExit:
+            pass
+        return json.loads(report_path.read_text())['repositories']['repo1']['stages']
+
+    assert 'copy' in backup_stages()
+    assert (backup_path / 'repo1' / 'file2.txt').exists()
+
+    # Nothing changed: the repository is not scanned
+    assert 'copy' not in backup_stages()
+
+    # A new file in a directory that held candidates
+    (test_dirs[0] / 'subdir' / 'new_file.txt').write_text('new')
+    try:
+        assert 'copy' in backup_stages()
+        assert (backup_path / 'repo1' / 'subdir' / 'new_file.txt').exists()
+    finally:
+        (test_dirs[0] / 'subdir' / 'new_file.txt').unlink()
+
+
+def test_backup_retries_unpushed_files_that_failed(setup_test_environment):
+    temp_dir, test_dirs = setup_test_environment
+
+    config = load_config('config/default.toml', 'config/test_config.toml')
+    backup_path = Path(temp_dir) / 'backup_cursor'
+    # A directory where the committed file would be copied to: the copy fails
+    (backup_path / 'repo1' / 'file1.txt').mkdir(parents=True)
+    config['BackupSettings']['backup_root_path'] = str(backup_path)
+    config['BackupSettings']['unpushed_cursor'] = True
+    config['Repositories']['repo_paths'] = [str(test_dirs[0])]
+    config['GeneralSettings']['test_mode'] = False
+    cursors_path = backup_path / '.state' / 'unpushed_cursors.json'
+
+    backup_uncommitted_files(config)
+    assert str(test_dirs[0].resolve()) not in json.loads(cursors_path.read_text())
+
+    # HEAD did not move, the file of the unpushed commit is copied by the next run
+    (backup_path / 'repo1' / 'file1.txt').rmdir()
+    backup_uncommitted_files(config)
+    assert (backup_path / 'repo1' / 'file1.txt').is_file()
+    assert str(test_dirs[0].resolve()) in json.loads(cursors_path.read_text())
+
+
 if __name__ == '__main__':
     pytest.main([__file__])
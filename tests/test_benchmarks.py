@@ -0,0 +1,26 @@
+import pytest
+from benchmarks.bench import run
+from benchmarks import startup
+
+
+def test_benchmark_run():
+    shape = {'files': 20, 'depth': 2, 'ignored_files': 20, 'commits': 3, 'unpushed_commits': 1,
+             'untracked_files': 5, 'modified_files': 2, 'large_files': 1, 'large_file_size': 1024 * 1024,
+             'small_file_size': 64}
+    results = run(shape)
+    assert set(results['stages']) == {'get_uncommitted_files', 'get_unpushed_files', 'copy_files_cold',
+                                      'copy_files_warm', 'delete_old_files'}
+    assert results['counts']['uncommitted_files'] == 7
+    # Only the files of the unpushed commit, nothing from node_modules
+    assert 0 < results['counts']['unpushed_files'] <= 5
+    assert results['counts']['copied'] > 0
+
+
+def test_startup_benchmark():
+    results = startup.run(repeat=1)
+    assert results['eagerly_imported'] == []
+    assert set(results['seconds']) == {'interpreter', 'import', 'noop_run', 'config_parse', 'config_cached'}
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
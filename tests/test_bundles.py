@@ -0,0 +1,67 @@
+import logging
+import tempfile
+import shutil
+import subprocess
+from pathlib import Path
+import pytest
+from git_backup_notifier.bundles import bundle_unpushed_commits, read_bundle_heads
+
+
+def git(*args, cwd=None):
+    return subprocess.run(['git'] + list(args), cwd=cwd, check=True, capture_output=True, text=True).stdout.strip()
+
+
+def commit(repo, name):
+    (repo / name).write_text(name)
+    git('add', name, cwd=repo)
+    git('commit', '-m', name, cwd=repo)
+
+
+@pytest.fixture
+def setup_clone():
+    temp_dir = Path(tempfile.mkdtemp())
+    remote = temp_dir / 'remote.git'
+    clone = temp_dir / 'clone'
+    git('init', '--bare', str(remote))
+    git('clone', str(remote), str(clone))
+    commit(clone, 'pushed.txt')
+    git('push', '-u', 'origin', 'HEAD', cwd=clone)
+
+    yield temp_dir, remote, clone
+
+    shutil.rmtree(temp_dir)
+
+
+def test_bundle_unpushed_commits(setup_clone):
+    temp_dir, remote, clone = setup_clone
+    logger = logging.getLogger('test_bundles')
+    bundle_file = temp_dir / 'backup' / '.bundles' / 'clone.bundle'
+    branch = git('symbolic-ref', 'HEAD', cwd=clone)
+
+    # Everything is pushed
+    assert not bundle_unpushed_commits(clone, bundle_file, logger, False)
+    assert not bundle_file.exists()
+
+    commit(clone, 'unpushed.txt')
+    assert bundle_unpushed_commits(clone, bundle_file, logger, False)
+    assert read_bundle_heads(bundle_file) == [(git('rev-parse', 'HEAD', cwd=clone), branch)]
+    # Tip unchanged: not written again
+    assert not bundle_unpushed_commits(clone, bundle_file, logger, False)
+
+    commit(clone, 'unpushed2.txt')
+    git('checkout', '-q', '-b', 'local-only', cwd=clone)
+    commit(clone, 'local.txt')
+    git('checkout', '-q', '-', cwd=clone)
+    assert bundle_unpushed_commits(clone, bundle_file, logger, False, all_branches=True)
+    assert sorted(refname for _, refname in read_bundle_heads(bundle_file)) == sorted(['refs/heads/local-only', branch])
+
+    # Restore into a fresh clone of the remote with plain git fetch
+    restore = temp_dir / 'restore'
+    git('clone', str(remote), str(restore))
+    git('fetch', str(bundle_file), 'refs/heads/*:refs/remotes/backup/*', cwd=restore)
+    assert git('show', 'backup/local-only:local.txt', cwd=restore) == 'local.txt'
+    assert git('rev-parse', f'backup/{branch.rpartition("/")[2]}', cwd=restore) == git('rev-parse', 'HEAD', cwd=clone)
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
@@ -0,0 +1,95 @@
+import os
+import io
+import time
+import logging
+import tempfile
+import shutil
+from pathlib import Path
+import pytest
+from git_backup_notifier.chunks import ChunkStore, choose_anchor, iter_chunks, restore_chunked_files, MAX_CHUNK_SIZE
+from git_backup_notifier.utils import copy_files
+
+
+@pytest.fixture
+def setup_dirs():
+    temp_dir = tempfile.mkdtemp()
+    src = Path(temp_dir) / 'src'
+    src.mkdir()
+    (src / 'data.db').write_bytes(os.urandom(2 * 1024 * 1024))
+    (src / 'small.txt').write_text('small')
+
+    yield Path(temp_dir), src
+
+    shutil.rmtree(temp_dir)
+
+
+def test_iter_chunks_survive_insertion():
+    data = os.urandom(4 * 1024 * 1024)
+    anchor, mask_bits = choose_anchor(data)
+    chunks = [bytes(chunk) for chunk in iter_chunks(io.BytesIO(data), anchor, mask_bits)]
+    assert b''.join(chunks) == data
+    assert max(len(chunk) for chunk in chunks) <= MAX_CHUNK_SIZE
+
+    changed = data[:1000000] + b'inserted' + data[1000000:]
+    changed_chunks = [bytes(chunk) for chunk in iter_chunks(io.BytesIO(changed), anchor, mask_bits)]
+    assert len([chunk for chunk in changed_chunks if chunk not in set(chunks)]) <= 2
+
+
+def test_copy_files_with_chunk_store(setup_dirs):
+    temp_dir, src = setup_dirs
+    logger = logging.getLogger('test_chunks')
+    store = ChunkStore.for_backup_root(temp_dir / 'backup', 1024 * 1024)
+    dst = temp_dir / 'backup' / 'src'
+    files = ['data.db', 'small.txt']
+
+    assert copy_files(files, src, dst, [], [], 0, 10 ** 9, logger, False, chunk_store=store) == (2, 0)
+    assert (dst / 'small.txt').exists()
+    assert not (dst / 'data.db').exists()
+    # Unchanged: the large file is not read again
+    assert copy_files(files, src, dst, [], [], 0, 10 ** 9, logger, False, chunk_store=store) == (0, 2)
+
+    # A small edit in the middle only writes the chunks around it
+    first_version = store.load_version('src', 'data.db')
+    with open(src / 'data.db', 'r+b') as f:
+        f.seek(1024 * 1024)
+        f.write(b'changed')
+    written = store.store_file('src', 'data.db', src / 'data.db', os.stat(src / 'data.db'))
+    assert 0 < written <= 2 * MAX_CHUNK_SIZE
+    assert len(store.list_versions('src', 'data.db')) == 2
+
+    target = temp_dir / 'restore'
+    assert restore_chunked_files(store, 'src', target, logger) == 1
+    assert (target / 'data.db').read_bytes() == (src / 'data.db').read_bytes()
+    store.restore_file('src', 'data.db', target / 'old.db', store.list_versions('src', 'data.db')[0])
+    assert os.path.getsize(target / 'old.db') == first_version['size']
+
+
+def test_chunk_store_drops_files_that_are_no_longer_chunked(setup_dirs):
+    temp_dir, src = setup_dirs
+    logger = logging.getLogger('test_chunks')
+    store = ChunkStore.for_backup_root(temp_dir / 'backup', 1024 * 1024)
+    dst = temp_dir / 'backup' / 'src'
+    (src / 'gone.db').write_bytes(os.urandom(1024 * 1024))
+    files = ['data.db', 'gone.db']
+    assert copy_files(files, src, dst, [], [], 0, 10 ** 9, logger, False, chunk_store=store) == (2, 0)
+
+    # Below the threshold: the file is mirrored and its chunked versions are dropped
+    (src / 'data.db').write_text('small now')
+    assert copy_files(files, src, dst, [], [], 0, 10 ** 9, logger, False, chunk_store=store) == (1, 1)
+    assert (dst / 'data.db').read_text() == 'small now'
+    assert store.list_files('src') == ['gone.db']
+    assert restore_chunked_files(store, 'src', temp_dir / 'restore', logger) == 1
+
+    # The latest version of a file that is gone from the source is pruned once it is old
+    (src / 'gone.db').unlink()
+    assert store.prune([src], 30, logger, False) == 0
+    old_time = time.time() - 60 * 24 * 60 * 60
+    version_id = store.list_versions('src', 'gone.db')[0]
+    os.utime(store.file_versions_path('src', 'gone.db') / f'{version_id}.json', (old_time, old_time))
+    assert store.prune([src], 30, logger, False) == 1
+    assert store.list_files('src') == []
+    assert list(store.objects_path.glob('*/*')) == []
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
@@ -0,0 +1,80 @@
+import os
+import tempfile
+import shutil
+import subprocess
+from pathlib import Path
+import pytest
+from git_backup_notifier import discovery
+from git_backup_notifier.backup import backup_uncommitted_files, check_backup_manifest
+from git_backup_notifier.discovery import discover_repositories
+from git_backup_notifier.utils import load_config
+
+
+@pytest.fixture
+def setup_roots():
+    temp_dir = Path(tempfile.mkdtemp())
+    src = temp_dir / 'src'
+    for repo in ['repo1', 'group/repo2', 'group/repo2/nested', 'venv/repo3', 'a/b/c/d/too_deep']:
+        (src / repo / '.git').mkdir(parents=True)
+    (src / 'worktree').mkdir()
+    (src / 'worktree' / '.git').write_text('gitdir: ../repo1/.git/worktrees/worktree')
+    (src / 'group' / 'not_a_repo').mkdir()
+
+    yield temp_dir, src
+
+    shutil.rmtree(temp_dir)
+
+
+def test_discover_repositories(setup_roots, monkeypatch):
+    temp_dir, src = setup_roots
+    cache_path = temp_dir / 'discovery_cache.json'
+    # Treat all directories as old enough to be cached
+    monkeypatch.setattr(discovery, 'MTIME_GRACE_SECONDS', -60)
+
+    expected = [str(src / 'group' / 'repo2'), str(src / 'repo1'), str(src / 'worktree')]
+    assert discover_repositories([str(src)], ['venv'], 3, cache_path) == expected
+
+    scanned = []
+    scandir = os.scandir
+
+    def counting_scandir(path):
+        scanned.append(path)
+        return scandir(path)
+
+    monkeypatch.setattr(os, 'scandir', counting_scandir)
+    assert discover_repositories([str(src)], ['venv'], 3, cache_path) == expected
+    assert scanned == []
+
+    # A new clone changes the mtime of its parent, only that directory is scanned again
+    (src / 'group' / 'repo4' / '.git').mkdir(parents=True)
+    assert discover_repositories([str(src)], ['venv'], 3, cache_path) == sorted(
+        expected + [str(src / 'group' / 'repo4')])
+    assert str(src / 'group') in scanned
+    assert str(src) not in scanned
+
+
+def test_backup_discovered_below_home(monkeypatch):
+    home = Path(tempfile.mkdtemp())
+    try:
+        monkeypatch.setenv('HOME', str(home))
+        repo_path = home / 'src' / 'repo'
+        repo_path.mkdir(parents=True)
+        subprocess.run(['git', 'init'], cwd=repo_path, check=True)
+        (repo_path / 'new.txt').write_text('new')
+        backup_path = home / 'backup'
+        backup_path.mkdir()
+        config = load_config('config/default.toml', 'config/test_config.toml')
+        config['BackupSettings'].update({'backup_root_path': str(backup_path), 'use_manifest': True})
+        config['Repositories'].update({'repo_paths': [], 'discover_roots': ['~/src']})
+        config['GeneralSettings']['test_mode'] = False
+
+        backup_uncommitted_files(config)
+        assert (backup_path / 'repo' / 'new.txt').exists()
+        # The discovered repository is recorded again when the manifest is rebuilt
+        assert check_backup_manifest(config, rebuild=True) == 1
+    finally:
+        shutil.rmtree(home)
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
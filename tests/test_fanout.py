@@ -0,0 +1,132 @@
+import os
+import time
+import shutil
+import tempfile
+import subprocess
+from pathlib import Path
+import pytest
+from git_backup_notifier.backup import backup_uncommitted_files
+from git_backup_notifier.fanout import fan_out_files
+from git_backup_notifier.manifest import BackupManifest
+from git_backup_notifier.metrics import RunMetrics
+from git_backup_notifier.utils import create_buffered_logger, load_config
+
+
+@pytest.fixture
+def temp_dir():
+    temp_dir = Path(tempfile.mkdtemp())
+    yield temp_dir
+    shutil.rmtree(temp_dir)
+
+
+def test_fan_out_files_reads_once(temp_dir):
+    src = temp_dir / 'repo'
+    (src / 'src').mkdir(parents=True)
+    (src / 'src' / 'big.bin').write_bytes(os.urandom(3 * 1024 * 1024 + 5))
+    (src / 'small.txt').write_text('small')
+    (src / 'debug.log').write_text('excluded')
+    manifest = BackupManifest.for_backup_root(temp_dir / 'local')
+    destinations = [(temp_dir / 'local' / 'repo', manifest), (temp_dir / 'cloud' / 'repo', None)]
+    files = ['src/big.bin', 'small.txt', 'debug.log']
+    logger, buffer = create_buffered_logger('test_fan_out_files_reads_once')
+    run_metrics = RunMetrics()
+
+    with run_metrics.collect('repo'):
+        # A buffer smaller than a block: the reader waits for every write
+        result = fan_out_files(files, src, destinations, ['*.log'], [], 0, 10 ** 9, logger, False, workers=2,
+                               max_in_flight_bytes=1024)
+
+    assert result == (2, 1)
+    size = (src / 'src' / 'big.bin').stat().st_size + 5
+    counters = run_metrics.as_dict()['repositories']['repo']['counters']
+    assert counters['bytes_read'] == size
+    assert counters['bytes_copied'] == 2 * size
+    for root in ['local', 'cloud']:
+        assert (temp_dir / root / 'repo' / 'src' / 'big.bin').read_bytes() == (src / 'src' / 'big.bin').read_bytes()
+        assert (temp_dir / root / 'repo' / 'small.txt').stat().st_mtime == (src / 'small.txt').stat().st_mtime
+        assert not (temp_dir / root / 'repo' / 'debug.log').exists()
+    assert manifest.get('repo', 'small.txt').size == 5
+
+    # Up-to-date checks are per destination: only the destination that lost the file gets it again
+    (temp_dir / 'cloud' / 'repo' / 'small.txt').unlink()
+    buffer.records.clear()
+    with run_metrics.collect('repo 2'):
+        assert fan_out_files(files, src, destinations, ['*.log'], [], 0, 10 ** 9, logger, False) == (1, 2)
+    assert run_metrics.as_dict()['repositories']['repo 2']['counters']['bytes_read'] == 5
+    messages = [record.getMessage() for record in buffer.records]
+    assert f"Copied {src / 'small.txt'} to {temp_dir / 'cloud' / 'repo' / 'small.txt'}" in messages
+    assert f"Skipped {src / 'small.txt'} (backup is up to date based on manifest)" in messages
+    manifest.close()
+
+
+def test_fan_out_files_failing_destination(temp_dir):
+    src = temp_dir / 'repo'
+    src.mkdir()
+    (src / 'a.txt').write_bytes(b'a' * 100)
+    # A file where the destination directory would be: every write to it fails
+    (temp_dir / 'broken').write_text('')
+    destinations = [(temp_dir / 'broken' / 'repo', None), (temp_dir / 'good' / 'repo', None)]
+    logger, buffer = create_buffered_logger('test_fan_out_files_failing_destination')
+
+    assert fan_out_files(['a.txt'], src, destinations, [], [], 0, 1000, logger, False, max_in_flight_bytes=10) == \
+        (1, 0)
+
+    assert (temp_dir / 'good' / 'repo' / 'a.txt').read_bytes() == b'a' * 100
+    assert [record.event for record in buffer.records if getattr(record, 'event', None)] == ['failed', 'copied']
+
+
+def test_backup_to_several_destinations(temp_dir):
+    repo_path = temp_dir / 'repo'
+    repo_path.mkdir()
+    subprocess.run(['git', 'init'], cwd=repo_path, check=True)
+    (repo_path / 'new.txt').write_text('new')
+    roots = [temp_dir / 'local', temp_dir / 'cloud']
+    for root in roots:
+        root.mkdir()
+    # Only in the cloud destination: deleted from there by the retention
+    old_file = roots[1] / 'repo' / 'gone.txt'
+    old_file.parent.mkdir()
+    old_file.write_text('gone')
+    old_time = time.time() - 60 * 24 * 60 * 60
+    os.utime(old_file, (old_time, old_time))
+    config = load_config('config/default.toml', 'config/test_config.toml')
+    config['BackupSettings']['backup_root_path'] = [str(root) for root in roots]
+    config['BackupSettings']['delete_after_days'] = 30
+    config['Repositories']['repo_paths'] = [str(repo_path)]
+    config['GeneralSettings']['test_mode'] = False
+
+    backup_uncommitted_files(config)
+
+    for root in roots:
+        assert (root / 'repo' / 'new.txt').read_text() == 'new'
+    assert not old_file.exists()
+    # Logs and state are kept in the first destination
+    assert (roots[0] / 'backuplog').is_dir()
+    assert not (roots[1] / 'backuplog').exists()
+
+    config['BackupSettings']['storage_mode'] = 'snapshot'
+    with pytest.raises(ValueError):
+        backup_uncommitted_files(config)
+
+
+def test_backup_plans_every_destination(temp_dir, monkeypatch):
+    repo_path = temp_dir / 'repo'
+    repo_path.mkdir()
+    subprocess.run(['git', 'init'], cwd=repo_path, check=True)
+    (repo_path / 'new.txt').write_text('x' * 1000)
+    roots = [temp_dir / 'local', temp_dir / 'cloud']
+    for root in roots:
+        root.mkdir()
+    config = load_config('config/default.toml', 'config/test_config.toml')
+    config['BackupSettings'].update({'backup_root_path': [str(root) for root in roots], 'plan_free_space': True,
+                                     'free_space_margin_mb': 0})
+    config['Repositories']['repo_paths'] = [str(repo_path)]
+    config['GeneralSettings']['test_mode'] = False
+    # Only the second destination is full
+    monkeypatch.setattr('git_backup_notifier.planning.get_free_space',
+                        lambda path: 500 if Path(path) == roots[1] else 10 ** 9)
+
+    with pytest.raises(SystemExit):
+        backup_uncommitted_files(config)
+
+    assert not (roots[0] / 'repo').exists()
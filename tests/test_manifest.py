@@ -0,0 +1,70 @@
+import logging
+import tempfile
+import shutil
+from pathlib import Path
+import pytest
+import time
+from git_backup_notifier.manifest import BackupManifest, verify_manifest, rebuild_manifest, delete_expired_files
+from git_backup_notifier.utils import copy_files
+
+
+@pytest.fixture
+def setup_dirs():
+    temp_dir = tempfile.mkdtemp()
+    src = Path(temp_dir) / 'src'
+    backup_root = Path(temp_dir) / 'backup'
+    (src / 'subdir').mkdir(parents=True)
+    backup_root.mkdir()
+    (src / 'file1.txt').write_text('one')
+    (src / 'subdir' / 'file2.txt').write_text('two')
+
+    yield src, backup_root
+
+    shutil.rmtree(temp_dir)
+
+
+def test_copy_files_with_manifest(setup_dirs):
+    src, backup_root = setup_dirs
+    logger = logging.getLogger('test_manifest')
+    manifest = BackupManifest.for_backup_root(backup_root)
+    files = ['file1.txt', 'subdir/file2.txt']
+
+    copied, skipped = copy_files(files, src, backup_root / 'src', [], [], 0, 1000, logger, False, manifest)
+    assert (copied, skipped) == (2, 0)
+    assert manifest.get('src', 'file1.txt').size == 3
+
+    # The destination is not looked at: a removed backup file is only found by verify
+    (backup_root / 'src' / 'file1.txt').unlink()
+    copied, skipped = copy_files(files, src, backup_root / 'src', [], [], 0, 1000, logger, False, manifest)
+    assert (copied, skipped) == (0, 2)
+    assert verify_manifest(manifest, backup_root, logger) == [('src', 'file1.txt', 'missing')]
+
+    assert rebuild_manifest(manifest, backup_root, ['src'], logger) == 1
+    copied, skipped = copy_files(files, src, backup_root / 'src', [], [], 0, 1000, logger, False, manifest)
+    assert (copied, skipped) == (1, 1)
+    assert (backup_root / 'src' / 'file1.txt').exists()
+    manifest.close()
+
+
+def test_delete_expired_files(setup_dirs):
+    src, backup_root = setup_dirs
+    logger = logging.getLogger('test_manifest')
+    manifest = BackupManifest.for_backup_root(backup_root)
+    files = ['file1.txt', 'subdir/file2.txt']
+    copy_files(files, src, backup_root / 'src', [], [], 0, 1000, logger, False, manifest)
+
+    (src / 'file1.txt').unlink()
+    # Not seen for 10 days: file1.txt is gone from the source, file2.txt still exists there
+    manifest.mark_seen('src', files, time.time() - 10 * 24 * 60 * 60)
+
+    assert delete_expired_files(manifest, backup_root, [str(src)], 30, logger, False) == 0
+    assert delete_expired_files(manifest, backup_root, [str(src)], 5, logger, False) == 1
+    assert not (backup_root / 'src' / 'file1.txt').exists()
+    assert (backup_root / 'src' / 'subdir' / 'file2.txt').exists()
+    assert manifest.get('src', 'file1.txt') is None
+    assert manifest.expired('src', time.time() - 60) == []
+    manifest.close()
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
@@ -0,0 +1,70 @@
+import json
+import tempfile
+import shutil
+import subprocess
+from pathlib import Path
+import pytest
+from git_backup_notifier.backup import backup_uncommitted_files
+from git_backup_notifier.metrics import RunMetrics, count, stage
+from git_backup_notifier.utils import load_config
+
+
+@pytest.fixture
+def setup_repo():
+    temp_dir = Path(tempfile.mkdtemp())
+    repo = temp_dir / 'repo'
+    repo.mkdir()
+    (temp_dir / 'backup').mkdir()
+    subprocess.run(['git', 'init', '-q'], cwd=repo, check=True)
+    (repo / 'new.txt').write_text('new')
+    (repo / 'debug.log').write_text('excluded')
+
+    yield temp_dir, repo
+
+    shutil.rmtree(temp_dir)
+
+
+def test_run_metrics():
+    run_metrics = RunMetrics()
+    count('files_copied')  # outside of a repository: ignored
+    with run_metrics.collect('repo "1"'):
+        with stage('copy'):
+            count('files_copied', 2)
+    run_metrics.finish(True, copied=2)
+
+    report = run_metrics.as_dict()
+    assert report['success'] is True
+    assert report['repositories']['repo "1"']['counters']['files_copied'] == 2
+    assert set(report['repositories']['repo "1"']['stages']) == {'copy', 'total'}
+
+
+def test_backup_writes_report(setup_repo):
+    temp_dir, repo = setup_repo
+    config = load_config('config/default.toml', 'config/test_config.toml')
+    config['BackupSettings']['backup_root_path'] = str(temp_dir / 'backup')
+    config['Repositories']['repo_paths'] = [str(repo)]
+    config['GeneralSettings']['test_mode'] = False
+    config['Metrics'] = {'textfile_path': str(temp_dir / 'git_backup.prom')}
+
+    try:
+        backup_uncommitted_files(config)
+    except SystemExit:
+        pass
+
+    report = json.loads((temp_dir / 'backup' / 'backuplog' / 'run_report.json').read_text())
+    assert report['success'] is True
+    assert report['totals']['copied'] == 1
+    repo_report = report['repositories']['repo']
+    assert {'enumerate_uncommitted', 'enumerate_unpushed', 'copy', 'total'} <= set(repo_report['stages'])
+    assert repo_report['counters']['files_copied'] == 1
+    assert repo_report['counters']['bytes_copied'] == 3
+    assert repo_report['counters']['subprocess_count'] >= 2
+
+    textfile = (temp_dir / 'git_backup.prom').read_text()
+    assert '# TYPE git_backup_run_success gauge' in textfile
+    assert 'git_backup_run_success 1' in textfile
+    assert 'git_backup_repo_files_copied{repo="repo"} 1' in textfile
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
@@ -1,4 +1,14 @@
-from git_backup_notifier.notifications import send_local_notification, send_email_notification, send_telegram_notification
+import json
+import socketserver
+import tempfile
+import shutil
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs
+import pytest
+from git_backup_notifier.notifications import send_local_notification, send_email_notification, \
+    send_telegram_notification, NotificationDispatcher
 
 
 def test_send_local_notification():
@@ -19,6 +29,119 @@ def test_send_telegram_notification():
     send_telegram_notification("test-telegram-bot-token", "test-telegram-chat-id", "This is a test Telegram message.")
 
 
+class SMTPStubHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.server.connections += 1
+        self.wfile.write(b'220 stub\r\n')
+        data = None
+        for line in self.rfile:
+            if data is not None:
+                if line == b'.\r\n':
+                    self.server.messages.append(b''.join(data).decode())
+                    data = None
+                    self.wfile.write(b'250 queued\r\n')
+                else:
+                    data.append(line)
+                continue
+            command = line[:4].upper()
+            if command == b'EHLO':
+                self.wfile.write(b'250-stub\r\n250 AUTH PLAIN LOGIN\r\n')
+            elif command == b'AUTH':
+                self.wfile.write(b'235 ok\r\n')
+            elif command == b'DATA':
+                data = []
+                self.wfile.write(b'354 go ahead\r\n')
+            elif command == b'QUIT':
+                self.wfile.write(b'221 bye\r\n')
+                break
+            else:
+                self.wfile.write(b'250 ok\r\n')
+
+
+class TelegramStubHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length'])).decode()
+        self.server.requests.append((self.path, parse_qs(body)))
+        # The first request fails to test the retry
+        status = 500 if len(self.server.requests) == 1 else 200
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps({'ok': status == 200}).encode())
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub_servers():
+    smtp_server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), SMTPStubHandler)
+    smtp_server.connections = 0
+    smtp_server.messages = []
+    http_server = ThreadingHTTPServer(('127.0.0.1', 0), TelegramStubHandler)
+    http_server.requests = []
+    threads = [threading.Thread(target=server.serve_forever, daemon=True) for server in (smtp_server, http_server)]
+    for thread in threads:
+        thread.start()
+    temp_dir = tempfile.mkdtemp()
+    config = {'Notifications': {
+        'local': False,
+        'email': 'to@example.com',
+        'smtp_server': '127.0.0.1',
+        'smtp_port': smtp_server.server_address[1],
+        'smtp_user': 'user',
+        'smtp_password': 'password',
+        'telegram_token': 'token',
+        'telegram_chat_id': 'chat',
+        'telegram_api_url': f'http://127.0.0.1:{http_server.server_address[1]}',
+        'retry_backoff': 0.01,
+        'timeout': 5,
+    }}
+
+    yield config, smtp_server, http_server, Path(temp_dir)
+
+    for server in (smtp_server, http_server):
+        server.shutdown()
+        server.server_close()
+    shutil.rmtree(temp_dir)
+
+
+def test_notification_dispatcher(stub_servers):
+    config, smtp_server, http_server, _ = stub_servers
+    dispatcher = NotificationDispatcher(config)
+    dispatcher.notify("First", "first message")
+    dispatcher.notify("Second", "second message")
+    dispatcher.close()
+
+    assert smtp_server.connections == 1
+    assert len(smtp_server.messages) == 2
+    assert 'Subject: Second' in smtp_server.messages[1]
+    # One failed request was retried
+    assert [request[1]['text'][0] for request in http_server.requests] == \
+           ['first message', 'first message', 'second message']
+    assert http_server.requests[0][0] == '/bottoken/sendMessage'
+
+
+def test_notification_digest(stub_servers):
+    config, smtp_server, http_server, state_dir = stub_servers
+    config['Notifications']['digest_interval'] = 3600
+    for run in range(2):
+        dispatcher = NotificationDispatcher(config, state_dir)
+        dispatcher.notify("Backup Completed", f"run {run}")
+        dispatcher.close()
+    assert smtp_server.messages == []
+
+    dispatcher = NotificationDispatcher(config, state_dir)
+    dispatcher.notify("Backup Failed", "disk full", urgent=True)
+    dispatcher.digest_interval = 0.001
+    dispatcher.notify("Backup Completed", "run 2")
+    dispatcher.close()
+
+    assert len(smtp_server.messages) == 2
+    assert 'Subject: 3 backup notifications' in smtp_server.messages[1]
+    assert 'run 0' in smtp_server.messages[1] and 'run 2' in smtp_server.messages[1]
+
+
 if __name__ == '__main__':
     test_send_local_notification()
     test_send_email_notification()
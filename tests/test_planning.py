@@ -0,0 +1,64 @@
+import json
+import shutil
+import tempfile
+import subprocess
+from pathlib import Path
+import pytest
+from git_backup_notifier.backup import backup_uncommitted_files, plan_backup_run
+from git_backup_notifier.utils import load_config
+
+
+@pytest.fixture
+def setup_repo():
+    temp_dir = Path(tempfile.mkdtemp())
+    repo_path = temp_dir / 'repo'
+    (repo_path / 'src').mkdir(parents=True)
+    subprocess.run(['git', 'init'], cwd=repo_path, check=True)
+    (repo_path / 'committed.txt').write_text('committed')
+    subprocess.run(['git', 'add', 'committed.txt'], cwd=repo_path, check=True)
+    subprocess.run(['git', 'commit', '-m', 'Initial commit'], cwd=repo_path, check=True)
+    (repo_path / 'src' / 'new.txt').write_text('x' * 1000)
+    (repo_path / 'debug.log').write_text('excluded')
+    backup_path = temp_dir / 'backup'
+    backup_path.mkdir()
+
+    config = load_config('config/default.toml', 'config/test_config.toml')
+    config['BackupSettings']['backup_root_path'] = str(backup_path)
+    config['Repositories']['repo_paths'] = [str(repo_path)]
+    config['Exclusions']['exclude_patterns'] = ['*.log']
+    config['GeneralSettings']['test_mode'] = False
+    yield config, repo_path, backup_path
+    shutil.rmtree(temp_dir)
+
+
+def test_plan_backup_run(setup_repo):
+    config, repo_path, backup_path = setup_repo
+    plan_path = backup_path.parent / 'plan.json'
+
+    plan = plan_backup_run(config, str(plan_path))
+
+    assert json.loads(plan_path.read_text()) == plan
+    files = {file['path']: file for file in plan['repositories'][0]['files']}
+    assert files['src/new.txt'] == {'path': 'src/new.txt', 'size': 1000, 'action': 'copy'}
+    assert 'debug.log' not in files
+    assert plan['totals']['bytes_to_copy'] >= 1000
+    assert plan['fits']
+    # Nothing was copied
+    assert not (backup_path / 'repo').exists()
+
+    backup_uncommitted_files(config)
+    plan = plan_backup_run(config, str(plan_path))
+    assert {file['action'] for file in plan['repositories'][0]['files']} == {'up_to_date'}
+    assert plan['totals']['bytes_to_copy'] == 0
+
+
+def test_backup_stops_before_copying_without_free_space(setup_repo, monkeypatch):
+    config, repo_path, backup_path = setup_repo
+    config['BackupSettings']['plan_free_space'] = True
+    config['BackupSettings']['free_space_margin_mb'] = 0
+    monkeypatch.setattr('git_backup_notifier.planning.get_free_space', lambda path: 500)
+
+    with pytest.raises(SystemExit):
+        backup_uncommitted_files(config)
+
+    assert not (backup_path / 'repo').exists()
@@ -0,0 +1,93 @@
+import os
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+from pathlib import Path
+import pytest
+from git_backup_notifier.backup import backup_uncommitted_files
+from git_backup_notifier.scheduling import prioritize_files
+from git_backup_notifier.utils import copy_files, create_buffered_logger, load_config
+
+
+@pytest.fixture
+def temp_dir():
+    temp_dir = Path(tempfile.mkdtemp())
+    yield temp_dir
+    shutil.rmtree(temp_dir)
+
+
+def write_file(path, size, age):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b'x' * size)
+    mtime = time.time() - age
+    os.utime(path, (mtime, mtime))
+
+
+def test_prioritize_files(temp_dir):
+    write_file(temp_dir / 'build' / 'artifact.bin', 9000, 60)
+    write_file(temp_dir / 'notes.txt', 10, 60)
+    write_file(temp_dir / 'old.txt', 10, 30 * 24 * 60 * 60)
+    write_file(temp_dir / '.env', 100, 30 * 24 * 60 * 60)
+    write_file(temp_dir / 'deferred.txt', 500, 2 * 24 * 60 * 60)
+
+    files = ['missing.txt', 'old.txt', 'build/artifact.bin', 'deferred.txt', 'notes.txt', '.env']
+    assert prioritize_files(files, temp_dir, ['.env'], deferred=['deferred.txt']) == \
+        ['deferred.txt', '.env', 'notes.txt', 'build/artifact.bin', 'old.txt', 'missing.txt']
+
+
+def test_copy_files_deadline(temp_dir):
+    for name in ['a.txt', 'b.txt', 'c.log']:
+        write_file(temp_dir / 'src' / name, 10, 0)
+    logger, _ = create_buffered_logger('test_copy_files_deadline')
+    deferred = []
+
+    result = copy_files(['a.txt', 'b.txt', 'c.log'], temp_dir / 'src', temp_dir / 'dst', ['*.log'], [], 0, 1000,
+                        logger, False, deadline=time.monotonic() - 1, deferred=deferred)
+
+    assert result == (0, 0)
+    assert deferred == ['a.txt', 'b.txt']
+    assert not (temp_dir / 'dst').exists()
+
+
+def test_backup_streams_files_without_deadline(temp_dir, monkeypatch):
+    repo_path = temp_dir / 'repo'
+    repo_path.mkdir()
+    subprocess.run(['git', 'init'], cwd=repo_path, check=True)
+    (repo_path / '.env').write_text('SECRET=1')
+    backup_path = temp_dir / 'backup'
+    backup_path.mkdir()
+    config = load_config('config/default.toml', 'config/test_config.toml')
+    config['BackupSettings'].update({'backup_root_path': str(backup_path), 'prioritize': True})
+    config['Repositories']['repo_paths'] = [str(repo_path)]
+    config['GeneralSettings']['test_mode'] = False
+
+    def fail(*args):
+        raise AssertionError("files are sorted without a deadline")
+    monkeypatch.setattr('git_backup_notifier.backup.prioritize_files', fail)
+
+    backup_uncommitted_files(config)
+    assert (backup_path / 'repo' / '.env').exists()
+
+
+def test_backup_defers_repositories_after_deadline(temp_dir):
+    repo_path = temp_dir / 'repo'
+    repo_path.mkdir()
+    subprocess.run(['git', 'init'], cwd=repo_path, check=True)
+    (repo_path / '.env').write_text('SECRET=1')
+    backup_path = temp_dir / 'backup'
+    backup_path.mkdir()
+    config = load_config('config/default.toml', 'config/test_config.toml')
+    config['BackupSettings']['backup_root_path'] = str(backup_path)
+    config['Repositories']['repo_paths'] = [str(repo_path)]
+    config['GeneralSettings']['test_mode'] = False
+    deferred_path = backup_path / '.state' / 'deferred.json'
+
+    backup_uncommitted_files(config, deadline_seconds=1e-9)
+    assert not (backup_path / 'repo' / '.env').exists()
+    assert json.loads(deferred_path.read_text())[str(repo_path.resolve())]['files'] == []
+
+    backup_uncommitted_files(config)
+    assert (backup_path / 'repo' / '.env').exists()
+    assert json.loads(deferred_path.read_text())[str(repo_path.resolve())] is None
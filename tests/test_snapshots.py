@@ -0,0 +1,123 @@
+import os
+import time
+import logging
+import tempfile
+import shutil
+import subprocess
+from pathlib import Path
+import pytest
+from git_backup_notifier.backup import backup_uncommitted_files
+from git_backup_notifier.snapshots import SnapshotStore, snapshot_files, restore_snapshot
+from git_backup_notifier.utils import load_config
+
+
+@pytest.fixture
+def setup_dirs():
+    temp_dir = tempfile.mkdtemp()
+    src = Path(temp_dir) / 'src'
+    (src / 'subdir').mkdir(parents=True)
+    (src / '.env').write_text('SECRET=1')
+    (src / 'subdir' / '.env').write_text('SECRET=1')
+    (src / 'file1.txt').write_text('one')
+
+    yield Path(temp_dir), src
+
+    shutil.rmtree(temp_dir)
+
+
+def test_snapshot_and_restore(setup_dirs):
+    temp_dir, src = setup_dirs
+    logger = logging.getLogger('test_snapshots')
+    store = SnapshotStore.for_backup_root(temp_dir / 'backup')
+    files = ['.env', 'subdir/.env', 'file1.txt']
+
+    # Identical content is stored once
+    assert snapshot_files(files, src, store, 'src', [], [], 0, 1000, logger, False) == (2, 1)
+    assert len(store.list_snapshots('src')) == 1
+
+    # Nothing changed: no new objects and no new snapshot
+    assert snapshot_files(files, src, store, 'src', [], [], 0, 1000, logger, False) == (0, 3)
+    assert len(store.list_snapshots('src')) == 1
+
+    first_snapshot = store.list_snapshots('src')[0]
+    (src / 'file1.txt').write_text('changed')
+    assert snapshot_files(files, src, store, 'src', [], [], 0, 1000, logger, False) == (1, 2)
+    assert len(store.list_snapshots('src')) == 2
+
+    target = temp_dir / 'restore'
+    assert restore_snapshot(store, 'src', target, logger, first_snapshot) == 3
+    assert (target / 'file1.txt').read_text() == 'one'
+    assert (target / 'subdir' / '.env').read_text() == 'SECRET=1'
+    restore_snapshot(store, 'src', target, logger)
+    assert (target / 'file1.txt').read_text() == 'changed'
+
+
+def test_snapshot_does_not_copy_stored_content(setup_dirs, monkeypatch):
+    temp_dir, src = setup_dirs
+    logger = logging.getLogger('test_snapshots')
+    store = SnapshotStore.for_backup_root(temp_dir / 'backup')
+    assert snapshot_files(['.env', 'file1.txt'], src, store, 'src', [], [], 0, 1000, logger, False) == (2, 0)
+
+    copied = []
+    add_object = store.add_object
+    monkeypatch.setattr(store, 'add_object', lambda src_file: copied.append(src_file) or add_object(src_file))
+    # Only the mtime changed
+    os.utime(src / 'file1.txt', (1, 1))
+    assert snapshot_files(['.env', 'file1.txt'], src, store, 'src', [], [], 0, 1000, logger, False) == (0, 2)
+    # The same content in another repository
+    assert snapshot_files(['subdir/.env'], src, store, 'other', [], [], 0, 1000, logger, False) == (0, 1)
+    assert copied == []
+
+    # New content of a known size is stored
+    (src / 'file1.txt').write_text('two')
+    assert snapshot_files(['file1.txt'], src, store, 'src', [], [], 0, 1000, logger, False) == (1, 0)
+    assert copied == [src / 'file1.txt']
+
+
+def test_snapshot_prune(setup_dirs):
+    temp_dir, src = setup_dirs
+    logger = logging.getLogger('test_snapshots')
+    store = SnapshotStore.for_backup_root(temp_dir / 'backup')
+    snapshot_files(['.env', 'file1.txt'], src, store, 'src', [], [], 0, 1000, logger, False)
+    old_hash = store.load_snapshot('src')['file1.txt']['hash']
+    (src / 'file1.txt').write_text('changed')
+    snapshot_files(['.env', 'file1.txt'], src, store, 'src', [], [], 0, 1000, logger, False)
+    first, latest = store.list_snapshots('src')
+
+    assert store.prune(['src'], 30, logger, False) == 0
+    old_time = time.time() - 60 * 24 * 60 * 60
+    for snapshot_id in (first, latest):
+        os.utime(store.snapshots_path / 'src' / f'{snapshot_id}.json', (old_time, old_time))
+    # The latest snapshot is always kept
+    assert store.prune(['src'], 30, logger, False) == 1
+    assert store.list_snapshots('src') == [latest]
+    assert not store.has_object(old_hash)
+    assert store.has_object(store.load_snapshot('src')['.env']['hash'])
+
+
+def test_snapshot_keeps_unpushed_files_with_cursor(setup_dirs):
+    temp_dir, src = setup_dirs
+    subprocess.run(['git', 'init'], cwd=src, check=True)
+    subprocess.run(['git', 'add', 'file1.txt'], cwd=src, check=True)
+    subprocess.run(['git', 'commit', '-m', 'Unpushed commit'], cwd=src, check=True)
+    backup_path = temp_dir / 'backup'
+    backup_path.mkdir()
+    config = load_config('config/default.toml', 'config/test_config.toml')
+    config['BackupSettings'].update({'backup_root_path': str(backup_path), 'storage_mode': 'snapshot',
+                                     'unpushed_cursor': True})
+    config['Repositories']['repo_paths'] = [str(src)]
+    config['GeneralSettings']['test_mode'] = False
+    store = SnapshotStore.for_backup_root(backup_path)
+
+    backup_uncommitted_files(config)
+    assert sorted(store.load_snapshot('src')) == ['.env', 'file1.txt', 'subdir/.env']
+
+    # HEAD did not move: the file of the unpushed commit is still part of the next snapshot
+    (src / '.env').write_text('SECRET=2')
+    backup_uncommitted_files(config)
+    assert len(store.list_snapshots('src')) == 2
+    assert sorted(store.load_snapshot('src')) == ['.env', 'file1.txt', 'subdir/.env']
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
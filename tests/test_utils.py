@@ -1,9 +1,16 @@
+import os
+import json
 import tempfile
+import threading
 import shutil
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 import subprocess
 import pytest
-from git_backup_notifier.utils import compute_file_hash, get_uncommitted_files, get_unpushed_files
+from git_backup_notifier.utils import compute_file_hash, get_uncommitted_files, get_unpushed_files, get_head_commit, \
+    iter_git_status, parse_status_records, ExclusionMatcher, copy_file, get_repo_fingerprint, fingerprint_paths, \
+    copy_files, create_buffered_logger, iter_unique, iter_uncommitted_files, load_config, setup_logger, stop_logger, \
+    process_files_in_order, iter_git_output
 
 
 @pytest.fixture(scope='module')
@@ -38,6 +45,110 @@ def test_compute_file_hash(setup_repo):
     assert hash1 == hash2
 
 
+@pytest.mark.parametrize('compute_hash', [True, False])
+def test_copy_file(setup_repo, compute_hash):
+    temp_dir, repo_path = setup_repo
+    src = repo_path / 'file1.txt'
+    dst_dir = Path(temp_dir) / f'copy_{compute_hash}'
+    dst_dir.mkdir()
+    dst = dst_dir / 'file1.txt'
+    dst.write_text('old content that is longer than the new one')
+
+    digest = copy_file(src, dst, compute_hash=compute_hash)
+
+    assert dst.read_bytes() == src.read_bytes()
+    assert dst.stat().st_mtime == src.stat().st_mtime
+    assert digest == (compute_file_hash(src) if compute_hash else None)
+    assert [path.name for path in dst_dir.iterdir()] == ['file1.txt']
+
+
+def test_copy_files_parallel():
+    temp_dir = Path(tempfile.mkdtemp())
+    try:
+        src = temp_dir / 'src'
+        files = []
+        for index in range(50):
+            file = f'dir{index % 5}/file{index}.txt'
+            (src / file).parent.mkdir(parents=True, exist_ok=True)
+            (src / file).write_text('x' * index)
+            files.append(file)
+        files += ['dir0/debug.log', 'missing.txt']
+        (src / 'dir0' / 'debug.log').write_text('excluded')
+
+        def copy(dst, workers):
+            logger, buffer = create_buffered_logger(f'test_copy_files_{workers}')
+            result = copy_files(files, src, dst, ['*.log'], [], 1, 1000, logger, False, workers=workers,
+                                max_in_flight_bytes=100)
+            return result, [record.getMessage().replace(str(dst), '') for record in buffer.records]
+
+        sequential = copy(temp_dir / 'sequential', 1)
+        parallel = copy(temp_dir / 'parallel', 4)
+        assert parallel == sequential
+        assert parallel[0] == (49, 3)
+        assert (temp_dir / 'parallel' / 'dir4' / 'file49.txt').read_text() == 'x' * 49
+        # Everything is up to date now
+        assert copy(temp_dir / 'parallel', 4)[0] == (0, 52)
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def test_process_files_in_order_limits_files_in_flight():
+    temp_dir = Path(tempfile.mkdtemp())
+    executor = ThreadPoolExecutor(max_workers=2)
+    try:
+        files = [f'file{index:02}.txt' for index in range(50)]
+        for file in files:
+            (temp_dir / file).write_text('')
+        release = threading.Event()
+        started = []
+        finished = []
+        in_flight = []
+
+        def process(file, src_file, src_stat):
+            started.append(file)
+            in_flight.append(len(started) - len(finished))
+            if file == 'file00.txt':
+                # A slow first file: all other files are done long before it
+                threading.Timer(0.2, release.set).start()
+                return [executor.submit(release.wait)]
+            return [executor.submit(lambda: True)]
+
+        process_files_in_order(files, temp_dir, ExclusionMatcher([], []), 0, 100, process,
+                               lambda file, records, results: finished.append(file), max_pending=4)
+
+        assert finished == files
+        assert max(in_flight) <= 5
+    finally:
+        executor.shutdown(wait=True)
+        shutil.rmtree(temp_dir)
+
+
+def test_setup_logger():
+    temp_dir = Path(tempfile.mkdtemp())
+    try:
+        src = temp_dir / 'src'
+        src.mkdir()
+        (src / 'new.txt').write_text('new')
+        (src / 'debug.log').write_text('excluded')
+
+        logger = setup_logger(temp_dir / 'log')
+        logger = setup_logger(temp_dir / 'log', file_events='jsonl')
+        logger.info("Backup of %s started", src)
+        copy_files(['new.txt', 'debug.log'], src, temp_dir / 'repo', ['*.log'], [], 0, 1000, logger, False)
+        stop_logger()
+
+        log_lines = (temp_dir / 'log' / 'backup.log').read_text().splitlines()
+        # Written once although setup_logger was called twice, per-file records are in events.jsonl
+        assert len([line for line in log_lines if 'Backup of' in line]) == 1
+        assert not [line for line in log_lines if 'new.txt' in line]
+        events = [json.loads(line) for line in (temp_dir / 'log' / 'events.jsonl').read_text().splitlines()]
+        assert [(event['repo'], event['path'], event['event']) for event in events] == \
+            [('repo', 'new.txt', 'copied'), ('repo', 'debug.log', 'excluded')]
+    finally:
+        stop_logger()
+        shutil.rmtree(temp_dir)
+
+
 def test_get_uncommitted_files(setup_repo):
     temp_dir, repo_path = setup_repo
     files = get_uncommitted_files(repo_path)
@@ -53,5 +164,136 @@ def test_get_unpushed_files(setup_repo):
     assert 'file1.txt' in files
 
 
+def test_get_unpushed_files_upstream_range():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        remote = Path(temp_dir) / 'remote.git'
+        clone = Path(temp_dir) / 'clone'
+        subprocess.run(['git', 'init', '--bare', str(remote)], check=True)
+        subprocess.run(['git', 'clone', str(remote), str(clone)], check=True)
+        (clone / 'pushed.txt').write_text('pushed')
+        subprocess.run(['git', 'add', 'pushed.txt'], cwd=clone, check=True)
+        subprocess.run(['git', 'commit', '-m', 'pushed'], cwd=clone, check=True)
+        subprocess.run(['git', 'push', '-u', 'origin', 'HEAD'], cwd=clone, check=True)
+        (clone / 'unpushed.txt').write_text('unpushed')
+        subprocess.run(['git', 'add', 'unpushed.txt'], cwd=clone, check=True)
+        subprocess.run(['git', 'commit', '-m', 'unpushed'], cwd=clone, check=True)
+
+        assert get_unpushed_files(clone) == ['unpushed.txt']
+        # Nothing new since the current HEAD
+        assert get_unpushed_files(clone, since=get_head_commit(clone)) == []
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def test_iter_unique():
+    assert list(iter_unique(iter(['b', 'a', 'b', 'c', 'a']))) == ['b', 'a', 'c']
+
+
+def test_iter_uncommitted_files_is_lazy(setup_repo):
+    temp_dir, repo_path = setup_repo
+    files = iter_uncommitted_files(repo_path)
+    first = next(files)
+    assert first in get_uncommitted_files(repo_path)
+    files.close()  # Stops git status
+
+
+def test_load_config_cache():
+    temp_dir = Path(tempfile.mkdtemp())
+    try:
+        default_path = temp_dir / 'default.toml'
+        user_path = temp_dir / 'user.toml'
+        default_path.write_text('[BackupSettings]\nmin_file_size = 0\nmax_file_size = 100\n')
+        user_path.write_text('[BackupSettings]\nmin_file_size = 10\n')
+        for path in (default_path, user_path):
+            os.utime(path, (1000000000, 1000000000))
+        cache_dir = temp_dir / 'cache'
+
+        expected = {'BackupSettings': {'min_file_size': 10, 'max_file_size': 100}}
+        assert load_config(default_path, user_path, cache_dir) == expected
+        assert len(list(cache_dir.iterdir())) == 1
+        assert load_config(default_path, user_path, cache_dir) == expected
+
+        # A changed file is parsed again
+        user_path.write_text('[BackupSettings]\nmin_file_size = 20\n')
+        os.utime(user_path, (1000000001, 1000000001))
+        assert load_config(default_path, user_path, cache_dir)['BackupSettings']['min_file_size'] == 20
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def test_parse_status_records():
+    records = [b'1 .M N... 100644 100644 100644 abc abc file with spaces.txt',
+               b'1 A. N... 000000 100644 100644 000 abc staged.txt',
+               b'2 R. N... 100644 100644 100644 abc abc R100 new name.txt', b'old name.txt',
+               b'? untracked\xff.txt',
+               b'! venv/']
+    entries = list(parse_status_records(records))
+    assert [entry.kind for entry in entries] == ['modified', 'staged', 'renamed', 'untracked', 'ignored']
+    assert entries[0].path == 'file with spaces.txt'
+    assert entries[2].orig_path == 'old name.txt'
+    assert os.fsencode(entries[3].path) == b'untracked\xff.txt'
+
+
+def test_iter_git_status(setup_repo):
+    temp_dir, repo_path = setup_repo
+    entries = {entry.path: entry.kind for entry in iter_git_status(repo_path)}
+    assert entries['file_to_commit_but_not_push.txt'] == 'staged'
+    assert entries['subdir/file3.txt'] == 'untracked'
+
+
+def test_iter_git_output_reports_stderr(setup_repo):
+    temp_dir, repo_path = setup_repo
+    assert list(iter_git_output(['ls-files', '-z', 'file1.txt'], repo_path, 'list files')) == [b'file1.txt']
+    with pytest.raises(RuntimeError, match='Failed to check a commit in .*no-such-commit'):
+        list(iter_git_output(['cat-file', '-t', 'no-such-commit'], repo_path, 'check a commit'))
+
+
+def test_exclusion_matcher():
+    matcher = ExclusionMatcher(['venv', 'node_modules'], ['*.log', '*.tmp'])
+    assert matcher.reason('venv/lib/site.py') == 'directory'
+    assert matcher.reason('src/node_modules', is_dir=True) == 'directory'
+    assert matcher.reason('src/debug.log') == 'pattern'
+    assert matcher.reason('src/venv.py') is None
+    assert matcher.reason('src/main.py') is None
+
+
+def test_get_uncommitted_files_prunes_excluded_dirs(setup_repo):
+    temp_dir, repo_path = setup_repo
+    (repo_path / 'node_modules' / 'pkg').mkdir(parents=True)
+    (repo_path / 'node_modules' / 'pkg' / 'index.js').write_text('x')
+    (repo_path / 'debug.log').write_text('x')
+    try:
+        matcher = ExclusionMatcher(['node_modules'], ['*.log'])
+        files = get_uncommitted_files(repo_path, matcher)
+        assert 'file2.txt' in files
+        assert not any(file.startswith('node_modules') for file in files)
+        assert 'debug.log' not in files
+    finally:
+        shutil.rmtree(repo_path / 'node_modules')
+        (repo_path / 'debug.log').unlink()
+
+
+def test_get_repo_fingerprint(setup_repo):
+    temp_dir, repo_path = setup_repo
+    paths = fingerprint_paths(['file2.txt', 'subdir/file3.txt'])
+    assert paths == ['', 'subdir', 'file2.txt', 'subdir/file3.txt']
+    fingerprint = get_repo_fingerprint(repo_path, paths)
+    assert get_repo_fingerprint(repo_path, paths) == fingerprint
+    assert get_repo_fingerprint(repo_path, paths, 'other settings') != fingerprint
+
+    # A candidate changed
+    stat = os.stat(repo_path / 'file2.txt')
+    os.utime(repo_path / 'file2.txt', ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    changed = get_repo_fingerprint(repo_path, paths)
+    assert changed != fingerprint
+
+    # A new commit
+    (repo_path / 'fingerprint.txt').write_text('x')
+    subprocess.run(['git', 'add', 'fingerprint.txt'], cwd=repo_path)
+    subprocess.run(['git', 'commit', '-m', 'Fingerprint', '--', 'fingerprint.txt'], cwd=repo_path)
+    assert get_repo_fingerprint(repo_path, paths) != changed
+
+
 if __name__ == '__main__':
     pytest.main([__file__])
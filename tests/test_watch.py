@@ -0,0 +1,98 @@
+import tempfile
+import shutil
+import subprocess
+import threading
+import time
+from pathlib import Path
+import pytest
+from git_backup_notifier.utils import load_config, ExclusionMatcher
+from git_backup_notifier.watch import FULL_SCAN, InotifyWatcher, PollingWatcher, watch_repositories
+
+
+@pytest.fixture
+def setup_repo():
+    temp_dir = tempfile.mkdtemp()
+    repo = Path(temp_dir) / 'repo'
+    repo.mkdir()
+    (Path(temp_dir) / 'backup').mkdir()
+    subprocess.run(['git', 'init'], cwd=repo)
+    (repo / 'file1.txt').write_text('one')
+    subprocess.run(['git', 'add', 'file1.txt'], cwd=repo)
+    subprocess.run(['git', 'commit', '-m', 'Initial commit'], cwd=repo)
+
+    yield Path(temp_dir), repo
+
+    shutil.rmtree(temp_dir)
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+@pytest.mark.parametrize('watcher_class', [InotifyWatcher, PollingWatcher])
+def test_watcher_reports_changes(setup_repo, watcher_class):
+    temp_dir, repo = setup_repo
+    matcher = ExclusionMatcher(['.git', 'venv'], ['*.log'])
+    try:
+        watcher = InotifyWatcher([str(repo)], matcher) if watcher_class is InotifyWatcher \
+            else PollingWatcher([str(repo)], matcher, poll_interval=0.1)
+    except OSError:
+        pytest.skip('inotify is not available')
+    (repo / 'venv').mkdir()
+    (repo / 'venv' / 'ignored.txt').write_text('x')
+    (repo / 'debug.log').write_text('x')
+    (repo / 'new.txt').write_text('new')
+
+    events = set()
+    wait_for(lambda: events.update(watcher.read_events(0.2)) or (str(repo), 'new.txt') in events, timeout=5)
+    watcher.close()
+    assert (str(repo), 'new.txt') in events
+    assert (str(repo), 'debug.log') not in events
+    assert not any(path.startswith('venv/') for _, path in events)
+
+
+def test_inotify_watcher_survives_watch_errors(setup_repo, monkeypatch):
+    temp_dir, repo = setup_repo
+    try:
+        watcher = InotifyWatcher([str(repo)], ExclusionMatcher(['.git'], []))
+    except OSError:
+        pytest.skip('inotify is not available')
+
+    def add_watch(repo_path, relative_dir):
+        raise OSError(28, 'inotify_add_watch failed: No space left on device')
+    monkeypatch.setattr(watcher, '_add_watch', add_watch)
+    (repo / 'subdir').mkdir()
+
+    events = set()
+    wait_for(lambda: events.update(watcher.read_events(0.2)) or (str(repo), FULL_SCAN) in events, timeout=5)
+    watcher.close()
+    assert (str(repo), FULL_SCAN) in events
+
+
+def test_watch_repositories(setup_repo):
+    temp_dir, repo = setup_repo
+    config = load_config('config/default.toml', 'config/test_config.toml')
+    config['BackupSettings']['backup_root_path'] = str(temp_dir / 'backup')
+    config['Repositories']['repo_paths'] = [str(repo)]
+    config['WatchSettings'] = {'debounce_seconds': 0.1, 'poll_interval': 0.1}
+    stop_event = threading.Event()
+    thread = threading.Thread(target=watch_repositories, args=(config,), kwargs={'stop_event': stop_event})
+    thread.start()
+    try:
+        assert wait_for(lambda: (temp_dir / 'backup' / 'repo' / 'file1.txt').exists())
+        (repo / 'subdir').mkdir()
+        (repo / 'subdir' / '.env').write_text('SECRET=1')
+        assert wait_for(lambda: (temp_dir / 'backup' / 'repo' / 'subdir' / '.env').exists())
+    finally:
+        stop_event.set()
+        thread.join(10)
+    assert not thread.is_alive()
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])